@@ -1,1433 +1,6583 @@
 import os
+import sys
+import csv
+import random
+import urllib.parse
 import sqlite3
 import hashlib
+import heapq
+import itertools
 import re
+import shutil
+import subprocess
+import threading
 import datetime
+import functools
+import json
+import math
+import mmap
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+from operator import itemgetter
 from getpass import getpass
 from tabulate import tabulate
 from datetime import datetime, timedelta
 
+try:
+    import numpy as np
+except ImportError:  # Forecasts fall back to a slower pure Python sampler
+    np = None
+
+
+# Report records. Amounts are kept as plain floats all the way through the
+# report pipeline and only turned into strings by the render helpers below.
+Transaction = namedtuple("Transaction", "id type amount category description date currency")
+CategoryTotal = namedtuple("CategoryTotal", "type category total")
+PayeeTotal = namedtuple("PayeeTotal", "payee total count")
+
+
+class PeriodTotals:
+    """Income and expense totals for a single period (day, month, ...)."""
+    __slots__ = ("label", "income", "expense")
+
+    def __init__(self, label, income=0.0, expense=0.0):
+        self.label = label
+        self.income = income
+        self.expense = expense
+
+    def add(self, transaction_type, amount):
+        if transaction_type == "income":
+            self.income += amount
+        else:
+            self.expense += amount
+
+    @property
+    def net(self):
+        return self.income - self.expense
+
+    @property
+    def has_data(self):
+        return self.income > 0 or self.expense > 0
+
+    @property
+    def savings_rate(self):
+        """Net savings as a percentage of income, or None without income."""
+        return (self.net / self.income) * 100 if self.income > 0 else None
+
+
+class BudgetStatus:
+    """A budget together with the amount spent against it.
+
+    ``nested`` marks a budget whose category sits below another budgeted
+    category, so its spending is already part of that budget.
+    """
+    __slots__ = ("category", "budget", "spent", "nested")
+
+    def __init__(self, category, budget, spent=0.0, nested=False):
+        self.category = category
+        self.budget = budget
+        self.spent = spent
+        self.nested = nested
+
+    @property
+    def remaining(self):
+        return self.budget - self.spent
+
+    @property
+    def percentage(self):
+        return (self.spent / self.budget) * 100 if self.budget > 0 else None
+
+
+# Month-end forecasts resample whole days of past spending. NumPy runs all
+# paths at once; without it fewer paths are simulated one at a time.
+FORECAST_PATHS = 10000 if np is not None else 2000
+FORECAST_HISTORY_DAYS = 365
+
+SpendForecast = namedtuple("SpendForecast", "category budget spent expected p90 chance_over")
+
+
+def forecast_spending(history, statuses, remaining_days, paths=FORECAST_PATHS, seed=None):
+    """Project month-end spending for each budget by Monte Carlo simulation.
+
+    ``history`` holds one row of daily spend per BudgetStatus in
+    ``statuses``, all covering the same days. Each simulated path draws
+    ``remaining_days`` whole days from history, so categories that tend to
+    be spent together stay correlated. Returns one SpendForecast per status.
+    """
+    days = len(history[0]) if history else 0
+    if not remaining_days or not days:
+        return [
+            SpendForecast(s.category, s.budget, s.spent, s.spent, s.spent, 100.0 if s.spent > s.budget else 0.0)
+            for s in statuses
+        ]
+    
+    if np is not None:
+        rng = np.random.default_rng(seed)
+        daily = np.asarray(history, dtype=float)
+        totals = np.zeros((len(statuses), paths))
+        for picks in rng.integers(0, days, size=(remaining_days, paths)):
+            totals += daily[:, picks]
+        spent = np.array([s.spent for s in statuses])[:, None]
+        budget = np.array([s.budget for s in statuses])[:, None]
+        projected = totals + spent
+        expected = projected.mean(axis=1)
+        p90 = np.percentile(projected, 90, axis=1)
+        chance_over = (projected > budget).mean(axis=1) * 100
+        return [
+            SpendForecast(s.category, s.budget, s.spent, float(expected[i]), float(p90[i]), float(chance_over[i]))
+            for i, s in enumerate(statuses)
+        ]
+    
+    rng = random.Random(seed)
+    columns = list(zip(*history))
+    simulated = zip(*(
+        [sum(day) for day in zip(*rng.choices(columns, k=remaining_days))]
+        for _ in range(paths)
+    ))
+    forecasts = []
+    for status, totals in zip(statuses, simulated):
+        projected = sorted(status.spent + total for total in totals)
+        over = sum(1 for total in projected if total > status.budget)
+        forecasts.append(SpendForecast(
+            status.category, status.budget, status.spent, sum(projected) / paths,
+            projected[min(int(paths * 0.9), paths - 1)], over * 100 / paths
+        ))
+    return forecasts
+
+
+# Amounts are stored in their own currency. Exchange rates are stored as the
+# value of one unit of a currency in DEFAULT_CURRENCY, so DEFAULT_CURRENCY
+# itself never needs a rate.
+DEFAULT_CURRENCY = "USD"
+CURRENCY_SYMBOLS = {"USD": "$", "EUR": "€", "GBP": "£", "INR": "₹", "JPY": "¥"}
+
+
+# Transactions carry an integer day number (days since 1970-01-01) next to
+# their free-text date, so range filters and day/month grouping are integer
+# comparisons. DAY_NUM_SQL computes it in SQL for the column's triggers.
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+DAY_NUM_SQL = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+DAY_NUM_BACKFILL_BATCH = 5000
+
+
+def epoch_day(value):
+    """Day number of a date, datetime or ``YYYY-MM-DD[ HH:MM:SS]`` string."""
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], "%Y-%m-%d")
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def month_days(year, month):
+    """Return ``(first, end)`` day numbers of a month, ``end`` exclusive."""
+    return epoch_day(datetime(year, month, 1)), epoch_day(datetime(year + month // 12, month % 12 + 1, 1))
+
+
+def month_starts(first_year, last_year):
+    """Day numbers of the first of every month from ``first_year`` to ``last_year``.
+
+    ``bisect_right(starts, day) - 1`` is then the month index of a day
+    number, counted from January of ``first_year``.
+    """
+    return [epoch_day(datetime(year, month, 1))
+            for year in range(first_year, last_year + 1) for month in range(1, 13)]
+
+
+# Each transaction stores a fingerprint of its normalized content in a
+# unique index, so importing the same statement twice adds nothing. The
+# n-th identical transaction gets suffix ":n", keeping repeated purchases
+# (two coffees on one day) apart while a re-import maps onto them again.
+FINGERPRINT_BACKFILL_BATCH = 5000
+
+
+def transaction_fingerprint(user_id, transaction_type, amount, category, description, date, currency):
+    """Hash of a transaction's normalized content, without the ":n" suffix.
+
+    Dates keep only the day, amounts are rounded to cents, the category is
+    case-insensitive and the description is lower-cased with runs of
+    whitespace collapsed.
+    """
+    key = "|".join([
+        str(user_id), transaction_type, f"{float(amount):.2f}", category.strip().lower(),
+        " ".join((description or "").lower().split()), str(date)[:10], currency
+    ])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+# Columns of exported CSV files, in the order the import reads them
+EXPORT_COLUMNS = ("date", "type", "amount", "category", "description", "currency", "external_id")
+
+
+# Automatic categorization rules map a description keyword (a substring),
+# a regular expression or an amount range to a category, optionally for
+# one transaction type only; matching ignores case. The highest priority
+# matching rule wins, the earliest added among equal priorities.
+RULE_KINDS = ("keyword", "regex", "amount")
+GLOBAL_REGEX_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+DEFAULT_IMPORT_CATEGORY = "Other"
+
+
+class CategoryMatcher:
+    """A user's categorization rules compiled into one matcher per type.
+
+    ``rules`` are ``(category, kind, pattern, min_amount, max_amount,
+    transaction_type)`` tuples, best first; a rule's rank is its position.
+    Keywords go into an Aho-Corasick automaton, which finds every keyword
+    in a description in one pass. Regular expressions are joined into one
+    alternation of lookaheads in rank order, so a single match attempt
+    returns the best matching one; those with capturing groups (whose
+    numbers and backreferences joining would shift) or global inline flags
+    are searched on their own. Amount ranges are few and checked in
+    rank order, only while they could still beat the best text match.
+    """
+
+    def __init__(self, rules):
+        self.categories = [rule[0] for rule in rules]
+        self._compiled = {
+            transaction_type: self._compile(
+                [(rank, rule) for rank, rule in enumerate(rules) if rule[5] in (None, transaction_type)]
+            )
+            for transaction_type in ("income", "expense")
+        }
+
+    def _compile(self, ranked):
+        none = len(self.categories)
+        # Automaton states: transitions, failure link and best rank ending there
+        goto, fail, best = [{}], [0], [none]
+        for rank, (_, kind, pattern, _, _, _) in ranked:
+            if kind != "keyword":
+                continue
+            state = 0
+            for char in pattern.casefold():
+                if char not in goto[state]:
+                    goto[state][char] = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    best.append(none)
+                state = goto[state][char]
+            best[state] = min(best[state], rank)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, target in goto[state].items():
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[target] = goto[link].get(char, 0)
+                best[target] = min(best[target], best[fail[target]])
+                queue.append(target)
+        
+        expressions, separate = [], []
+        for rank, (_, kind, pattern, _, _, _) in ranked:
+            if kind != "regex":
+                continue
+            compiled = re.compile(pattern, re.IGNORECASE)
+            if compiled.groups or GLOBAL_REGEX_FLAGS.match(pattern):
+                separate.append((rank, compiled))
+            else:
+                expressions.append((rank, pattern))
+        regex = None
+        if expressions:
+            regex = re.compile(
+                "|".join(f"(?=[\\s\\S]*?(?:{pattern}))(?P<rule{rank}>)" for rank, pattern in expressions),
+                re.IGNORECASE
+            )
+        first_regex = min([rank for rank, _ in expressions[:1] + separate[:1]], default=none)
+        amounts = [(rank, low, high) for rank, (_, kind, _, low, high, _) in ranked if kind == "amount"]
+        return goto, fail, best, regex, separate, first_regex, amounts
+
+    def match(self, description, amount, transaction_type):
+        """Return the category of the best rule matching a transaction, or None."""
+        goto, fail, best, regex, separate, first_regex, amounts = self._compiled[transaction_type]
+        found = len(self.categories)
+        if len(goto) > 1:
+            state = 0
+            for char in (description or "").casefold():
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                if best[state] < found:
+                    found = best[state]
+        if first_regex < found:
+            if regex is not None:
+                match = regex.match(description or "")
+                if match:
+                    found = min(found, int(match.lastgroup[4:]))
+            for rank, compiled in separate:
+                if rank >= found:
+                    break
+                if compiled.search(description or ""):
+                    found = rank
+                    break
+        for rank, low, high in amounts:
+            if rank >= found:
+                break
+            if (low is None or amount >= low) and (high is None or amount <= high):
+                found = rank
+                break
+        return self.categories[found] if found < len(self.categories) else None
+
+
+# Payees are compared by the words of their descriptions, less card
+# terminal noise, so "POS UBER *TRIP 4411" and "Uber Trip" are the same
+# payee. The top payees report ranks TOP_PAYEES of them by total and by
+# number of transactions.
+TOP_PAYEES = 10
+PAYEE_WORD = re.compile(r"[^\W\d_]+")
+PAYEE_NOISE = frozenset(["pos", "card", "debit", "purchase", "ach"])
+
+
+def payee_key(description):
+    """Normalize a description to its payee: lower-case words, without
+    digits, punctuation or PAYEE_NOISE words."""
+    words = PAYEE_WORD.findall((description or "").casefold())
+    return " ".join(word for word in words if word not in PAYEE_NOISE)
+
+
+def top_n(rows, limit, *keys):
+    """Return, for each of ``keys``, the ``limit`` largest of ``rows`` by
+    that key, largest first (earlier rows win ties).
+
+    ``rows`` is read once and only ``limit`` rows per key are held, in a
+    bounded min-heap, however many rows there are.
+    """
+    heaps = [[] for _ in keys]
+    for i, row in enumerate(rows):
+        for heap, key in zip(heaps, keys):
+            item = (key(row), -i, row)
+            if len(heap) < limit:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    return [[row for _, _, row in sorted(heap, reverse=True)] for heap in heaps]
+
+
+# Tags are lower-case words (letters, digits, '_' and '-') a transaction can
+# have any number of, e.g. "business" or "trip-2026". Tag queries combine
+# them with and/or/not and parentheses; juxtaposed tags mean "and", and
+# the operator words cannot be tag names.
+TAG_NAME = re.compile(r"[\w-]+")
+TAG_TOKEN = re.compile(r"\s*(\(|\)|[\w-]+)")
+TAG_OPERATORS = ("and", "or", "not")
+
+
+def parse_tags(text):
+    """Split a comma- or space-separated list into valid, lower-case tag names."""
+    tags = [tag for tag in re.split(r"[\s,]+", (text or "").strip().lower()) if tag]
+    for tag in tags:
+        if not TAG_NAME.fullmatch(tag):
+            raise ValueError(f"Invalid tag '{tag}' (use letters, digits, '_' and '-').")
+        if tag in TAG_OPERATORS:
+            raise ValueError(f"'{tag}' is reserved for tag queries and cannot be a tag.")
+    return tags
+
+
+class TagIndex:
+    """Bitmap index of one user's tags.
+
+    The user's transaction IDs are held sorted in an array; a transaction's
+    position there is its ordinal, and each tag is an int whose bit
+    ``ordinal`` is set for every transaction with that tag. Tag queries are
+    then answered with bitwise and/or/not over those ints, whatever the
+    number of rows.
+    """
+    __slots__ = ("ids", "bits", "everything")
+
+    def __init__(self, ids, tagged):
+        """``ids`` are the user's transaction IDs in ascending order and
+        ``tagged`` yields ``(tag, transaction ID)`` pairs."""
+        self.ids = array("q", ids)
+        size = (len(self.ids) + 7) // 8
+        maps = {}
+        for tag, transaction_id in tagged:
+            ordinal = bisect_left(self.ids, transaction_id)
+            if ordinal == len(self.ids) or self.ids[ordinal] != transaction_id:
+                continue
+            bitmap = maps.get(tag)
+            if bitmap is None:
+                bitmap = maps[tag] = bytearray(size)
+            bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+        self.bits = {tag: int.from_bytes(bitmap, "little") for tag, bitmap in maps.items()}
+        self.everything = (1 << len(self.ids)) - 1
+
+    def query(self, expression):
+        """Return the bitset of transactions matching a tag expression such
+        as ``business and not (reimbursable or trip-2026)``.
+
+        Raises ValueError for a malformed expression; unknown tags match
+        nothing.
+        """
+        tokens = []
+        position, text = 0, expression.strip().lower()
+        while position < len(text):
+            match = TAG_TOKEN.match(text, position)
+            if not match:
+                raise ValueError(f"Unexpected '{text[position:].strip()[0]}' in tag query.")
+            tokens.append(match.group(1))
+            position = match.end()
+        if not tokens:
+            raise ValueError("The tag query is empty.")
+        
+        def either(i):
+            bits, i = both(i)
+            while i < len(tokens) and tokens[i] == "or":
+                more, i = both(i + 1)
+                bits |= more
+            return bits, i
+        
+        def both(i):
+            bits, i = single(i)
+            while i < len(tokens) and tokens[i] not in ("or", ")"):
+                more, i = single(i + 1 if tokens[i] == "and" else i)
+                bits &= more
+            return bits, i
+        
+        def single(i):
+            if i == len(tokens):
+                raise ValueError("The tag query ends too early.")
+            token = tokens[i]
+            if token == "not":
+                bits, i = single(i + 1)
+                return self.everything & ~bits, i
+            if token == "(":
+                bits, i = either(i + 1)
+                if i == len(tokens) or tokens[i] != ")":
+                    raise ValueError("Missing ')' in tag query.")
+                return bits, i + 1
+            if token in (")", "and", "or"):
+                raise ValueError(f"Unexpected '{token}' in tag query.")
+            return self.bits.get(token, 0), i + 1
+        
+        bits, i = either(0)
+        if i < len(tokens):
+            raise ValueError(f"Unexpected '{tokens[i]}' in tag query.")
+        return bits
+
+    def count(self, bits):
+        """Number of transactions in a bitset."""
+        return bin(bits).count("1")
+
+    def transaction_ids(self, bits):
+        """Return the transaction IDs in a bitset, in ascending order."""
+        ids = []
+        for index, byte in enumerate(bits.to_bytes((len(self.ids) + 7) // 8, "little")):
+            while byte:
+                low = byte & -byte
+                ids.append(self.ids[index * 8 + low.bit_length() - 1])
+                byte ^= low
+        return ids
+
+
+def stats_without(stats, amount):
+    """Remove one ``amount`` from Welford ``(count, mean, m2)`` statistics
+    (as the category_stats triggers do); None stays None."""
+    if not stats:
+        return None
+    count, mean, m2 = stats
+    if count <= 1:
+        return 0, 0.0, 0.0
+    remaining = (count * mean - amount) / (count - 1)
+    return count - 1, remaining, max(m2 - (amount - mean) * (amount - remaining), 0.0)
+
+
+def parse_amount(text):
+    """Parse an entered amount like ``float`` does, but reject the
+    ``inf`` and ``nan`` that ``float`` also accepts."""
+    amount = float(text)
+    if not math.isfinite(amount):
+        raise ValueError(f"not a finite amount: {text!r}")
+    return amount
+
+
+def format_money(amount, signed=False, currency=DEFAULT_CURRENCY):
+    """Render an amount with its currency, e.g. ``$12.50``, ``-€12.50``, ``CHF 3.00``."""
+    symbol = CURRENCY_SYMBOLS.get(currency, f"{currency} ")
+    if signed:
+        return f"{'-' if amount < 0 else '+'}{symbol}{abs(amount):.2f}"
+    return f"{symbol}{amount:.2f}"
+
+
+class RateCache:
+    """As-of-date exchange rate lookups for a single report run.
+
+    Each currency's rate history is read once, in date order, and searched
+    with bisect; results are memoized per (currency, day) so converting many
+    grouped rows costs one dictionary lookup each. Days are day numbers or
+    ``YYYY-MM-DD`` strings.
+    """
+    __slots__ = ("base", "_cursor", "_series", "_memo")
+
+    def __init__(self, cursor, base=DEFAULT_CURRENCY):
+        self.base = base
+        self._cursor = cursor
+        self._series = {}
+        self._memo = {}
+
+    def rate(self, currency, day):
+        """Value of one ``currency`` unit in DEFAULT_CURRENCY on ``day``."""
+        if currency == DEFAULT_CURRENCY:
+            return 1.0
+        key = (currency, day)
+        if key in self._memo:
+            return self._memo[key]
+        
+        if currency not in self._series:
+            self._cursor.execute(
+                "SELECT date, rate FROM fx_rates WHERE currency = ? ORDER BY date",
+                (currency,)
+            )
+            rows = self._cursor.fetchall()
+            self._series[currency] = ([epoch_day(r[0]) for r in rows], [r[1] for r in rows])
+        days, rates = self._series[currency]
+        if not days:
+            raise LookupError(f"No exchange rate recorded for {currency}.")
+        
+        # Latest rate on or before the day; earlier days use the first known rate
+        index = bisect_right(days, epoch_day(day) if isinstance(day, str) else day) - 1
+        self._memo[key] = rates[max(index, 0)]
+        return self._memo[key]
+
+    def convert(self, amount, currency, day):
+        """Convert ``amount`` from ``currency`` into the base currency."""
+        if currency == self.base:
+            return amount
+        return amount * self.rate(currency, day) / self.rate(self.base, day)
+
+
+def format_percent(value, missing="N/A"):
+    """Render a percentage with one decimal, or ``missing`` for None."""
+    return missing if value is None else f"{value:.1f}%"
+
+
+def format_transaction_row(t):
+    """Render a Transaction record as a table row."""
+    amount = t.amount if t.type == "income" else -t.amount
+    return [
+        t.id,
+        t.type.title(),
+        format_money(amount, signed=True, currency=t.currency),
+        t.category,
+        t.description if t.description else "-",
+        t.date
+    ]
+
+
+def budget_progress(percentage):
+    """Render a budget's spent percentage as a traffic-light progress indicator."""
+    if percentage is None:
+        return "N/A"
+    if percentage > 100:
+        return "🔴 {:5.1f}% (OVER!)".format(percentage)
+    if percentage >= 80:
+        return "🟠 {:5.1f}%".format(percentage)
+    return "🟢 {:5.1f}%".format(percentage)
+
+
+def trend_arrow(net):
+    """Return an arrow showing the direction of a net amount."""
+    return "↑" if net > 0 else "↓" if net < 0 else "→"
+
+
+def category_share_rows(totals, grand_total, limit=None, currency=DEFAULT_CURRENCY, sort=True):
+    """Render ``{category: amount}`` as rows sorted by amount with % share.
+
+    With ``sort=False`` the rows keep the order of ``totals``.
+    """
+    ranked = sorted(totals.items(), key=lambda x: x[1], reverse=True) if sort else list(totals.items())
+    if limit is not None:
+        ranked = ranked[:limit]
+    return [
+        [category, format_money(amount, currency=currency),
+         format_percent((amount / grand_total) * 100 if grand_total > 0 else 0)]
+        for category, amount in ranked
+    ]
+
+
+# Tables with at most this many rows are handed to tabulate as a whole; larger
+# ones are streamed with column widths taken from this many leading rows.
+TABLE_SAMPLE_ROWS = 200
+
+
+class StreamingTable:
+    """Write rows in tabulate's "pretty" layout one at a time.
+
+    Column widths are fixed up front, so rows can be written as soon as
+    they are produced. Cells that do not fit are shortened with an
+    ellipsis in the columns listed in ``truncate``; other columns are left
+    intact so amounts and dates are never cut.
+    """
+
+    def __init__(self, headers, widths, out, truncate=()):
+        self.widths = widths
+        self.out = out
+        self.truncate = set(truncate)
+        self.border = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+        self.out.write(self.border + "\n")
+        self.write_row(headers)
+        self.out.write(self.border + "\n")
+
+    def write_row(self, row):
+        cells = []
+        for i, (value, width) in enumerate(zip(row, self.widths)):
+            text = str(value)
+            if len(text) > width and i in self.truncate:
+                text = text[:max(width - 1, 0)] + "…"
+            cells.append("{0:^{1}}".format(text, width))
+        self.out.write("| " + " | ".join(cells) + " |\n")
+
+    def close(self):
+        self.out.write(self.border + "\n")
+
+
+def print_table(rows, headers, out=None, min_widths=None, truncate=(), sample_size=TABLE_SAMPLE_ROWS):
+    """Print ``rows`` (any iterable) as a "pretty" table.
+
+    Small tables are rendered by tabulate exactly as before. When more than
+    ``sample_size`` rows arrive, widths are computed from the headers, the
+    sampled rows and ``min_widths``, and the remaining rows are streamed to
+    ``out`` without ever holding the whole table in memory.
+    """
+    out = out or sys.stdout
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_size + 1))
+    
+    if len(sample) <= sample_size:
+        out.write(tabulate(sample, headers=headers, tablefmt="pretty") + "\n")
+        return
+    
+    widths = [len(str(h)) for h in headers]
+    for row in sample:
+        for i, value in enumerate(row):
+            widths[i] = max(widths[i], len(str(value)))
+    for i, width in enumerate(min_widths or ()):
+        widths[i] = max(widths[i], width)
+    
+    table = StreamingTable(headers, widths, out, truncate)
+    for row in itertools.chain(sample, rows):
+        table.write_row(row)
+    table.close()
+
+
+@contextmanager
+def pager_output(enabled=True):
+    """Yield a stream that feeds ``$PAGER`` when stdout is a terminal.
+
+    Falls back to stdout when paging is disabled, no pager is configured
+    or stdout is redirected. Quitting the pager early is not an error.
+    """
+    pager = os.environ.get("PAGER")
+    if not enabled or not pager or not sys.stdout.isatty():
+        yield sys.stdout
+        return
+    
+    process = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE,
+                               universal_newlines=True, encoding="utf-8")
+    try:
+        yield process.stdin
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+
+# Listing orders by column; each ends with the row ID so equal values keep
+# a stable order (the ID is part of every index, so a date order still
+# follows the (user_id, date) index). Compiled filter statements are cached
+# per filter shape, FILTER_CACHE_SIZE of them at a time.
+FILTER_SORTS = {"date": "date", "amount": "amount", "category": "category"}
+FILTER_CACHE_SIZE = 64
+
+
+def like_escape(text):
+    """Escape ``text`` for a LIKE pattern with ``ESCAPE '\\'``, so its
+    ``%`` and ``_`` match themselves."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def filter_where(shape):
+    """Compile a TransactionFilter shape into its SQL condition."""
+    start_date, end_date, categories, transaction_type, min_amount, max_amount, description, tags = shape
+    clauses = []
+    if start_date:
+        clauses.append("day_num >= ?")
+    if end_date:
+        clauses.append("day_num <= ?")
+    if categories == 1:
+        clauses.append("category = ?")
+    elif categories:
+        clauses.append(f"category IN ({', '.join('?' * categories)})")
+    if transaction_type:
+        clauses.append("type = ?")
+    if min_amount:
+        clauses.append("amount >= ?")
+    if max_amount:
+        clauses.append("amount <= ?")
+    if description:
+        clauses.append("description LIKE ? ESCAPE '\\'")
+    if tags:
+        clauses.append("id IN (SELECT value FROM json_each(?))")
+    return " AND ".join(clauses) or "1 = 1"
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def filter_select(shape, columns, source, sort, descending, limited):
+    """Compile a TransactionFilter shape into a SELECT of ``columns`` from
+    ``source`` for one user, in the filter's order."""
+    order = "DESC" if descending else "ASC"
+    sql = f"""SELECT {columns} FROM {source} 
+              WHERE user_id = ? AND {filter_where(shape)} 
+              ORDER BY {FILTER_SORTS[sort]} {order}, id {order}"""
+    return sql + " LIMIT ?" if limited else sql
+
+
+class TransactionFilter:
+    """Criteria selecting a user's transactions, and the order and number
+    of them to return.
+
+    Every criterion is optional. ``where`` and ``select`` compile the ones
+    that are set into parameterized SQL whose text depends only on which
+    are set (the filter's ``shape``), so each shape is compiled once and
+    the connection's statement cache reuses its prepared statement. Dates
+    are matched on ``day_num`` and categories by equality, which keeps the
+    (user_id, ...) indexes usable. A ``tags`` query needs the matching
+    transaction IDs (see ``PersonalFinanceManager._filter_tag_ids``).
+    """
+    __slots__ = ("start_date", "end_date", "categories", "type", "min_amount", "max_amount", "description",
+                 "tags", "sort", "descending", "limit")
+
+    def __init__(self, start_date=None, end_date=None, category=None, transaction_type=None,
+                 min_amount=None, max_amount=None, description=None, tags=None, sort="date",
+                 descending=True, limit=None):
+        if sort not in FILTER_SORTS:
+            raise ValueError(f"Cannot sort by '{sort}' (expected one of {', '.join(FILTER_SORTS)}).")
+        self.start_date = start_date
+        self.end_date = end_date
+        # One category or any of several
+        self.categories = (category,) if isinstance(category, str) else tuple(category or ())
+        self.type = transaction_type
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.description = description
+        self.tags = tags
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+
+    def shape(self):
+        """Which criteria are set (and how many categories), as a hashable key."""
+        return (bool(self.start_date), bool(self.end_date), len(self.categories), bool(self.type),
+                self.min_amount is not None, self.max_amount is not None, bool(self.description),
+                bool(self.tags))
+
+    def params(self, tagged_ids=None):
+        """Parameters for the condition, in the order ``filter_where`` uses them."""
+        if self.tags and tagged_ids is None:
+            raise ValueError("A tag query needs the IDs of the transactions it matches.")
+        params = []
+        if self.start_date:
+            params.append(epoch_day(self.start_date))
+        if self.end_date:
+            params.append(epoch_day(self.end_date))
+        params.extend(self.categories)
+        if self.type:
+            params.append(self.type)
+        if self.min_amount is not None:
+            params.append(self.min_amount)
+        if self.max_amount is not None:
+            params.append(self.max_amount)
+        if self.description:
+            params.append(f"%{like_escape(self.description)}%")
+        if self.tags:
+            params.append(tagged_ids)
+        return params
+
+    def where(self, tagged_ids=None):
+        """Return ``(sql, params)``; the SQL is ``1 = 1`` when nothing is set."""
+        return filter_where(self.shape()), self.params(tagged_ids)
+
+    def select(self, columns, user_id, source="transactions", tagged_ids=None):
+        """Return ``(sql, params)`` selecting ``columns`` of the user's
+        matching rows from ``source``, sorted and limited."""
+        sql = filter_select(self.shape(), columns, source, self.sort, self.descending, self.limit is not None)
+        params = [user_id] + self.params(tagged_ids)
+        if self.limit is not None:
+            params.append(self.limit)
+        return sql, params
+
+    def describe(self):
+        """Human-readable summary of the criteria."""
+        parts = []
+        if self.start_date or self.end_date:
+            parts.append(f"dates {self.start_date or '...'} to {self.end_date or '...'}")
+        if self.categories:
+            parts.append(f"categor{'y' if len(self.categories) == 1 else 'ies'} {', '.join(self.categories)}")
+        if self.type:
+            parts.append(f"type {self.type}")
+        if self.min_amount is not None or self.max_amount is not None:
+            low = "..." if self.min_amount is None else f"{self.min_amount:.2f}"
+            high = "..." if self.max_amount is None else f"{self.max_amount:.2f}"
+            parts.append(f"amount {low} to {high}")
+        if self.description:
+            parts.append(f"description contains '{self.description}'")
+        if self.tags:
+            parts.append(f"tagged '{self.tags}'")
+        return ", ".join(parts) or "all transactions"
+
+
+class ReaderPool:
+    """A small pool of read-only connections to a WAL-mode database file.
+
+    Each acquired connection has an open read transaction, so everything a
+    report reads through it comes from one consistent snapshot, and WAL lets
+    the writer keep committing while that snapshot is held.
+
+    With ``memory_uri`` the connections go to that shared-cache in-memory
+    database instead. Shared-cache readers would lock the writer out of
+    the tables they read, so they read uncommitted: they see the writer's
+    changes before it commits (or rolls back), and a snapshot is only
+    consistent while nothing is written.
+    """
+
+    def __init__(self, db_file, size=4, timeout=5.0, archive_file=None, memory_uri=None):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.archive_file = archive_file
+        self.memory_uri = memory_uri
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None and self.memory_uri:
+            conn = sqlite3.connect(self.memory_uri, uri=True, timeout=self.timeout,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA read_uncommitted=1")
+        elif conn is None:
+            uri = "file:" + urllib.parse.quote(os.path.abspath(self.db_file)) + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=self.timeout,
+                                   isolation_level=None, check_same_thread=False)
+        if self.archive_file:
+            attach_archive(conn, self.archive_file, read_only=True)
+        conn.execute("BEGIN")
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.row_factory = None
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# Operation metrics: call and error counters plus latency histograms with
+# fixed buckets (seconds), exported in the Prometheus text format.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_WRITE_INTERVAL = 60
+
+
+class Metrics:
+    """Counters and latency histograms for the operations marked ``@timed``.
+
+    With a ``path``, the metrics are written there at most every
+    ``interval`` seconds, after an operation finishes.
+    """
+
+    def __init__(self, enabled=False, buckets=LATENCY_BUCKETS, path=None, interval=METRICS_WRITE_INTERVAL):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.path = path
+        self.interval = interval
+        self._next_write = time.monotonic() + interval
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+        # operation -> [count per bucket..., count above the last, sum of seconds]
+        self._histograms = {}
+        self._local = threading.local()
+
+    def run(self, operation, func, *args, **kwargs):
+        """Call ``func`` as ``operation``, recording its count, errors and latency."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        frame = [None, None]  # started, stopped
+        stack.append(frame)
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            stack.pop()
+            seconds = (frame[1] or time.perf_counter()) - frame[0] if frame[0] is not None else None
+            with self._lock:
+                self._calls[operation] = self._calls.get(operation, 0) + 1
+                if failed:
+                    self._errors[operation] = self._errors.get(operation, 0) + 1
+                if seconds is not None:
+                    histogram = self._histograms.setdefault(operation, [0] * (len(self.buckets) + 1) + [0.0])
+                    histogram[bisect_left(self.buckets, seconds)] += 1
+                    histogram[-1] += seconds
+            if self.path and time.monotonic() >= self._next_write:
+                self._next_write = time.monotonic() + self.interval
+                try:
+                    self.write()
+                except OSError:
+                    pass  # Tried again after the next interval; metrics never break an operation
+
+    def connection_taken(self):
+        """Start the clock of every running operation that has not started yet."""
+        now = time.perf_counter()
+        for frame in getattr(self._local, "stack", ()):
+            if frame[0] is None:
+                frame[0] = now
+
+    def stop_clock(self):
+        """Stop the clock of every running operation, e.g. before its output
+        goes to a pager the user reads at their own pace."""
+        now = time.perf_counter()
+        for frame in getattr(self._local, "stack", ()):
+            if frame[0] is not None and frame[1] is None:
+                frame[1] = now
+
+    def rows(self):
+        """Return ``(operation, calls, errors, timed, mean_seconds, p95_bucket)`` rows.
+
+        ``p95_bucket`` is the upper bound of the bucket holding the 95th
+        percentile (None above the last bucket or without timings).
+        """
+        with self._lock:
+            calls, errors = dict(self._calls), dict(self._errors)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        rows = []
+        for operation in sorted(calls):
+            counts = histograms.get(operation, [0] * (len(self.buckets) + 1) + [0.0])
+            timed = sum(counts[:-1])
+            mean = counts[-1] / timed if timed else None
+            p95 = None
+            if timed:
+                rank = 0.95 * timed
+                cumulative = list(itertools.accumulate(counts[:-1]))
+                index = next(i for i, c in enumerate(cumulative) if c >= rank)
+                p95 = self.buckets[index] if index < len(self.buckets) else None
+            rows.append((operation, calls[operation], errors.get(operation, 0), timed, mean, p95))
+        return rows
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            calls, errors = dict(self._calls), dict(self._errors)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        lines = [
+            "# HELP finance_manager_operations_total Operations run.",
+            "# TYPE finance_manager_operations_total counter",
+        ]
+        lines += [f'finance_manager_operations_total{{operation="{op}"}} {n}' for op, n in sorted(calls.items())]
+        lines += [
+            "# HELP finance_manager_operation_errors_total Operations that raised an error.",
+            "# TYPE finance_manager_operation_errors_total counter",
+        ]
+        lines += [f'finance_manager_operation_errors_total{{operation="{op}"}} {n}'
+                  for op, n in sorted(errors.items())]
+        lines += [
+            "# HELP finance_manager_operation_duration_seconds Operation latency, from first database access.",
+            "# TYPE finance_manager_operation_duration_seconds histogram",
+        ]
+        for op, counts in sorted(histograms.items()):
+            cumulative = list(itertools.accumulate(counts[:-1]))
+            for bound, count in zip(list(self.buckets) + ["+Inf"], cumulative):
+                lines.append(f'finance_manager_operation_duration_seconds_bucket{{operation="{op}",le="{bound}"}} '
+                             f'{count}')
+            lines.append(f'finance_manager_operation_duration_seconds_sum{{operation="{op}"}} {counts[-1]}')
+            lines.append(f'finance_manager_operation_duration_seconds_count{{operation="{op}"}} {cumulative[-1]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        """Write ``render()`` to ``path`` (default: ``self.path``) atomically,
+        as textfile collectors expect."""
+        path = path or self.path
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+def timed(operation):
+    """Decorate a PersonalFinanceManager method to be recorded as ``operation``."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return method(self, *args, **kwargs)
+            return self.metrics.run(operation, method, self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Seconds between flushes of an in-memory working copy to the database
+# file, the longest stretch of work a crash can lose (0 flushes only at
+# logout and exit)
+WORKING_COPY_FLUSH_INTERVAL = 60
+
+
+# Database maintenance, run for the steps that are due at logout and for
+# all of them from the maintenance menu. ANALYZE refreshes the planner's
+# statistics once this many rows (as counted by the change log) changed
+# since the last run, looking at a bounded sample of each index; each run
+# returns at most MAINTENANCE_VACUUM_PAGES free pages to the file system;
+# and quick_check runs every MAINTENANCE_CHECK_DAYS days.
+MAINTENANCE_ANALYZE_CHANGES = 1000
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+MAINTENANCE_VACUUM_PAGES = 1000
+MAINTENANCE_CHECK_DAYS = 7
+MaintenanceStep = namedtuple("MaintenanceStep", "name seconds result")
+
+
+# Transactions before a user's archive cutoff live in a separate archive
+# database. Monthly summaries of them stay in the hot database, and
+# month-level reports read MONTHLY_ROWS, which merges those summaries (dated
+# on the first of their month) with the hot rows.
+ARCHIVE_AFTER_MONTHS = 24
+MONTHLY_ROWS = """(
+    SELECT user_id, type, amount, category, currency, day_num FROM transactions
+    UNION ALL
+    SELECT user_id, type, total, category, currency, day_num FROM monthly_summaries
+)"""
+
+
+# Receipt scans and other attachments are files named by the SHA-256 of
+# their content under the attachments directory (identical files are stored
+# once); the attachments table only holds their metadata, so transaction
+# scans never read them. Files are copied in chunks, never loaded whole.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+
+def attachment_path(directory, digest):
+    """Location of the file with SHA-256 ``digest`` in an attachment store."""
+    return os.path.join(directory, digest[:2], digest)
+
+
+def store_attachment(source, directory):
+    """Copy the file at ``source`` into an attachment store in chunks.
+
+    Returns ``(digest, size)``. The copy goes to a temporary file first and
+    is renamed into place, so a failed copy never leaves a partial file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    temp_path = os.path.join(directory, f".incoming_{os.getpid()}_{threading.get_ident()}")
+    try:
+        with open(source, "rb") as src, open(temp_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(ATTACHMENT_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+        target = attachment_path(directory, digest.hexdigest())
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return digest.hexdigest(), size
+
+
+# Optional per-user columnar snapshots for analytics over long histories.
+# Each column is a file of fixed-width values (native byte order), one per
+# transaction, archived ones included; meta.json holds the row count, the
+# category and currency names the code columns index into, and the
+# change-log seq the snapshot is current to. Rows are sorted by day up to
+# meta["sorted"]; rows added since the last full rewrite follow unsorted.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = {"day_num": "i", "amount": "d", "category": "i", "type": "B", "currency": "H"}
+SNAPSHOT_TYPES = ("income", "expense")
+
+
+def read_snapshot_meta(directory):
+    """Return a snapshot's meta.json contents, or None if it is missing or stale."""
+    try:
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == SNAPSHOT_VERSION else None
+
+
+def write_snapshot(directory, meta, columns, append=False):
+    """Write a snapshot's column files from ``columns`` (name -> array), then
+    its meta.json.
+
+    Readers only look at the first meta["rows"] values of each column, so
+    with ``append`` the new values go after the rows of the previous
+    meta.json (``append`` is that meta). A full rewrite removes meta.json
+    first; an interrupted one leaves no snapshot rather than a mixed one.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, "meta.json")
+    temp_suffix = f".tmp_{os.getpid()}_{threading.get_ident()}"
+    if not append and os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, values in columns.items():
+        path = os.path.join(directory, name)
+        if append:
+            with open(path, "r+b") as f:
+                f.truncate(append["rows"] * values.itemsize)
+                f.seek(0, os.SEEK_END)
+                values.tofile(f)
+        else:
+            with open(path + temp_suffix, "wb") as f:
+                values.tofile(f)
+            os.replace(path + temp_suffix, path)
+    with open(meta_path + temp_suffix, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + temp_suffix, meta_path)
+
+
+class ColumnSnapshot:
+    """A snapshot directory opened read-only, with each column file
+    memory-mapped and exposed as a typed memoryview in ``columns``.
+
+    Use it as a context manager: the views are only valid until it closes.
+    """
+
+    def __init__(self, directory):
+        self.meta = read_snapshot_meta(directory)
+        if self.meta is None:
+            raise ValueError(f"No snapshot in {directory}")
+        self.rows = self.meta["rows"]
+        self.columns = {}
+        self._maps = []
+        try:
+            for name, code in SNAPSHOT_COLUMNS.items():
+                size = self.rows * array(code).itemsize
+                if not size:
+                    self.columns[name] = memoryview(array(code))
+                    continue
+                with open(os.path.join(directory, name), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                self._maps.append(mapped)
+                self.columns[name] = memoryview(mapped).cast(code)
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in self.columns.values():
+            view.release()
+        self.columns = {}
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def sums(self, first_day, end_day, group_by=(), base=DEFAULT_CURRENCY, rates=None):
+        """Sum amounts on days ``first_day`` up to (not including) ``end_day``.
+
+        Returns ``{(group values..., type): total}`` like ``_converted_sums``,
+        with ``group_by`` drawn from "category" and "day_num". Amounts in the
+        ``base`` currency are added as they are; others are summed per
+        currency and day and then converted with ``rates``. The day-sorted
+        rows are cut to the range by binary search and read straight from
+        the mapped buffers (as zero-copy NumPy arrays when available).
+        """
+        day = self.columns["day_num"]
+        sorted_rows = self.meta["sorted"]
+        parts = [
+            (bisect_left(day, first_day, 0, sorted_rows), bisect_left(day, end_day, 0, sorted_rows), False),
+            (sorted_rows, self.rows, True)
+        ]
+        currencies = self.meta["currencies"]
+        base_code = currencies.index(base) if base in currencies else -1
+        positions = [list(SNAPSHOT_COLUMNS).index(name) for name in group_by] + [3]
+        group = itemgetter(*positions, 4)
+
+        # {(group codes..., type code, currency code, day or None): total}
+        partial = {}
+        for start, stop, unsorted in parts:
+            if start >= stop:
+                continue
+            if np is not None:
+                arrays = [np.frombuffer(self.columns[name][start:stop], dtype=code)
+                          for name, code in SNAPSHOT_COLUMNS.items()]
+                if unsorted:
+                    keep = (arrays[0] >= first_day) & (arrays[0] < end_day)
+                    arrays = [values[keep] for values in arrays]
+                if not len(arrays[0]):
+                    continue
+                foreign = arrays[4] != base_code
+                keys = np.stack([arrays[i].astype(np.int64) for i in positions + [4]]
+                                + [foreign.astype(np.int64), np.where(foreign, arrays[0], 0)], axis=1)
+                unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+                summed = np.bincount(inverse.ravel(), weights=arrays[1], minlength=len(unique))
+                for (*key, is_foreign, day_num), total in zip(unique.tolist(), summed.tolist()):
+                    key = tuple(key) + (day_num if is_foreign else None,)
+                    partial[key] = partial.get(key, 0.0) + total
+                continue
+
+            columns = [self.columns[name][start:stop] for name in SNAPSHOT_COLUMNS]
+            for row in zip(*columns):
+                if unsorted and not first_day <= row[0] < end_day:
+                    continue
+                key = group(row) + (None if row[4] == base_code else row[0],)
+                partial[key] = partial.get(key, 0.0) + row[1]
+            for view in columns:
+                view.release()
+
+        categories = self.meta["categories"]
+        decode = [categories if name == "category" else None for name in group_by]
+        totals = {}
+        for (*key, kind, currency, day_num), total in partial.items():
+            if day_num is not None:
+                total = rates.convert(total, currencies[currency], day_num)
+            key = tuple(names[value] if names else value for names, value in zip(decode, key))
+            key += (SNAPSHOT_TYPES[kind],)
+            totals[key] = totals.get(key, 0) + total
+        return totals
+
+
+def subtree_rows(source):
+    """Wrap a transactions source so every row appears once under each of
+    its category's ancestors (itself included) in ``category_closure``.
+
+    Grouping the result by category then gives subtree totals in one
+    indexed join.
+    """
+    return f"""(
+    SELECT s.user_id, s.type, s.amount, c.ancestor AS category, s.currency, s.day_num, c.depth
+    FROM {source} s JOIN category_closure c ON c.user_id = s.user_id AND c.descendant = s.category
+)"""
+
+
+def category_paths(parents, categories):
+    """Order categories depth-first under their parents, largest first.
+
+    ``parents`` maps a category to its parent and ``categories`` maps
+    categories to their (subtree) totals. Returns ``{path: total}`` with
+    paths such as ``Food > Groceries``.
+    """
+    children = {}
+    for category in categories:
+        parent = parents.get(category)
+        children.setdefault(parent if parent in categories else None, []).append(category)
+    
+    paths = {}
+    def visit(parent, prefix):
+        for category in sorted(children.get(parent, []), key=lambda c: categories[c], reverse=True):
+            path = f"{prefix}{category}"
+            paths[path] = categories[category]
+            visit(category, f"{path} > ")
+    visit(None, "")
+    return paths
+
+
+def archive_backup_file(backup_file):
+    """Name of the archive database copy belonging to a backup file."""
+    return os.path.splitext(backup_file)[0] + ".archive"
+
+
+def attach_archive(conn, archive_file, create=False, read_only=False):
+    """Attach the archive database as ``archive`` and cover it with the
+    temporary ``all_transactions`` view.
+
+    Without an archive file (and unless ``create`` is set) the view covers
+    the hot table only. Must be called outside a transaction. Returns
+    whether the archive is attached.
+    """
+    if any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+        return True
+    if not create and not os.path.exists(archive_file):
+        conn.execute("CREATE TEMP VIEW IF NOT EXISTS all_transactions AS SELECT * FROM main.transactions")
+        return False
+    
+    if read_only:
+        archive_file = "file:" + urllib.parse.quote(os.path.abspath(archive_file)) + "?mode=ro"
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_file,))
+    columns = ", ".join(row[1] for row in conn.execute("PRAGMA main.table_info(transactions)"))
+    conn.execute("DROP VIEW IF EXISTS temp.all_transactions")
+    conn.execute(f"""CREATE TEMP VIEW all_transactions AS 
+                     SELECT {columns} FROM main.transactions 
+                     UNION ALL 
+                     SELECT {columns} FROM archive.transactions""")
+    return True
+
+
+def daily_balance_sql(row, sign):
+    """Trigger statements adding (``sign`` "+") or removing ("-") the
+    transaction ``row`` ("NEW" or "OLD") in ``daily_balances``.
+
+    The amount goes into the running totals of its own day and every later
+    day, for its category and for the all-categories row (category '').
+    A day's row starts from the previous day's totals when first written.
+    """
+    statements = []
+    for category in (f"{row}.category", "''"):
+        if sign == "+":
+            statements.append(f"""
+            INSERT OR IGNORE INTO daily_balance_keys (user_id, category, currency)
+            SELECT {row}.user_id, {category}, {row}.currency WHERE {row}.day_num IS NOT NULL;
+            INSERT OR IGNORE INTO daily_balances (user_id, category, currency, day_num, income, expense)
+            SELECT {row}.user_id, {category}, {row}.currency, {row}.day_num,
+                   COALESCE(p.income, 0), COALESCE(p.expense, 0)
+            FROM (SELECT 1) LEFT JOIN (
+                SELECT income, expense FROM daily_balances
+                 WHERE user_id = {row}.user_id AND category = {category} AND currency = {row}.currency
+                   AND day_num < {row}.day_num
+                 ORDER BY day_num DESC LIMIT 1
+            ) p ON 1
+            WHERE {row}.day_num IS NOT NULL;""")
+        statements.append(f"""
+            UPDATE daily_balances
+               SET income = income {sign} CASE WHEN {row}.type = 'income' THEN {row}.amount ELSE 0 END,
+                   expense = expense {sign} CASE WHEN {row}.type = 'expense' THEN {row}.amount ELSE 0 END
+             WHERE user_id = {row}.user_id AND category = {category} AND currency = {row}.currency
+               AND day_num >= {row}.day_num;""")
+    return "".join(statements)
+
+
+# Replicas of the database (say on a laptop and a desktop) sync through a
+# change log: one entry per changed row, naming the row by a key that is the
+# same in every replica, with a Lamport clock value and the replica it came
+# from. SYNC_TABLES gives each table's user and key expressions for a row
+# alias; exchange rates are shared by all users and logged under user 0.
+SYNC_TABLES = {
+    "transactions": ("{row}.user_id", "{row}.uid"),
+    "budgets": ("{row}.user_id", "{row}.month || '|' || {row}.year || '|' || {row}.category"),
+    "fx_rates": ("0", "{row}.currency || '|' || {row}.date"),
+}
+
+
+def change_log_sql(table, row, op):
+    """Trigger statements logging an ``op`` ("upsert" or "delete") of
+    ``table``'s ``row`` ("NEW" or "OLD") under the next clock value."""
+    user, key = (expression.format(row=row) for expression in SYNC_TABLES[table])
+    return f"""
+            UPDATE meta SET value = value + 1 WHERE key = 'clock';
+            INSERT OR REPLACE INTO change_log (table_name, user_id, row_key, op, clock, origin)
+            SELECT '{table}', {user}, {key}, '{op}',
+                   (SELECT value FROM meta WHERE key = 'clock'),
+                   (SELECT value FROM meta WHERE key = 'replica_id')
+            WHERE {key} IS NOT NULL;"""
+
+
+def change_log_triggers(table, update_columns, delete_when=""):
+    """Insert, update and delete triggers logging ``table``'s changes,
+    except while a sync is applying changes from another replica.
+
+    An update logs the old key as deleted before logging the new row, as
+    natural keys (a budget's month and category, say) can change.
+    """
+    not_syncing = "NOT EXISTS (SELECT 1 FROM meta WHERE key = 'syncing')"
+    update_body = change_log_sql(table, "OLD", "delete") + change_log_sql(table, "NEW", "upsert")
+    return {
+        f"change_log_{table}_insert": f"""
+        AFTER INSERT ON {table} WHEN {not_syncing} BEGIN{change_log_sql(table, "NEW", "upsert")}
+        END""",
+        f"change_log_{table}_update": f"""
+        AFTER UPDATE OF {update_columns} ON {table} WHEN {not_syncing} BEGIN{update_body}
+        END""",
+        f"change_log_{table}_delete": f"""
+        AFTER DELETE ON {table} WHEN {delete_when}{not_syncing} BEGIN{change_log_sql(table, "OLD", "delete")}
+        END""",
+    }
+
+
+# Triggers keeping derived tables consistent with every write to the base
+# tables, whichever code path (or external tool) performs it. They are
+# dropped and recreated on startup so their definitions stay current.
+TRIGGERS = {
+    # Day numbers follow the free-text date on every write
+    "day_num_insert": f"""
+        AFTER INSERT ON transactions WHEN NEW.day_num IS NULL BEGIN
+            UPDATE transactions SET day_num = {DAY_NUM_SQL.format("NEW.date")} WHERE id = NEW.id;
+        END""",
+    "day_num_update": f"""
+        AFTER UPDATE OF date ON transactions BEGIN
+            UPDATE transactions SET day_num = {DAY_NUM_SQL.format("NEW.date")} WHERE id = NEW.id;
+        END""",
+    # Cached yearly comparison totals are dropped for any year that changes
+    "yearly_cache_transaction_insert": """
+        AFTER INSERT ON transactions BEGIN
+            DELETE FROM yearly_cache_years
+             WHERE user_id = NEW.user_id AND year = CAST(substr(NEW.date, 1, 4) AS INTEGER);
+            DELETE FROM yearly_cache_totals
+             WHERE user_id = NEW.user_id AND year = CAST(substr(NEW.date, 1, 4) AS INTEGER);
+        END""",
+    "yearly_cache_transaction_update": """
+        AFTER UPDATE OF user_id, type, amount, category, date, currency ON transactions BEGIN
+            DELETE FROM yearly_cache_years
+             WHERE (user_id = OLD.user_id AND year = CAST(substr(OLD.date, 1, 4) AS INTEGER))
+                OR (user_id = NEW.user_id AND year = CAST(substr(NEW.date, 1, 4) AS INTEGER));
+            DELETE FROM yearly_cache_totals
+             WHERE (user_id = OLD.user_id AND year = CAST(substr(OLD.date, 1, 4) AS INTEGER))
+                OR (user_id = NEW.user_id AND year = CAST(substr(NEW.date, 1, 4) AS INTEGER));
+        END""",
+    "yearly_cache_transaction_delete": """
+        AFTER DELETE ON transactions BEGIN
+            DELETE FROM yearly_cache_years
+             WHERE user_id = OLD.user_id AND year = CAST(substr(OLD.date, 1, 4) AS INTEGER);
+            DELETE FROM yearly_cache_totals
+             WHERE user_id = OLD.user_id AND year = CAST(substr(OLD.date, 1, 4) AS INTEGER);
+        END""",
+    # Any rate change can alter converted totals, so the whole cache goes
+    "yearly_cache_rate_insert": """
+        AFTER INSERT ON fx_rates BEGIN
+            DELETE FROM yearly_cache_years;
+            DELETE FROM yearly_cache_totals;
+        END""",
+    "yearly_cache_rate_update": """
+        AFTER UPDATE ON fx_rates BEGIN
+            DELETE FROM yearly_cache_years;
+            DELETE FROM yearly_cache_totals;
+        END""",
+    "yearly_cache_rate_delete": """
+        AFTER DELETE ON fx_rates BEGIN
+            DELETE FROM yearly_cache_years;
+            DELETE FROM yearly_cache_totals;
+        END""",
+    # Every category in use is its own closure row, so subtree joins see it
+    "category_closure_transaction_insert": """
+        AFTER INSERT ON transactions BEGIN
+            INSERT OR IGNORE INTO category_closure (user_id, ancestor, descendant, depth)
+            VALUES (NEW.user_id, NEW.category, NEW.category, 0);
+        END""",
+    "category_closure_transaction_update": """
+        AFTER UPDATE OF user_id, category ON transactions BEGIN
+            INSERT OR IGNORE INTO category_closure (user_id, ancestor, descendant, depth)
+            VALUES (NEW.user_id, NEW.category, NEW.category, 0);
+        END""",
+    "category_closure_budget_insert": """
+        AFTER INSERT ON budgets BEGIN
+            INSERT OR IGNORE INTO category_closure (user_id, ancestor, descendant, depth)
+            VALUES (NEW.user_id, NEW.category, NEW.category, 0);
+        END""",
+    # Per-user revision counters, bumped by every change a cached result may depend on
+    "data_revision_transaction_insert": """
+        AFTER INSERT ON transactions BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_transaction_update": """
+        AFTER UPDATE OF user_id, type, amount, category, date, currency ON transactions BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (OLD.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+            INSERT INTO data_revisions (user_id, revision) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_transaction_delete": """
+        AFTER DELETE ON transactions BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (OLD.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_budget_insert": """
+        AFTER INSERT ON budgets BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_budget_update": """
+        AFTER UPDATE ON budgets BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (OLD.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+            INSERT INTO data_revisions (user_id, revision) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_budget_delete": """
+        AFTER DELETE ON budgets BEGIN
+            INSERT INTO data_revisions (user_id, revision) VALUES (OLD.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_rate_insert": """
+        AFTER INSERT ON fx_rates BEGIN
+            UPDATE data_revisions SET revision = revision + 1;
+        END""",
+    "data_revision_rate_update": """
+        AFTER UPDATE ON fx_rates BEGIN
+            UPDATE data_revisions SET revision = revision + 1;
+        END""",
+    "data_revision_rate_delete": """
+        AFTER DELETE ON fx_rates BEGIN
+            UPDATE data_revisions SET revision = revision + 1;
+        END""",
+    # Tag bitmaps (see TagIndex) are rebuilt when the revision changes
+    "data_revision_tag_insert": """
+        AFTER INSERT ON transaction_tags BEGIN
+            INSERT INTO data_revisions (user_id, revision) SELECT user_id, 1 FROM tags WHERE id = NEW.tag_id
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    "data_revision_tag_delete": """
+        AFTER DELETE ON transaction_tags BEGIN
+            INSERT INTO data_revisions (user_id, revision) SELECT user_id, 1 FROM tags WHERE id = OLD.tag_id
+            ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1;
+        END""",
+    # Running expense statistics per user/category/currency (Welford's method)
+    "category_stats_insert": """
+        AFTER INSERT ON transactions WHEN NEW.type = 'expense' BEGIN
+            INSERT OR IGNORE INTO category_stats (user_id, category, currency)
+            VALUES (NEW.user_id, NEW.category, NEW.currency);
+            UPDATE category_stats
+               SET count = count + 1,
+                   mean = mean + (NEW.amount - mean) / (count + 1),
+                   m2 = m2 + (NEW.amount - mean) * (NEW.amount - (mean + (NEW.amount - mean) / (count + 1)))
+             WHERE user_id = NEW.user_id AND category = NEW.category AND currency = NEW.currency;
+        END""",
+    # Archiving moves rows out without changing their history, so it sets
+    # the 'archiving' meta flag for the duration of the move
+    "category_stats_delete": """
+        AFTER DELETE ON transactions WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'archiving') BEGIN
+            UPDATE category_stats
+               SET count = count - 1,
+                   mean = CASE WHEN count > 1 THEN (count * mean - OLD.amount) / (count - 1) ELSE 0 END,
+                   m2 = CASE WHEN count > 1
+                        THEN MAX(m2 - (OLD.amount - mean) * (OLD.amount - (count * mean - OLD.amount) / (count - 1)), 0)
+                        ELSE 0 END
+             WHERE OLD.type = 'expense'
+               AND user_id = OLD.user_id AND category = OLD.category AND currency = OLD.currency;
+            DELETE FROM anomalies WHERE transaction_id = OLD.id;
+        END""",
+    "category_stats_update": """
+        AFTER UPDATE OF user_id, type, amount, category, currency ON transactions BEGIN
+            UPDATE category_stats
+               SET count = count - 1,
+                   mean = CASE WHEN count > 1 THEN (count * mean - OLD.amount) / (count - 1) ELSE 0 END,
+                   m2 = CASE WHEN count > 1
+                        THEN MAX(m2 - (OLD.amount - mean) * (OLD.amount - (count * mean - OLD.amount) / (count - 1)), 0)
+                        ELSE 0 END
+             WHERE OLD.type = 'expense'
+               AND user_id = OLD.user_id AND category = OLD.category AND currency = OLD.currency;
+            INSERT OR IGNORE INTO category_stats (user_id, category, currency)
+            SELECT NEW.user_id, NEW.category, NEW.currency WHERE NEW.type = 'expense';
+            UPDATE category_stats
+               SET count = count + 1,
+                   mean = mean + (NEW.amount - mean) / (count + 1),
+                   m2 = m2 + (NEW.amount - mean) * (NEW.amount - (mean + (NEW.amount - mean) / (count + 1)))
+             WHERE NEW.type = 'expense'
+               AND user_id = NEW.user_id AND category = NEW.category AND currency = NEW.currency;
+            -- The flag was judged against the old values (edit_transaction checks again)
+            DELETE FROM anomalies WHERE transaction_id = OLD.id;
+        END""",
+    # Attachments and tags go with their transaction, but stay with archived ones
+    "attachments_transaction_delete": """
+        AFTER DELETE ON transactions WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'archiving') BEGIN
+            DELETE FROM attachments WHERE transaction_id = OLD.id;
+        END""",
+    "tags_transaction_delete": """
+        AFTER DELETE ON transactions WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'archiving') BEGIN
+            DELETE FROM transaction_tags WHERE transaction_id = OLD.id;
+        END""",
+    # Running income/expense totals per day; rows get their day number from
+    # the day_num triggers' update, which is why inserts without one are skipped.
+    # Bulk writes set 'rebuilding_balances' and recompute the totals afterwards.
+    "daily_balance_insert": f"""
+        AFTER INSERT ON transactions
+        WHEN NEW.day_num IS NOT NULL AND NOT EXISTS (SELECT 1 FROM meta WHERE key = 'rebuilding_balances')
+        BEGIN{daily_balance_sql("NEW", "+")}
+        END""",
+    "daily_balance_update": """
+        AFTER UPDATE OF user_id, type, amount, category, currency, day_num ON transactions
+        WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'rebuilding_balances')
+        BEGIN""" + daily_balance_sql("OLD", "-") + daily_balance_sql("NEW", "+") + """
+        END""",
+    "daily_balance_delete": f"""
+        AFTER DELETE ON transactions
+        WHEN OLD.day_num IS NOT NULL AND NOT EXISTS (SELECT 1 FROM meta WHERE key = 'rebuilding_balances')
+        BEGIN{daily_balance_sql("OLD", "-")}
+        END""",
+    # Every transaction gets an ID that is the same in all replicas
+    "transaction_uid_insert": """
+        AFTER INSERT ON transactions WHEN NEW.uid IS NULL BEGIN
+            UPDATE transactions SET uid = lower(hex(randomblob(16))) WHERE id = NEW.id;
+        END""",
+    # Change log for syncing replicas; archiving is a move, not a delete
+    **change_log_triggers("transactions", "user_id, type, amount, category, description, date, currency, uid",
+                          delete_when="NOT EXISTS (SELECT 1 FROM meta WHERE key = 'archiving') AND "),
+    **change_log_triggers("budgets", "user_id, category, amount, month, year, currency"),
+    **change_log_triggers("fx_rates", "currency, date, rate"),
+}
+
+
 class PersonalFinanceManager:
-    def __init__(self, conn=None):
-        self.db_file = "finance_manager.db"
+    # Seconds a connection waits for a lock before giving up
+    BUSY_TIMEOUT = 5.0
+    
+    def __init__(self, conn=None, db_file="finance_manager.db", readers=4,
+                 anomaly_threshold=3.0, anomaly_min_history=5, archive_file=None, attachments_dir=None,
+                 metrics=False, metrics_file=None, snapshots=False, snapshot_dir=None,
+                 in_memory=False, flush_interval=WORKING_COPY_FLUSH_INTERVAL):
+        self.db_file = db_file
+        self.archive_file = archive_file or os.path.splitext(db_file)[0] + "_archive.db"
+        self.attachments_dir = attachments_dir or os.path.splitext(db_file)[0] + "_attachments"
+        # Columnar snapshots for yearly and trend reports, when enabled
+        self.snapshot_dir = (snapshot_dir or os.path.splitext(db_file)[0] + "_snapshots") if snapshots else None
+        self._snapshot_lock = threading.Lock()
         self.conn = conn  # Store provided connection, if any
         self.current_user = None
+        # Expenses this many standard deviations from their category's mean
+        # are flagged, once the category has enough history
+        self.anomaly_threshold = anomaly_threshold
+        self.anomaly_min_history = anomaly_min_history
+        # Month-end forecasts by (user, month, year), valid for one data revision and day
+        self._forecast_cache = {}
+        # Compiled categorization rules by user, valid for one version of the rule set
+        self._category_matchers = {}
+        # Tag bitmaps by user, valid for one data revision
+        self._tag_indexes = {}
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        # With in_memory, the database is worked on as an in-memory copy
+        # (see _write_connection and flush). Its readers share the writer's
+        # cache and read uncommitted (see ReaderPool), so reports can show a
+        # change that is still being made; writes and reports are not
+        # isolated from each other in this mode.
+        self._memory_uri = None
+        if in_memory and not conn:
+            self._memory_uri = f"file:finance_manager_{os.getpid()}_{id(self)}?mode=memory&cache=shared"
+        self.flush_interval = flush_interval
+        self._flushed_changes = 0
+        self._flush_timer = None
+        self._readers = ReaderPool(db_file, size=readers, timeout=self.BUSY_TIMEOUT,
+                                   archive_file=self.archive_file, memory_uri=self._memory_uri)
+        # Operation metrics, also written to metrics_file if given
+        self.metrics = Metrics(enabled=metrics or bool(metrics_file), path=metrics_file)
         self.setup_database()
-        
-    def setup_database(self):
-        """Initialize the database and create necessary tables if they don't exist."""
-        # Use provided connection or create a new one
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
+    
+    def _write_connection(self):
+        """Return the single connection used for changes.
+
+        Without a provided connection this is one long-lived WAL connection
+        shared by all writes of this manager; it is held until ``_release``.
+        """
+        if self.metrics.enabled:
+            self.metrics.connection_taken()
+        if self.conn:
+            return self.conn
+        self._writer_lock.acquire()
+        if self._writer is None and self._memory_uri:
+            self._writer = self._load_working_copy()
+        elif self._writer is None:
+            self._writer = sqlite3.connect(self.db_file, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+            # Only takes effect on a new file (existing ones switch in run_maintenance)
+            self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._writer.execute("PRAGMA journal_mode=WAL")
+            attach_archive(self._writer, self.archive_file)
+        return self._writer
+    
+    def _load_working_copy(self):
+        """Copy the database file into the in-memory database and return
+        the connection that keeps it alive, which becomes the writer.
+
+        The copy is made with the backup API, and flushes are scheduled
+        every ``flush_interval`` seconds from then on.
+        """
+        writer = sqlite3.connect(self._memory_uri, uri=True, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        if os.path.exists(self.db_file):
+            source = sqlite3.connect(self.db_file, timeout=self.BUSY_TIMEOUT)
+            try:
+                source.backup(writer)
+            finally:
+                source.close()
+        writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        attach_archive(writer, self.archive_file)
+        self._flushed_changes = writer.total_changes
+        self._schedule_flush()
+        return writer
+    
+    def _schedule_flush(self):
+        if self.flush_interval:
+            self._flush_timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except (OSError, sqlite3.Error) as e:
+            print(f"\nCould not save the working copy to {self.db_file}: {e}")
+        with self._writer_lock:
+            if self._writer is not None:
+                self._schedule_flush()
+    
+    @timed("flush")
+    def flush(self):
+        """Write the in-memory working copy back to the database file.
+
+        The copy goes to a temporary file with the backup API, is synced to
+        disk and then renamed over the database file, so a crash leaves
+        either the previous file or the new one. Returns whether anything
+        was written: without the in-memory mode, with no changes since the
+        last flush or during a write, there is nothing to do. Other programs
+        must not write to the database file while a working copy is open.
+        """
+        if not self._memory_uri:
+            return False
+        with self._writer_lock:
+            writer = self._writer
+            if writer is None or writer.in_transaction or writer.total_changes == self._flushed_changes:
+                return False
+            temp_file = f"{self.db_file}.flush-{os.getpid()}"
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            target = sqlite3.connect(temp_file)
+            try:
+                writer.backup(target)
+            finally:
+                target.close()
+            with open(temp_file, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.db_file)
+            if os.name == "posix":
+                # Make the rename itself durable
+                directory = os.open(os.path.dirname(os.path.abspath(self.db_file)), os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+            self._flushed_changes = writer.total_changes
+            return True
+    
+    def _read_connection(self, timed=True):
+        """Return a read-only connection holding a consistent snapshot.
+
+        Quick lookups between prompts pass ``timed=False``, so they do not
+        start the clock of the running operation.
+        """
+        if self.metrics.enabled and timed:
+            self.metrics.connection_taken()
+        if self.conn:
+            return self.conn
+        return self._readers.acquire()
+    
+    def _release(self, conn):
+        """Hand back a connection from ``_write_connection``/``_read_connection``."""
+        if conn is self.conn:
+            return
+        if conn is self._writer:
+            # Like closing a connection: anything not committed is discarded
+            conn.rollback()
+            conn.row_factory = None
+            self._writer_lock.release()
+        else:
+            self._readers.release(conn)
+    
+    def close(self):
+        """Close pooled readers, then the writer (which checkpoints the WAL).
+
+        An in-memory working copy is flushed to the database file first.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        try:
+            self.flush()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Could not save the working copy to {self.db_file}: {e}")
+        if self.metrics.path:
+            try:
+                self.metrics.write()
+            except OSError as e:
+                print(f"Could not write metrics to {self.metrics.path}: {e}")
+        self._readers.close()
+        with self._writer_lock:
+            if self._writer is not None:
+                # Lets SQLite refresh statistics it considers stale, usually a
+                # no-op; skipped when another connection holds the lock
+                try:
+                    self._writer.execute("PRAGMA optimize")
+                except sqlite3.OperationalError:
+                    pass
+                self._writer.close()
+                self._writer = None
+        
+    def setup_database(self):
+        """Initialize the database and create necessary tables if they don't exist."""
+        # Use provided connection or the shared writer
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        
+        # Take the write lock first, so managers starting at the same time
+        # do not interleave their schema changes
+        if not self.conn:
+            cursor.execute("BEGIN IMMEDIATE")
+        
+        # Create users table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Create transactions table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            category TEXT NOT NULL,
+            description TEXT,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        
+        # Create budget table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budgets (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            month INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, category, month, year)
+        )
+        ''')
+        
+        # Create exchange rate table (value of one unit in DEFAULT_CURRENCY)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            currency TEXT NOT NULL,
+            date TEXT NOT NULL,
+            rate REAL NOT NULL,
+            PRIMARY KEY (currency, date)
+        )
+        ''')
+        
+        # Columns added after the first release
+        currency_column = f"TEXT NOT NULL DEFAULT '{DEFAULT_CURRENCY}'"
+        self._add_column_if_missing(cursor, "users", "base_currency", currency_column)
+        self._add_column_if_missing(cursor, "transactions", "currency", currency_column)
+        self._add_column_if_missing(cursor, "budgets", "currency", currency_column)
+        self._add_column_if_missing(cursor, "transactions", "day_num", "INTEGER")
+        self._add_column_if_missing(cursor, "users", "archived_before", "INTEGER")
+        self._add_column_if_missing(cursor, "transactions", "fingerprint", "TEXT")
+        self._add_column_if_missing(cursor, "transactions", "external_id", "TEXT")
+        self._add_column_if_missing(cursor, "transactions", "uid", "TEXT")
+        self._autoincrement_transaction_ids(cursor)
+        
+        # Small key/value table for flags and settings shared by all connections
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''')
+        # This replica's ID and its logical clock, for syncing
+        cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('replica_id', lower(hex(randomblob(8))))")
+        cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('clock', 0)")
+        
+        # Per-month totals of archived transactions, dated on the month's first day
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_summaries (
+            user_id INTEGER NOT NULL,
+            day_num INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            type TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            total REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day_num, category, type, currency)
+        )
+        ''')
+        
+        # Cached per-month/category totals for closed years, per base currency
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS yearly_cache_years (
+            user_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            base_currency TEXT NOT NULL,
+            PRIMARY KEY (user_id, year, base_currency)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS yearly_cache_totals (
+            user_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            base_currency TEXT NOT NULL,
+            month INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            type TEXT NOT NULL,
+            total REAL NOT NULL,
+            PRIMARY KEY (user_id, year, base_currency, month, category, type)
+        )
+        ''')
+        
+        # Revision counter per user for invalidating in-memory caches
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_revisions (
+            user_id INTEGER PRIMARY KEY,
+            revision INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        
+        # Running expense statistics and the transactions flagged against them
+        backfill_stats = not self._table_exists(cursor, "category_stats")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_stats (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            mean REAL NOT NULL DEFAULT 0,
+            m2 REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, category, currency)
+        )
+        ''')
+        if backfill_stats:
+            cursor.execute('''
+            INSERT INTO category_stats (user_id, category, currency, count, mean, m2)
+            SELECT user_id, category, currency, COUNT(*), AVG(amount),
+                   MAX(SUM(amount * amount) - COUNT(*) * AVG(amount) * AVG(amount), 0)
+            FROM transactions WHERE type = 'expense'
+            GROUP BY user_id, category, currency
+            ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS anomalies (
+            transaction_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            z_score REAL NOT NULL,
+            mean REAL NOT NULL,
+            stddev REAL NOT NULL,
+            flagged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_anomalies_user ON anomalies (user_id)")
+        
+        # Category hierarchy: each category's parent, and the closure table
+        # holding every (ancestor, descendant) pair with its distance
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_parents (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            PRIMARY KEY (user_id, category)
+        )
+        ''')
+        backfill_closure = not self._table_exists(cursor, "category_closure")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_closure (
+            user_id INTEGER NOT NULL,
+            ancestor TEXT NOT NULL,
+            descendant TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ancestor, descendant)
+        )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_category_closure_descendant ON category_closure (user_id, descendant)"
+        )
+        if backfill_closure:
+            cursor.execute('''
+            INSERT OR IGNORE INTO category_closure (user_id, ancestor, descendant, depth)
+            SELECT user_id, category, category, 0 FROM transactions
+            UNION SELECT user_id, category, category, 0 FROM monthly_summaries
+            UNION SELECT user_id, category, category, 0 FROM budgets
+            ''')
+
+        # Cumulative income/expense of hot transactions up to each day with
+        # activity, per category and currency (category '' for all of them),
+        # and the (category, currency) pairs that have rows
+        backfill_balances = not self._table_exists(cursor, "daily_balances")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_balances (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            day_num INTEGER NOT NULL,
+            income REAL NOT NULL DEFAULT 0,
+            expense REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, category, currency, day_num)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_balance_keys (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            PRIMARY KEY (user_id, category, currency)
+        )
+        ''')
+        if backfill_balances:
+            self._rebuild_daily_balances(cursor)
+
+        # Files attached to transactions (content lives in attachments_dir)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            transaction_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_transaction ON attachments (transaction_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (sha256)")
+        
+        # Automatic categorization rules (see CategoryMatcher). Rules are only
+        # added and deleted, so with AUTOINCREMENT ids a user's rule count
+        # and highest id identify a version of the rule set
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('keyword', 'regex', 'amount')),
+            pattern TEXT,
+            min_amount REAL,
+            max_amount REAL,
+            transaction_type TEXT CHECK (transaction_type IN ('income', 'expense')),
+            category TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_category_rules_user ON category_rules (user_id)")
+        
+        # Households: groups of users reported on together, with budgets
+        # checked against the members' combined spending. Users added by an
+        # owner are only invited; they see nothing of the group, and the
+        # group nothing of them, until they accept
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_groups (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL DEFAULT 'member' CHECK (role IN ('owner', 'member')),
+            status TEXT NOT NULL DEFAULT 'active' CHECK (status IN ('pending', 'active')),
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES user_groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        self._add_column_if_missing(cursor, "group_members", "status", "TEXT NOT NULL DEFAULT 'active'")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id)")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_budgets (
+            id INTEGER PRIMARY KEY,
+            group_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            month INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            currency TEXT NOT NULL DEFAULT 'USD',
+            FOREIGN KEY (group_id) REFERENCES user_groups (id),
+            UNIQUE(group_id, category, month, year)
+        )
+        ''')
+        
+        # Tags: any number per transaction, next to its single category
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, name)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transaction_tags (
+            tag_id INTEGER NOT NULL,
+            transaction_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, transaction_id),
+            FOREIGN KEY (tag_id) REFERENCES tags (id),
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+        ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_tags_transaction ON transaction_tags (transaction_id)")
+        
+        # Changes to sync (latest per row, in seq order) and, per replica
+        # synced with, the last of its change log's seqs applied here
+        backfill_change_log = not self._table_exists(cursor, "change_log")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            row_key TEXT NOT NULL,
+            op TEXT NOT NULL,
+            clock INTEGER NOT NULL,
+            origin TEXT NOT NULL,
+            UNIQUE (table_name, user_id, row_key)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_peers (
+            replica_id TEXT PRIMARY KEY,
+            received_seq INTEGER NOT NULL DEFAULT 0,
+            synced_at TIMESTAMP
+        )
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_uid ON transactions (uid)")
+        # Per-user changes since a seq, for refreshing columnar snapshots
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_change_log_user_seq ON change_log (table_name, user_id, seq)"
+        )
+        if backfill_change_log:
+            # Existing rows are all logged at clock 1, so a first sync sends everything
+            cursor.execute("UPDATE transactions SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+            for table, (user, key) in SYNC_TABLES.items():
+                cursor.execute(
+                    f"""INSERT OR REPLACE INTO change_log (table_name, user_id, row_key, op, clock, origin) 
+                        SELECT '{table}', {user.format(row="t")}, {key.format(row="t")}, 'upsert', 1, 
+                               (SELECT value FROM meta WHERE key = 'replica_id') 
+                        FROM {table} t"""
+                )
+            cursor.execute("UPDATE meta SET value = MAX(CAST(value AS INTEGER), 1) WHERE key = 'clock'")
+        
+        # Indexes for per-user date range scans
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_category ON transactions (user_id, category)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_day ON transactions (user_id, day_num)"
+        )
+        
+        # Duplicate detection: one row per fingerprint, and per ID from the source
+        cursor.execute(
+            """CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_fingerprint 
+               ON transactions (user_id, fingerprint)"""
+        )
+        cursor.execute(
+            """CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_external_id 
+               ON transactions (user_id, external_id) WHERE external_id IS NOT NULL"""
+        )
+        
+        self._create_triggers(cursor)
+        self._backfill_day_numbers(conn, cursor)
+        self._backfill_fingerprints(conn, cursor)
+        
+        # Commit changes if we own the connection
+        if not self.conn:
+            conn.commit()
+        if attach_archive(conn, self.archive_file):
+            self._create_archive_schema(cursor)
+            self._finish_archiving(cursor)
+            self._reserve_archived_ids(cursor)
+            if not self.conn:
+                conn.commit()
+        self._release(conn)
+        
+    def _create_triggers(self, cursor):
+        """(Re)create the triggers that maintain derived tables."""
+        for name, body in TRIGGERS.items():
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(f"CREATE TRIGGER {name} {body}")
+    
+    def _backfill_day_numbers(self, conn, cursor):
+        """Fill in ``day_num`` for rows written before the column existed.
+
+        Rows are updated in id ranges of DAY_NUM_BACKFILL_BATCH, committing
+        after each batch (when we own the connection) so the writer lock is
+        only held briefly on large databases.
+        """
+        cursor.execute("SELECT MIN(id), MAX(id) FROM transactions WHERE day_num IS NULL")
+        first, last = cursor.fetchone()
+        if first is None:
+            return
+        
+        for start in range(first, last + 1, DAY_NUM_BACKFILL_BATCH):
+            cursor.execute(
+                f"""UPDATE transactions SET day_num = {DAY_NUM_SQL.format("date")} 
+                    WHERE id >= ? AND id < ? AND day_num IS NULL""",
+                (start, start + DAY_NUM_BACKFILL_BATCH)
+            )
+            if not self.conn:
+                conn.commit()
+    
+    def _rebuild_daily_balances(self, cursor, user_id=None):
+        """Recompute ``daily_balances`` from the hot transactions, for one
+        user or everyone, with a single windowed running sum.
+
+        Used on first start and after bulk writes made with the
+        'rebuilding_balances' flag set, which is cheaper than shifting the
+        running totals of every later day once per row.
+        """
+        where, params = ("WHERE user_id = ?", [user_id]) if user_id is not None else ("", [])
+        cursor.execute(f"DELETE FROM daily_balances {where}", params)
+        cursor.execute(f"DELETE FROM daily_balance_keys {where}", params)
+        and_user = "AND user_id = ?" if user_id is not None else ""
+        cursor.execute(f'''
+        INSERT INTO daily_balances (user_id, category, currency, day_num, income, expense)
+        SELECT user_id, category, currency, day_num,
+               SUM(income) OVER running, SUM(expense) OVER running
+        FROM (
+            SELECT user_id, category, currency, day_num,
+                   SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END) AS income,
+                   SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END) AS expense
+            FROM transactions WHERE day_num IS NOT NULL {and_user}
+            GROUP BY user_id, category, currency, day_num
+            UNION ALL
+            SELECT user_id, '', currency, day_num,
+                   SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END),
+                   SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END)
+            FROM transactions WHERE day_num IS NOT NULL {and_user}
+            GROUP BY user_id, currency, day_num
+        )
+        WINDOW running AS (PARTITION BY user_id, category, currency ORDER BY day_num)
+        ''', params * 2)
+        cursor.execute(f"""INSERT OR IGNORE INTO daily_balance_keys (user_id, category, currency) 
+                           SELECT DISTINCT user_id, category, currency FROM daily_balances {where}""", params)
+    
+    def _backfill_fingerprints(self, conn, cursor):
+        """Fingerprint rows written without one (before the column existed,
+        or by tools that bypass the insert paths).
+
+        Works through FINGERPRINT_BACKFILL_BATCH rows at a time, committing
+        after each batch when we own the connection.
+        """
+        while True:
+            cursor.execute(
+                f"""SELECT id, user_id, type, amount, category, description, date, currency 
+                    FROM transactions WHERE fingerprint IS NULL ORDER BY id LIMIT {FINGERPRINT_BACKFILL_BATCH}"""
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            for transaction_id, user_id, *content in rows:
+                fingerprint = self._next_fingerprint(cursor, user_id, transaction_fingerprint(user_id, *content))
+                cursor.execute("UPDATE transactions SET fingerprint = ? WHERE id = ?", (fingerprint, transaction_id))
+            if not self.conn:
+                conn.commit()
+    
+    def _next_fingerprint(self, cursor, user_id, base):
+        """Return the first unused ``base:n`` fingerprint for a user.
+
+        The existing ``base:*`` fingerprints are one range probe of the
+        unique index, so a new transaction never collides with an earlier
+        identical one.
+        """
+        cursor.execute(
+            "SELECT fingerprint FROM transactions WHERE user_id = ? AND fingerprint > ? AND fingerprint < ?",
+            (user_id, f"{base}:", f"{base};")
+        )
+        used = [int(row[0].rpartition(":")[2]) for row in cursor.fetchall()]
+        return f"{base}:{max(used, default=0) + 1}"
+    
+    def _create_archive_schema(self, cursor):
+        """Create the archive's transactions table, with every hot column."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive.transactions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            category TEXT NOT NULL,
+            description TEXT,
+            date TIMESTAMP
+        )
+        ''')
+        cursor.execute("PRAGMA archive.table_info(transactions)")
+        archived = {row[1] for row in cursor.fetchall()}
+        cursor.execute("PRAGMA main.table_info(transactions)")
+        for _, column, column_type, *_ in cursor.fetchall():
+            if column not in archived:
+                cursor.execute(f"ALTER TABLE archive.transactions ADD COLUMN {column} {column_type}")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS archive.idx_archive_user_day ON transactions (user_id, day_num)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS archive.idx_archive_user_fingerprint ON transactions (user_id, fingerprint)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS archive.idx_archive_user_external_id ON transactions (user_id, external_id)"
+        )
+    
+    def _table_exists(self, cursor, table):
+        """Check whether a table is already present in the main database."""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return cursor.fetchone() is not None
+    
+    def _autoincrement_transaction_ids(self, cursor):
+        """Rebuild a transactions table created without AUTOINCREMENT.
+
+        Transaction IDs must stay unique across the hot and archive
+        databases (see ``_reserve_archived_ids``), which plain rowids do not
+        guarantee once the highest ones are archived. Indexes and triggers
+        go with the old table and are recreated by ``setup_database``.
+        """
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transactions'")
+        sql = cursor.fetchone()[0]
+        if "AUTOINCREMENT" in sql.upper():
+            return
+        sql = re.sub(r"^CREATE TABLE \S+", "CREATE TABLE transactions_rebuilt", sql)
+        sql = re.sub(r"\bid INTEGER PRIMARY KEY\b", "id INTEGER PRIMARY KEY AUTOINCREMENT", sql, count=1)
+        cursor.execute(sql)
+        cursor.execute("INSERT INTO transactions_rebuilt SELECT * FROM transactions")
+        cursor.execute("DROP TABLE transactions")
+        # Leave views and triggers that name the table alone while it is missing
+        cursor.execute("PRAGMA legacy_alter_table=ON")
+        try:
+            cursor.execute("ALTER TABLE transactions_rebuilt RENAME TO transactions")
+        finally:
+            cursor.execute("PRAGMA legacy_alter_table=OFF")
+    
+    def _reserve_archived_ids(self, cursor):
+        """Make new transactions get IDs above every archived one, so an ID
+        (and the tags, attachments and anomaly flags keyed by it) never
+        names two transactions."""
+        cursor.execute(
+            """UPDATE main.sqlite_sequence 
+               SET seq = MAX(seq, COALESCE((SELECT MAX(id) FROM archive.transactions), 0)) 
+               WHERE name = 'transactions'"""
+        )
+        if not cursor.rowcount:
+            cursor.execute(
+                """INSERT INTO main.sqlite_sequence (name, seq) 
+                   SELECT 'transactions', MAX(id) FROM archive.transactions HAVING MAX(id) IS NOT NULL"""
+            )
+    
+    def _add_column_if_missing(self, cursor, table, column, definition):
+        """Add a column to an existing table unless it is already there."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    def hash_password(self, password):
+        """Hash the password using SHA-256."""
+        return hashlib.sha256(password.encode()).hexdigest()
+    
+    def register_user(self):
+        """Register a new user."""
+        print("\n=== User Registration ===")
+        
+        while True:
+            username = input("Enter username (min 3 characters): ").strip()
+            if len(username) < 3:
+                print("Username must be at least 3 characters long.")
+                continue
+                
+            # Check if username exists
+            conn = self._read_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+                taken = cursor.fetchone() is not None
+            finally:
+                self._release(conn)
+            if taken:
+                print("Username already exists. Please choose another one.")
+                continue
+            
+            # Password validation
+            while True:
+                password = getpass("Enter password (min 6 characters): ")
+                if len(password) < 6:
+                    print("Password must be at least 6 characters long.")
+                    continue
+                    
+                confirm_password = getpass("Confirm password: ")
+                if password != confirm_password:
+                    print("Passwords do not match. Try again.")
+                    continue
+                break
+            
+            # Save user to database; the writer is only taken once the prompts are done
+            password_hash = self.hash_password(password)
+            conn = self._write_connection()
+            try:
+                conn.execute(
+                    "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                    (username, password_hash)
+                )
+                if not self.conn:
+                    conn.commit()
+                print("\n✓ Registration successful! You can now log in.")
+                break
+            except sqlite3.IntegrityError:
+                print("Username already exists. Please choose another one.")
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+            finally:
+                self._release(conn)
+            
+    def login(self):
+        """Authenticate user and set current_user if successful."""
+        print("\n=== User Login ===")
+        
+        username = input("Username: ").strip()
+        password = getpass("Password: ")
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                "SELECT id, username, password_hash, base_currency FROM users WHERE username = ?", 
+                (username,)
+            )
+            user = cursor.fetchone()
+            
+            if user and user[2] == self.hash_password(password):
+                self.current_user = {"id": user[0], "username": user[1], "base_currency": user[3]}
+                print(f"\n✓ Welcome back, {user[1]}!")
+                if not self.conn:
+                    conn.commit()
+                return True
+            else:
+                print("Invalid username or password.")
+                return False
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def logout(self):
+        """Log out the current user, running any database maintenance that is due."""
+        if self.current_user:
+            try:
+                self.run_maintenance()
+            except sqlite3.Error as e:
+                print(f"Database maintenance failed: {e}")
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Could not save the working copy to {self.db_file}: {e}")
+            print(f"\n✓ Goodbye, {self.current_user['username']}!")
+            self.current_user = None
+        else:
+            print("No user is currently logged in.")
+    
+    @timed("add_transaction")
+    def add_transaction(self):
+        """Add a new income or expense transaction."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Add Transaction ===")
+        
+        # Get transaction type (income or expense)
+        while True:
+            transaction_type = input("Transaction type (income/expense): ").strip().lower()
+            if transaction_type in ["income", "expense"]:
+                break
+            print("Invalid type. Please enter 'income' or 'expense'.")
+        
+        # Get currency (default is the user's base currency)
+        currency = self._prompt_currency(self._base_currency())
+        
+        # Get amount
+        while True:
+            try:
+                amount = parse_amount(input(f"Amount ({currency}): ").strip())
+                if amount <= 0:
+                    print("Amount must be greater than zero.")
+                    continue
+                break
+            except ValueError:
+                print("Invalid amount. Please enter a number.")
+        
+        # Get description
+        description = input("Description (optional): ").strip()
+        
+        # Get category, suggested by the categorization rules
+        suggestion = self._suggest_category(description, amount, transaction_type)
+        categories = self.get_categories(transaction_type)
+        print(f"\nAvailable {transaction_type} categories:")
+        for i, category in enumerate(categories, 1):
+            print(f"{i}. {category}")
+        print(f"{len(categories) + 1}. Other (create new)")
+        prompt = "\nSelect category number: "
+        if suggestion:
+            prompt = f"\nSelect category number (leave empty for {suggestion}): "
+        
+        while True:
+            try:
+                choice = input(prompt).strip()
+                if suggestion and not choice:
+                    category = suggestion
+                    break
+                choice = int(choice)
+                if 1 <= choice <= len(categories):
+                    category = categories[choice - 1]
+                    break
+                elif choice == len(categories) + 1:
+                    category = input("Enter new category name: ").strip().title()
+                    if not category:
+                        print("Category cannot be empty.")
+                        continue
+                    break
+                else:
+                    print("Invalid choice.")
+            except ValueError:
+                print("Please enter a number.")
+        
+        # Get date (default is today)
+        while True:
+            date_input = input("Date (YYYY-MM-DD, leave empty for today): ").strip()
+            if not date_input:
+                date = datetime.now().strftime("%Y-%m-%d")
+                break
+            
+            try:
+                date = datetime.strptime(date_input, "%Y-%m-%d").strftime("%Y-%m-%d")
+                break
+            except ValueError:
+                print("Invalid date format. Please use YYYY-MM-DD.")
+        
+        # Save transaction to database
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        
+        try:
+            stats = self._category_stats(cursor, self.current_user["id"], transaction_type, category, currency)
+            fingerprint = self._next_fingerprint(cursor, self.current_user["id"], transaction_fingerprint(
+                self.current_user["id"], transaction_type, amount, category, description, date, currency
+            ))
+            cursor.execute(
+                """INSERT INTO transactions 
+                (user_id, type, amount, category, description, date, currency, fingerprint) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (self.current_user["id"], transaction_type, amount, category, description, date, currency,
+                 fingerprint)
+            )
+            anomaly = self._flag_anomaly(cursor, cursor.lastrowid, amount, stats)
+            if not self.conn:
+                conn.commit()
+            print(f"\n✓ {transaction_type.title()} transaction added successfully!")
+            
+            if anomaly:
+                z_score, mean, stddev = anomaly
+                print(f"\n⚠️ Unusual spending: this {category} expense is {abs(z_score):.1f} standard deviations "
+                      f"from your usual {format_money(mean, currency=currency)} "
+                      f"(± {format_money(stddev, currency=currency)}).")
+            
+            if not self._has_rate(cursor, currency):
+                print(f"Note: no exchange rate for {currency} yet. Add one under Exchange Rates "
+                      f"so reports can convert it to {self._base_currency()}.")
+            
+            # Check if budget is exceeded for expense transactions
+            if transaction_type == "expense":
+                self.check_budget_limit(category, amount, date)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._release(conn)
+    
+    def _category_stats(self, cursor, user_id, transaction_type, category, currency):
+        """Return ``(count, mean, m2)`` for an expense category, or None."""
+        if transaction_type != "expense":
+            return None
+        cursor.execute(
+            """SELECT count, mean, m2 FROM category_stats 
+               WHERE user_id = ? AND category = ? AND currency = ?""",
+            (user_id, category, currency)
+        )
+        return cursor.fetchone()
+    
+    def _flag_anomaly(self, cursor, transaction_id, amount, stats):
+        """Record a transaction as an anomaly if it is an outlier for ``stats``.
+
+        ``stats`` are the category's statistics without this transaction
+        (from before the insert, or see ``stats_without`` after an edit),
+        so the check is a constant-time comparison. Returns
+        ``(z_score, mean, stddev)`` when flagged, otherwise None.
+        """
+        if not stats:
+            return None
+        count, mean, m2 = stats
+        if count < max(self.anomaly_min_history, 2):
+            return None
+        stddev = (m2 / (count - 1)) ** 0.5
+        if stddev <= 0:
+            return None
+        z_score = (amount - mean) / stddev
+        if abs(z_score) < self.anomaly_threshold:
+            return None
+        cursor.execute(
+            """INSERT OR REPLACE INTO anomalies (transaction_id, user_id, z_score, mean, stddev) 
+               SELECT id, user_id, ?, ?, ? FROM transactions WHERE id = ?""",
+            (z_score, mean, stddev, transaction_id)
+        )
+        return z_score, mean, stddev
+    
+    @timed("import_transactions")
+    def import_transactions(self, path=None):
+        """Import transactions from a CSV file, skipping ones already recorded."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+        
+        print("\n=== Import Transactions ===")
+        print("CSV columns: date, type, amount, and optionally category, description, currency, external_id")
+        print(f"Rows without a category are categorized by your rules, or as {DEFAULT_IMPORT_CATEGORY}.")
+        
+        while not path:
+            path = input("CSV file path: ").strip()
+        
+        try:
+            with open(path, newline="", encoding="utf-8") as f:
+                inserted, duplicates, invalid = self._import_rows(csv.DictReader(f))
+        except OSError as e:
+            print(f"Error reading file: {e}")
+            return
+        except UnicodeDecodeError as e:
+            print(f"Error reading file: {e} (save it as UTF-8 and try again)")
+            return
+        except csv.Error as e:
+            print(f"Error reading file: not a valid CSV file ({e})")
+            return
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        
+        print(f"\n✓ Imported {inserted} transaction(s), skipped {duplicates} already recorded.")
+        if invalid:
+            print(f"Skipped {len(invalid)} invalid row(s):")
+            for line, message in invalid[:10]:
+                print(f"  Line {line}: {message}")
+            if len(invalid) > 10:
+                print(f"  ... and {len(invalid) - 10} more")
+    
+    @timed("export_transactions")
+    def export_transactions(self, criteria=None, path=None):
+        """Export the transactions matching a filter to a CSV file that
+        ``import_transactions`` can read back; returns the number written."""
+        if not self.current_user:
+            print("Please log in first.")
+            return None
+        
+        print("\n=== Export Transactions ===")
+        
+        if criteria is None:
+            print("Describe the transactions to export (leave any field empty to ignore it).")
+            criteria = self._prompt_filter(listing=True)
+        while not path:
+            path = input("CSV file path: ").strip()
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(*self._compile_filter(cursor, criteria, ", ".join(EXPORT_COLUMNS)))
+            # Rows stream from the cursor into the file
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(EXPORT_COLUMNS)
+                count = 0
+                for row in cursor:
+                    writer.writerow(row)
+                    count += 1
+        except ValueError as e:
+            print(f"Invalid filter: {e}")
+            return None
+        except OSError as e:
+            print(f"Error writing file: {e}")
+            return None
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+        
+        print(f"\n✓ Exported {count} transaction(s) ({criteria.describe()}) to {path}")
+        return count
+    
+    def _import_rows(self, rows):
+        """Insert CSV rows (dicts) for the current user in one transaction.
+
+        Rows stream into ``executemany`` with ``ON CONFLICT DO NOTHING``, so
+        duplicates are found by probes of the unique fingerprint and
+        external ID indexes (and of the archive's, for users with archived
+        history). The n-th identical row of the file gets fingerprint
+        suffix n, so re-importing an overlapping statement matches row for
+        row. Rows without a category get the one the user's categorization
+        rules give them, or DEFAULT_IMPORT_CATEGORY. Returns
+        ``(inserted, duplicates, invalid)``, with ``invalid``
+        listing ``(line, message)`` for rows that could not be parsed.
+        """
+        user_id = self.current_user["id"]
+        base_currency = self._base_currency()
+        occurrences = {}
+        invalid = []
+        valid = 0
+        
+        def parameters():
+            nonlocal valid
+            for line, row in enumerate(rows, 2):
+                try:
+                    transaction_type = (row.get("type") or "").strip().lower()
+                    if transaction_type not in ("income", "expense"):
+                        raise ValueError("type must be 'income' or 'expense'")
+                    amount = float(row.get("amount") or "nan")
+                    if not (math.isfinite(amount) and amount > 0):
+                        raise ValueError("amount must be a number greater than zero")
+                    category = (row.get("category") or "").strip()
+                    date = datetime.strptime((row.get("date") or "").strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+                except ValueError as e:
+                    invalid.append((line, str(e)))
+                    continue
+                
+                description = (row.get("description") or "").strip()
+                currency = (row.get("currency") or "").strip().upper() or base_currency
+                external_id = (row.get("external_id") or "").strip() or None
+                # Fingerprinted as in the file, so re-imports match whatever the rules say by then
+                base = transaction_fingerprint(user_id, transaction_type, amount, category, description, date,
+                                               currency)
+                if not category and matcher:
+                    category = matcher.match(description, amount, transaction_type)
+                category = category or DEFAULT_IMPORT_CATEGORY
+                occurrences[base] = occurrences.get(base, 0) + 1
+                valid += 1
+                yield (user_id, transaction_type, amount, category, description, date, currency,
+                       f"{base}:{occurrences[base]}", external_id)
+        
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            matcher = self._category_matcher(cursor)
+            cursor.execute("SELECT archived_before FROM users WHERE id = ?", (user_id,))
+            has_archive = cursor.fetchone()[0] is not None and any(
+                row[1] == "archive" for row in cursor.execute("PRAGMA database_list")
+            )
+            if has_archive:
+                source = """SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9 
+                    WHERE NOT EXISTS (SELECT 1 FROM archive.transactions WHERE user_id = ?1 AND fingerprint = ?8) 
+                      AND NOT EXISTS (SELECT 1 FROM archive.transactions WHERE user_id = ?1 AND external_id = ?9)"""
+            else:
+                source = "VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9)"
+            
+            # Running daily totals are rebuilt once rather than shifted per row
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilding_balances', '1')")
+            cursor.executemany(
+                f"""INSERT INTO transactions 
+                    (user_id, type, amount, category, description, date, currency, fingerprint, external_id) 
+                    {source} ON CONFLICT DO NOTHING""",
+                parameters()
+            )
+            inserted = cursor.rowcount
+            cursor.execute("DELETE FROM meta WHERE key = 'rebuilding_balances'")
+            if inserted:
+                self._rebuild_daily_balances(cursor, user_id)
+            if not self.conn:
+                conn.commit()
+        finally:
+            self._release(conn)
+        return inserted, valid - inserted, invalid
+    
+    def _base_currency(self):
+        """Currency that reports are converted into for the current user."""
+        return (self.current_user or {}).get("base_currency") or DEFAULT_CURRENCY
+    
+    def _money(self, amount, signed=False):
+        """Format an amount in the current user's base currency."""
+        return format_money(amount, signed, self._base_currency())
+    
+    def _rates(self, cursor):
+        """Return a fresh RateCache for one report run."""
+        return RateCache(cursor, self._base_currency())
+    
+    def _has_rate(self, cursor, currency):
+        """Check whether ``currency`` can be converted to the base currency."""
+        if currency == self._base_currency():
+            return True
+        for code in {currency, self._base_currency()} - {DEFAULT_CURRENCY}:
+            cursor.execute("SELECT 1 FROM fx_rates WHERE currency = ? LIMIT 1", (code,))
+            if cursor.fetchone() is None:
+                return False
+        return True
+    
+    def _prompt_currency(self, default):
+        """Prompt for a 3-letter currency code."""
+        while True:
+            currency = input(f"Currency (3-letter code, leave empty for {default}): ").strip().upper()
+            if not currency:
+                return default
+            if re.fullmatch(r"[A-Z]{3}", currency):
+                return currency
+            print("Invalid currency code. Please use a 3-letter code such as USD or EUR.")
+    
+    def get_categories(self, transaction_type):
+        """Get list of categories based on transaction type."""
+        if transaction_type == "income":
+            return ["Salary", "Freelance", "Investment", "Gift", "Refund"]
+        else:  # expense
+            return ["Food", "Housing", "Transportation", "Utilities", "Entertainment", 
+                    "Healthcare", "Education", "Shopping", "Personal Care"]
+    
+    @timed("view_transactions")
+    def view_transactions(self, criteria=None):
+        """View the current user's transactions matching a filter."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== View Transactions ===")
+        
+        if criteria is None:
+            print("Describe the transactions to show (leave any field empty to ignore it).")
+            criteria = self._prompt_filter(listing=True)
+        
+        conn = self._read_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        try:
+            # Widths that do not depend on the data seen so far
+            cursor.execute("SELECT MAX(id) FROM transactions")
+            max_id = cursor.fetchone()[0] or 0
+            min_widths = [len(str(max_id)), len("Expense"), 0, 0, 0, len("YYYY-MM-DD")]
+            
+            columns = "id, type, amount, category, description, date, currency"
+            cursor.execute(*self._compile_filter(cursor, criteria, columns))
+            first = cursor.fetchone()
+            
+            if first is None:
+                print(f"\nNo transactions match: {criteria.describe()}.")
+                return
+            
+            # Display transactions as they are read, totalling them in the same pass
+            headers = ["ID", "Type", "Amount", "Category", "Description", "Date"]
+            totals = PeriodTotals("all")
+            rates = self._rates(conn.cursor())
+            
+            def rows():
+                for t in map(Transaction._make, itertools.chain([first], cursor)):
+                    totals.add(t.type, rates.convert(t.amount, t.currency, t.date[:10]))
+                    yield format_transaction_row(t)
+            
+            with pager_output() as out:
+                if out is not sys.stdout and self.metrics.enabled:
+                    # Time spent reading in the pager is the user's, not ours
+                    self.metrics.stop_clock()
+                out.write("\n")
+                print_table(rows(), headers, out=out, min_widths=min_widths, truncate=(3, 4))
+                
+                # Show summary
+                out.write(f"\nSummary:\n")
+                out.write(f"Total Income: {self._money(totals.income)}\n")
+                out.write(f"Total Expenses: {self._money(totals.expense)}\n")
+                out.write(f"Balance: {self._money(totals.net)}\n")
+            
+        except ValueError as e:
+            print(f"Invalid filter: {e}")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("edit_transaction")
+    def edit_transaction(self):
+        """Edit an existing transaction."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Edit Transaction ===")
+        
+        # First, display recent transactions
+        try:
+            transaction = self._prompt_transaction("edit")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        if transaction is None:
+            return
+        transaction_id = transaction.id
+        
+        # Show current values
+        print(f"\nEditing transaction #{transaction_id}:")
+        print(f"Current type: {transaction.type}")
+        print(f"Current amount: {format_money(transaction.amount, currency=transaction.currency)}")
+        print(f"Current category: {transaction.category}")
+        print(f"Current description: {transaction.description or '-'}")
+        print(f"Current date: {transaction.date}")
+        
+        # Get new values
+        print("\nEnter new values (leave empty to keep current value):")
+        
+        # Type
+        while True:
+            new_type = input(f"New type (income/expense): ").strip().lower()
+            if not new_type:
+                new_type = transaction.type
+                break
+            elif new_type in ["income", "expense"]:
+                break
+            print("Invalid type. Please enter 'income' or 'expense'.")
+        
+        # Currency
+        new_currency = self._prompt_currency(transaction.currency)
+        
+        # Amount
+        while True:
+            new_amount_str = input(f"New amount ({new_currency}): ").strip()
+            if not new_amount_str:
+                new_amount = transaction.amount
+                break
+            try:
+                new_amount = parse_amount(new_amount_str)
+                if new_amount <= 0:
+                    print("Amount must be greater than zero.")
+                    continue
+                break
+            except ValueError:
+                print("Invalid amount. Please enter a number.")
+        
+        # Category
+        if new_type != transaction.type:
+            # If type changed, show categories for the new type
+            categories = self.get_categories(new_type)
+            print(f"\nAvailable {new_type} categories:")
+            for i, category in enumerate(categories, 1):
+                print(f"{i}. {category}")
+            print(f"{len(categories) + 1}. Other (create new)")
+            print(f"{len(categories) + 2}. Keep current ({transaction.category})")
+            
+            while True:
+                try:
+                    choice = int(input("\nSelect category number: "))
+                    if 1 <= choice <= len(categories):
+                        new_category = categories[choice - 1]
+                        break
+                    elif choice == len(categories) + 1:
+                        new_category = input("Enter new category name: ").strip().title()
+                        if not new_category:
+                            print("Category cannot be empty.")
+                            continue
+                        break
+                    elif choice == len(categories) + 2:
+                        new_category = transaction.category
+                        break
+                    else:
+                        print("Invalid choice.")
+                except ValueError:
+                    print("Please enter a number.")
+        else:
+            new_category_input = input(f"New category (current: {transaction.category}): ").strip()
+            new_category = new_category_input if new_category_input else transaction.category
+        
+        # Description
+        new_description = input(f"New description (current: {transaction.description or '-'}): ").strip()
+        if not new_description and transaction.description:
+            new_description = transaction.description
+        
+        # Date
+        while True:
+            new_date_input = input(f"New date (YYYY-MM-DD, current: {transaction.date}): ").strip()
+            if not new_date_input:
+                new_date = transaction.date
+                break
+            
+            try:
+                new_date = datetime.strptime(new_date_input, "%Y-%m-%d").strftime("%Y-%m-%d")
+                break
+            except ValueError:
+                print("Invalid date format. Please use YYYY-MM-DD.")
+        
+        # Update the transaction; the writer is only held for the update itself
+        conn = self._write_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """UPDATE transactions 
+                   SET type = ?, amount = ?, category = ?, description = ?, date = ?, currency = ? 
+                   WHERE id = ? AND user_id = ?""",
+                (new_type, new_amount, new_category, new_description, new_date, new_currency,
+                 transaction_id, self.current_user["id"])
+            )
+            if not cursor.rowcount:
+                print("The transaction was deleted in the meantime.")
+                return
+            # The update cleared any anomaly flag; judge the new values against the rest of the category
+            stats = self._category_stats(cursor, self.current_user["id"], new_type, new_category, new_currency)
+            anomaly = self._flag_anomaly(cursor, transaction_id, new_amount, stats_without(stats, new_amount))
+            if not self.conn:
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        print("\n✓ Transaction updated successfully!")
+        if anomaly:
+            z_score, mean, stddev = anomaly
+            print(f"\n⚠️ Unusual spending: this {new_category} expense is {abs(z_score):.1f} standard deviations "
+                  f"from your usual {format_money(mean, currency=new_currency)} "
+                  f"(± {format_money(stddev, currency=new_currency)}).")
+        
+        # Check budget if the transaction is an expense
+        if new_type == "expense":
+            self.check_budget_limit(new_category, new_amount, new_date)
+    
+    @timed("delete_transaction")
+    def delete_transaction(self):
+        """Delete an existing transaction."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Delete Transaction ===")
+        
+        # First, display recent transactions
+        try:
+            transaction = self._prompt_transaction("delete")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        if transaction is None:
+            return
+        transaction_id = transaction.id
+        
+        # Confirm deletion
+        confirm = input(f"Are you sure you want to delete transaction #{transaction_id}? (y/n): ").strip().lower()
+        if confirm != 'y':
+            print("Deletion cancelled.")
+            return
+        
+        # Delete the transaction; the writer is only held for the delete itself
+        conn = self._write_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT sha256 FROM attachments WHERE transaction_id = ?", (transaction_id,))
+            digests = [row[0] for row in cursor.fetchall()]
+            cursor.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?",
+                           (transaction_id, self.current_user["id"]))
+            if not cursor.rowcount:
+                print("The transaction was deleted in the meantime.")
+                return
+            if not self.conn:
+                conn.commit()
+            self._prune_attachment_files(cursor, digests)
+            print("\n✓ Transaction deleted successfully!")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._release(conn)
+    
+    def _prompt_transaction(self, verb):
+        """Show the user's recent transactions and prompt for one of them to
+        ``verb``; return it as a Transaction, or None if cancelled.
+
+        Each lookup is a short read, so no connection is held while the user
+        types, and none starts the clock of the running operation.
+        """
+        conn = self._read_connection(timed=False)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT id, type, amount, category, description, date, currency 
+                   FROM transactions 
+                   WHERE user_id = ? 
+                   ORDER BY date DESC LIMIT 10""",
+                (self.current_user["id"],)
+            )
+            table_data = [format_transaction_row(t) for t in map(Transaction._make, cursor)]
+        finally:
+            self._release(conn)
+        
+        if not table_data:
+            print("No transactions found.")
+            return None
+        
+        # Display transactions
+        headers = ["ID", "Type", "Amount", "Category", "Description", "Date"]
+        
+        print("\nRecent Transactions:")
+        print_table(table_data, headers)
+        
+        # Get transaction ID
+        while True:
+            try:
+                transaction_id = int(input(f"\nEnter ID of transaction to {verb} (0 to cancel): "))
+            except ValueError:
+                print("Please enter a valid ID.")
+                continue
+            if transaction_id == 0:
+                return None
+            
+            # Check if transaction exists and belongs to current user
+            conn = self._read_connection(timed=False)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """SELECT id, type, amount, category, description, date, currency 
+                       FROM transactions 
+                       WHERE id = ? AND user_id = ?""",
+                    (transaction_id, self.current_user["id"])
+                )
+                row = cursor.fetchone()
+            finally:
+                self._release(conn)
+            
+            if row:
+                return Transaction._make(row)
+            print(f"Transaction not found or you don't have permission to {verb} it.")
+    
+    def bulk_edit_transactions(self):
+        """Recategorize, retype or delete every transaction matching a filter."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Bulk Edit Transactions ===")
+        print("Describe the transactions to change (leave any field empty to ignore it).")
+        
+        criteria = self._prompt_filter()
+        
+        conn = self._read_connection()
+        try:
+            cursor = conn.cursor()
+            where, params = criteria.where(self._filter_tag_ids(cursor, criteria))
+            cursor.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = ? AND {where}",
+                [self.current_user["id"]] + params
+            )
+            count, total = cursor.fetchone()
+        except ValueError as e:
+            print(f"Invalid filter: {e}")
+            return
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if not count:
+            print(f"\nNo transactions match: {criteria.describe()}.")
+            return
+        
+        print(f"\n{count} transaction(s) match: {criteria.describe()} (amounts total {total:.2f}).")
+        print("1. Change category")
+        print("2. Change type")
+        print("3. Delete")
+        action = input("\nSelect an action (1-3, anything else to cancel): ").strip()
+        
+        if action == "1":
+            new_category = input("New category: ").strip().title()
+            if not new_category:
+                print("Category cannot be empty.")
+                return
+            changes = {"category": new_category}
+        elif action == "2":
+            new_type = input("New type (income/expense): ").strip().lower()
+            if new_type not in ["income", "expense"]:
+                print("Invalid type. Please enter 'income' or 'expense'.")
+                return
+            changes = {"type": new_type}
+        elif action == "3":
+            changes = None
+        else:
+            print("Bulk edit cancelled.")
+            return
+        
+        verb = "delete" if changes is None else "update"
+        confirm = input(f"Are you sure you want to {verb} {count} transaction(s)? (y/n): ").strip().lower()
+        if confirm != 'y':
+            print("Bulk edit cancelled.")
+            return
+        
+        try:
+            if changes is None:
+                affected = self.bulk_delete_transactions(criteria)
+            else:
+                affected = self.bulk_update_transactions(criteria, changes)
+            print(f"\n✓ {affected} transaction(s) {verb}d.")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+    
+    @timed("bulk_update")
+    def bulk_update_transactions(self, criteria, changes):
+        """Apply ``changes`` (column -> value) to all matching transactions.
+
+        Runs as one UPDATE in one transaction and returns the number of rows
+        changed. Derived tables are kept in step by their triggers, except
+        the daily balances, which are rebuilt once (see ``_bulk_execute``).
+        """
+        allowed = {"type", "category", "description", "date", "currency"}
+        unknown = set(changes) - allowed
+        if unknown or not changes:
+            raise ValueError(f"Cannot bulk update: {', '.join(sorted(unknown)) or 'no changes given'}")
+        
+        assignments = ", ".join(f"{column} = ?" for column in changes)
+        return self._bulk_execute(
+            f"UPDATE transactions SET {assignments} WHERE user_id = ? AND {{where}}",
+            list(changes.values()) + [self.current_user["id"]],
+            criteria
+        )
+    
+    @timed("bulk_delete")
+    def bulk_delete_transactions(self, criteria):
+        """Delete all matching transactions in one statement; returns the count."""
+        count = self._bulk_execute(
+            "DELETE FROM transactions WHERE user_id = ? AND {where}",
+            [self.current_user["id"]],
+            criteria
+        )
+        conn = self._write_connection()
+        try:
+            self._prune_attachment_files(conn.cursor())
+        finally:
+            self._release(conn)
+        return count
+    
+    def _bulk_execute(self, sql, params, criteria):
+        """Run a single bulk statement in its own transaction.
+
+        ``sql`` has a ``{where}`` placeholder for the condition of the
+        TransactionFilter ``criteria``, whose parameters follow ``params``.
+        """
+        conn = self._write_connection()
+        try:
+            cursor = conn.cursor()
+            where, where_params = criteria.where(self._filter_tag_ids(cursor, criteria))
+            # Running daily totals are rebuilt once rather than shifted per row
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilding_balances', '1')")
+            cursor.execute(sql.format(where=where), list(params) + where_params)
+            count = cursor.rowcount
+            cursor.execute("DELETE FROM meta WHERE key = 'rebuilding_balances'")
+            if count:
+                self._rebuild_daily_balances(cursor, self.current_user["id"])
+            if not self.conn:
+                conn.commit()
+            return count
+        finally:
+            self._release(conn)
+    
+    def _prompt_filter(self, listing=False):
+        """Prompt for the criteria of a TransactionFilter (with ``listing``,
+        also for its order and number of rows)."""
+        def prompt_date(label):
+            while True:
+                value = input(f"{label} (YYYY-MM-DD): ").strip()
+                if not value:
+                    return None
+                try:
+                    return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+                except ValueError:
+                    print("Invalid date format. Please use YYYY-MM-DD.")
+        
+        def prompt_amount(label):
+            while True:
+                value = input(f"{label}: ").strip()
+                if not value:
+                    return None
+                try:
+                    return parse_amount(value)
+                except ValueError:
+                    print("Invalid amount. Please enter a number.")
+        
+        start_date = prompt_date("Start date")
+        end_date = prompt_date("End date")
+        categories = [part.strip().title() for part in input("Categories (comma-separated): ").split(",")
+                      if part.strip()]
+        
+        while True:
+            transaction_type = input("Transaction type (income/expense): ").strip().lower() or None
+            if transaction_type in [None, "income", "expense"]:
+                break
+            print("Invalid type. Please enter 'income' or 'expense'.")
+        
+        min_amount = prompt_amount("Minimum amount")
+        max_amount = prompt_amount("Maximum amount")
+        description = input("Description contains: ").strip() or None
+        tags = input("Tags (e.g. business and not reimbursable): ").strip() or None
+        
+        sort, descending, limit = "date", True, None
+        if listing:
+            while True:
+                sort = input(f"Sort by ({'/'.join(FILTER_SORTS)}, leave empty for date): ").strip().lower() or "date"
+                if sort in FILTER_SORTS:
+                    break
+                print(f"Invalid choice. Please enter one of: {', '.join(FILTER_SORTS)}.")
+            descending = input("Largest/newest first? (y/n, leave empty for yes): ").strip().lower() != "n"
+            while True:
+                value = input("Show at most how many? (leave empty for all): ").strip()
+                if not value:
+                    break
+                if value.isdigit() and int(value) > 0:
+                    limit = int(value)
+                    break
+                print("Please enter a positive number.")
+        
+        return TransactionFilter(start_date, end_date, categories, transaction_type,
+                                 min_amount, max_amount, description, tags, sort, descending, limit)
+    
+    def _filter_tag_ids(self, cursor, criteria):
+        """Return the IDs matching ``criteria``'s tag query, as its ``where``
+        and ``select`` take them, or None without a tag query."""
+        return self._tagged_ids(cursor, criteria.tags) if criteria.tags else None
+    
+    def _compile_filter(self, cursor, criteria, columns):
+        """Return ``(sql, params)`` selecting ``columns`` of the current
+        user's transactions matching ``criteria``.
+
+        Date ranges reaching back before the user's archive cutoff read the
+        ``all_transactions`` view; other listings only the hot table.
+        """
+        source = "transactions"
+        if criteria.start_date or criteria.end_date:
+            source = self._history_source(cursor, epoch_day(criteria.start_date) if criteria.start_date else 0)
+        return criteria.select(columns, self.current_user["id"], source, self._filter_tag_ids(cursor, criteria))
+    
+    def archive_old_transactions(self):
+        """Move transactions older than a cutoff into the archive database."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+        
+        print("\n=== Archive Old Transactions ===")
+        print("Archived transactions no longer appear in listings, but reports still include them.")
+        
+        while True:
+            try:
+                months_input = input(
+                    f"Archive transactions older than how many months? (leave empty for {ARCHIVE_AFTER_MONTHS}): "
+                ).strip()
+                months = int(months_input) if months_input else ARCHIVE_AFTER_MONTHS
+                if months < 1:
+                    print("Please enter at least 1 month.")
+                    continue
+                break
+            except ValueError:
+                print("Please enter a valid number.")
+        
+        # Cut off on a month boundary so every month is either hot or archived
+        today = datetime.now()
+        index = today.year * 12 + today.month - 1 - months
+        cutoff = datetime(index // 12, index % 12 + 1, 1)
+        
+        confirm = input(f"Archive all transactions before {cutoff:%Y-%m-%d}? (y/n): ").strip().lower()
+        if confirm != 'y':
+            print("Archiving cancelled.")
+            return
+        
+        try:
+            count = self.archive_transactions(epoch_day(cutoff))
+            print(f"\n✓ Archived {count} transaction(s) to {self.archive_file}.")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+    
+    @timed("archive_transactions")
+    def archive_transactions(self, cutoff_day):
+        """Move the current user's transactions before ``cutoff_day`` to the archive.
+
+        The move is recorded in the hot database's 'archive_pending' meta
+        entry and then carried out by ``_finish_archiving``. Returns the
+        number of transactions moved.
+        """
+        user_id = self.current_user["id"]
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            attach_archive(conn, self.archive_file, create=True)
+            cursor.execute("PRAGMA archive.journal_mode=WAL")
+            self._create_archive_schema(cursor)
+            # An earlier move interrupted by a crash goes first
+            self._finish_archiving(cursor)
+            
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('archive_pending', ?)",
+                           (f"{user_id}:{cutoff_day}",))
+            if not self.conn:
+                conn.commit()
+            return self._finish_archiving(cursor)
+        finally:
+            self._release(conn)
+    
+    def _finish_archiving(self, cursor):
+        """Carry out the move recorded in 'archive_pending', if any; return
+        the number of transactions moved.
+
+        Both databases are in WAL mode, where SQLite only makes a commit
+        atomic within each file, so the move takes two commits. The first
+        copies the rows into the archive. The second, in the hot database
+        alone, adds them to the monthly summaries and deletes them, but only
+        rows whose archive copy exists, with the 'archiving' flag keeping the
+        delete triggers from treating the move as a deletion; it also clears
+        'archive_pending'. After a crash in between, the next start (or
+        archive) finishes the move; copying again is harmless.
+        """
+        cursor.execute("SELECT value FROM meta WHERE key = 'archive_pending'")
+        row = cursor.fetchone()
+        if not row:
+            return 0
+        user_id, cutoff_day = map(int, row[0].split(":"))
+        conn = cursor.connection
+        
+        cursor.execute("PRAGMA main.table_info(transactions)")
+        columns = ", ".join(row[1] for row in cursor.fetchall())
+        selected = "FROM main.transactions WHERE user_id = ? AND day_num < ?"
+        # Rows an interrupted run already copied are skipped, and an archived
+        # row is never overwritten: a row whose ID is taken by another one
+        # (possible in databases from before IDs were reserved) stays hot
+        cursor.execute(
+            f"""INSERT OR IGNORE INTO archive.transactions ({columns}) SELECT {columns} {selected} 
+                AND NOT EXISTS (SELECT 1 FROM archive.transactions a WHERE a.uid = main.transactions.uid)""",
+            (user_id, cutoff_day)
+        )
+        self._reserve_archived_ids(cursor)
+        if not self.conn:
+            conn.commit()
+        
+        moved = selected + """ AND EXISTS (SELECT 1 FROM archive.transactions a 
+                                WHERE a.id = main.transactions.id AND a.uid IS main.transactions.uid)"""
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('archiving', '1')")
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilding_balances', '1')")
+        cursor.execute(
+            f"""INSERT INTO monthly_summaries (user_id, day_num, category, type, currency, total, count) 
+                SELECT user_id, {DAY_NUM_SQL.format("date(date, 'start of month')")} AS month_day, 
+                       category, type, currency, SUM(amount), COUNT(*) 
+                {moved} 
+                GROUP BY month_day, category, type, currency 
+                ON CONFLICT (user_id, day_num, category, type, currency) 
+                DO UPDATE SET total = total + excluded.total, count = count + excluded.count""",
+            (user_id, cutoff_day)
+        )
+        cursor.execute(f"DELETE FROM anomalies WHERE transaction_id IN (SELECT id {moved})",
+                       (user_id, cutoff_day))
+        cursor.execute(f"DELETE {moved}", (user_id, cutoff_day))
+        count = cursor.rowcount
+        cursor.execute("DELETE FROM meta WHERE key IN ('archiving', 'rebuilding_balances', 'archive_pending')")
+        self._rebuild_daily_balances(cursor, user_id)
+        cursor.execute(
+            "UPDATE users SET archived_before = MAX(COALESCE(archived_before, 0), ?) WHERE id = ?",
+            (cutoff_day, user_id)
+        )
+        if not self.conn:
+            conn.commit()
+        return count
+    
+    def _history_source(self, cursor, first_day):
+        """Return the source covering transactions from ``first_day`` onwards.
+
+        That is the hot table, unless the period reaches back before the
+        user's archive cutoff, in which case the ``all_transactions`` view.
+        """
+        cursor.execute("SELECT archived_before FROM users WHERE id = ?", (self.current_user["id"],))
+        row = cursor.fetchone()
+        if row and row[0] is not None and first_day < row[0]:
+            return "all_transactions"
+        return "transactions"
+    
+    @timed("set_budget")
+    def set_budget(self):
+        """Set or update budget for a category."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Set Budget ===")
+        
+        # Get month and year
+        current_month = datetime.now().month
+        current_year = datetime.now().year
+        
+        while True:
+            try:
+                month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
+                month = int(month_input) if month_input else current_month
+                
+                if not 1 <= month <= 12:
+                    print("Month must be between 1 and 12.")
+                    continue
+                
+                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
+                year = int(year_input) if year_input else current_year
+                
+                if year < 2000 or year > 2100:
+                    print("Please enter a valid year between 2000 and 2100.")
+                    continue
+                
+                break
+            except ValueError:
+                print("Please enter a valid number.")
+        
+        # Show expense categories
+        categories = self.get_categories("expense")
+        print("\nExpense Categories:")
+        for i, category in enumerate(categories, 1):
+            print(f"{i}. {category}")
+        print(f"{len(categories) + 1}. Other (create new)")
+        
+        # Get category
+        while True:
+            try:
+                choice = int(input("\nSelect category number: "))
+                if 1 <= choice <= len(categories):
+                    category = categories[choice - 1]
+                    break
+                elif choice == len(categories) + 1:
+                    category = input("Enter new category name: ").strip().title()
+                    if not category:
+                        print("Category cannot be empty.")
+                        continue
+                    break
+                else:
+                    print("Invalid choice.")
+            except ValueError:
+                print("Please enter a number.")
+        
+        # Get budget amount
+        while True:
+            try:
+                amount = parse_amount(input(f"Budget amount for {category} ({month}/{year}, {self._base_currency()}): ").strip())
+                if amount <= 0:
+                    print("Budget amount must be greater than zero.")
+                    continue
+                break
+            except ValueError:
+                print("Invalid amount. Please enter a number.")
+        
+        # Set or update budget in database
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                """INSERT OR REPLACE INTO budgets 
+                   (user_id, category, amount, month, year, currency) 
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (self.current_user["id"], category, amount, month, year, self._base_currency())
+            )
+            if not self.conn:
+                conn.commit()
+            print(f"\n✓ Budget for {category} ({month}/{year}) set to {self._money(amount)}")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("check_budget_limit")
+    def check_budget_limit(self, category, amount, date_str):
+        """Check if a transaction exceeds the budget limit."""
+        if not self.current_user:
+            return
+            
+        # Parse transaction date
+        date = datetime.strptime(date_str, "%Y-%m-%d")
+        month = date.month
+        year = date.year
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Get budgets for the category and its parent categories for the month/year
+            cursor.execute(
+                """SELECT b.category, b.amount, b.currency FROM budgets b 
+                   JOIN category_closure c ON c.user_id = b.user_id AND c.ancestor = b.category 
+                   WHERE b.user_id = ? AND c.descendant = ? AND b.month = ? AND b.year = ? 
+                   ORDER BY c.depth""",
+                (self.current_user["id"], category, month, year)
+            )
+            budgets = cursor.fetchall()
+            
+            # Group budgets (also for parent categories) are checked against every member's spending
+            cursor.execute(
+                """SELECT g.id, g.name, b.category FROM user_groups g 
+                   JOIN group_members m ON m.group_id = g.id AND m.status = 'active' 
+                   JOIN group_budgets b ON b.group_id = g.id 
+                   JOIN category_closure c ON c.user_id = m.user_id AND c.ancestor = b.category 
+                   WHERE m.user_id = ? AND c.descendant = ? AND b.month = ? AND b.year = ? 
+                   ORDER BY g.id, c.depth""",
+                (self.current_user["id"], category, month, year)
+            )
+            groups = {}
+            for group_id, name, budget_category in cursor.fetchall():
+                groups.setdefault((group_id, name), []).append(budget_category)
+            
+            if not budgets and not groups:
+                return  # No budget set for this category
+            
+            rates = self._rates(conn.cursor())
+            
+            if budgets:
+                # Calculate total spent in each budgeted subtree for the month
+                spending = self._converted_sums(
+                    cursor,
+                    f"type = 'expense' AND category IN ({', '.join('?' * len(budgets))}) AND day_num >= ? AND day_num < ?",
+                    [b[0] for b in budgets] + list(month_days(year, month)),
+                    group_by=["category"],
+                    rates=rates,
+                    source=subtree_rows(MONTHLY_ROWS)
+                )
+                
+                for budget_category, amount, currency in budgets:
+                    budget_amount = rates.convert(amount, currency, f"{year}-{month:02d}-01")
+                    self._warn_budget(f"your budget for {budget_category}", budget_amount,
+                                      spending.get((budget_category, "expense"), 0), month, year)
+            
+            for (group_id, name), categories in groups.items():
+                for status in self._group_budget_statuses(cursor, group_id, month, year, rates, categories):
+                    self._warn_budget(f"{name}'s group budget for {status.category}", status.budget,
+                                      status.spent, month, year)
+        except sqlite3.Error as e:
+            print(f"Database error when checking budget: {e}")
+        except LookupError as e:
+            print(f"Currency error when checking budget: {e}")
+        finally:
+            self._release(conn)
+    
+    def _warn_budget(self, label, budget_amount, total_spent, month, year):
+        """Print a warning if spending has exceeded or nearly reached a budget."""
+        # Check if budget is exceeded
+        if total_spent > budget_amount:
+            print(f"\n⚠️ Warning: You have exceeded {label} in {month}/{year}!")
+            print(f"Budget: {self._money(budget_amount)}")
+            print(f"Spent: {self._money(total_spent)}")
+            print(f"Over budget by: {self._money(total_spent - budget_amount)}")
+        elif total_spent >= budget_amount * 0.8:
+            remaining = budget_amount - total_spent
+            print(f"\n⚠️ Warning: You are approaching {label} in {month}/{year}!")
+            print(f"Budget: {self._money(budget_amount)}")
+            print(f"Spent: {self._money(total_spent)}")
+            print(f"Remaining: {self._money(remaining)} ({(remaining/budget_amount)*100:.1f}% left)")
+    
+    @timed("view_budgets")
+    def view_budgets(self, month=None, year=None):
+        """View all budgets for the current user."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== View Budgets ===")
+        
+        # Get month and year filter
+        if month is None or year is None:
+            month, year = self._prompt_month_year()
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            statuses = self._budget_statuses(cursor, month, year)
+            
+            if not statuses:
+                print(f"No budgets found for {month}/{year}.")
+                return
+            
+            # Sort by amount spent (descending)
+            statuses.sort(key=lambda s: s.spent, reverse=True)
+            
+            # Display budget information
+            headers = ["Category", "Budget", "Spent", "Remaining", "Progress"]
+            table_data = []
+            
+            for status in statuses:
+                table_data.append([
+                    status.category,
+                    self._money(status.budget),
+                    self._money(status.spent),
+                    self._money(status.remaining),
+                    budget_progress(status.percentage)
+                ])
+            
+            # Display budgets
+            print(f"\nBudgets for {month}/{year}:")
+            print_table(table_data, headers)
+            
+            # Show summary
+            # Nested budgets are already part of their parent's totals
+            outer = [s for s in statuses if not s.nested]
+            total = BudgetStatus("all", sum(s.budget for s in outer), sum(s.spent for s in outer))
+            
+            print(f"\nSummary:")
+            print(f"Total Budget: {self._money(total.budget)}")
+            print(f"Total Spent: {self._money(total.spent)}")
+            print(f"Total Remaining: {self._money(total.remaining)}")
+            if total.percentage is not None:
+                print(f"Overall Progress: {format_percent(total.percentage)}")
+            
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    def _budget_statuses(self, cursor, month, year, rates=None):
+        """Return a BudgetStatus for every budget of the given month."""
+        rates = rates or self._rates(cursor.connection.cursor())
+        cursor.execute(
+            """SELECT category, amount, currency FROM budgets 
+               WHERE user_id = ? AND month = ? AND year = ?""",
+            (self.current_user["id"], month, year)
+        )
+        budgets = cursor.fetchall()
+        if not budgets:
+            return []
+        
+        # A budget covers its category's whole subtree
+        categories = [b[0] for b in budgets]
+        marks = ", ".join("?" * len(categories))
+        spending = self._converted_sums(
+            cursor,
+            f"type = 'expense' AND category IN ({marks}) AND day_num >= ? AND day_num < ?",
+            categories + list(month_days(year, month)),
+            group_by=["category"],
+            rates=rates,
+            source=subtree_rows(MONTHLY_ROWS)
+        )
+        cursor.execute(
+            f"""SELECT DISTINCT descendant FROM category_closure 
+                WHERE user_id = ? AND depth > 0 AND ancestor IN ({marks}) AND descendant IN ({marks})""",
+            [self.current_user["id"]] + categories + categories
+        )
+        nested = {row[0] for row in cursor.fetchall()}
+        
+        first_day = f"{year}-{month:02d}-01"
+        return [
+            BudgetStatus(category, rates.convert(amount, currency, first_day), spending.get((category, "expense"), 0),
+                         nested=category in nested)
+            for category, amount, currency in budgets
+        ]
+    
+    def manage_groups(self):
+        """Create household groups, manage their members and budgets, and view group reports."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+        
+        print("\n=== Household Groups ===")
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            groups = self._groups(cursor)
+            invitations = self._group_invitations(cursor)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if groups:
+            print_table([list(group) for group in groups], ["ID", "Group", "Your Role", "Members"])
+        else:
+            print("You are not in any group yet.")
+        if invitations:
+            print("\nInvitations:")
+            print_table([list(invitation) for invitation in invitations], ["ID", "Group", "Role"])
+        
+        print("\n1. Create a group")
+        print("2. Invite a member")
+        print("3. Remove a member (or leave a group)")
+        print("4. Set a group budget")
+        print("5. Group report")
+        print("6. Accept or decline an invitation")
+        choice = input("\nSelect an option (1-6): ").strip()
+        
+        if choice == "1":
+            name = input("Group name: ").strip()
+            if not name:
+                print("Group name cannot be empty.")
+                return
+            self.create_group(name)
+            return
+        if choice not in ["2", "3", "4", "5", "6"]:
+            print("Invalid choice.")
+            return
+        try:
+            group_id = int(input("Group ID: ").strip())
+        except ValueError:
+            print("Please enter a number.")
+            return
+        
+        if choice == "2":
+            username = input("Username to invite: ").strip()
+            role = input("Role (member/owner, leave empty for member): ").strip().lower() or "member"
+            self.add_group_member(group_id, username, role)
+        elif choice == "3":
+            username = input("Username to remove (leave empty to leave the group yourself): ").strip()
+            self.remove_group_member(group_id, username or None)
+        elif choice == "4":
+            month, year = self._prompt_month_year()
+            category = input("Category: ").strip().title()
+            try:
+                amount = parse_amount(input(f"Budget amount for {category} ({month}/{year}, {self._base_currency()}): "))
+            except ValueError:
+                print("Invalid amount. Please enter a number.")
+                return
+            self.set_group_budget(group_id, category, amount, month, year)
+        elif choice == "5":
+            self._generate_group_report(group_id)
+        elif input("Accept the invitation? (y/n): ").strip().lower() == "y":
+            self.accept_group_invitation(group_id)
+        else:
+            self.decline_group_invitation(group_id)
+    
+    def _groups(self, cursor):
+        """Return ``(id, name, role, member count)`` for the current user's groups."""
+        cursor.execute(
+            """SELECT g.id, g.name, m.role, 
+                      (SELECT COUNT(*) FROM group_members WHERE group_id = g.id AND status = 'active') 
+               FROM user_groups g JOIN group_members m ON m.group_id = g.id 
+               WHERE m.user_id = ? AND m.status = 'active' ORDER BY g.name""",
+            (self.current_user["id"],)
+        )
+        return cursor.fetchall()
+    
+    def _group_invitations(self, cursor):
+        """Return ``(id, name, role)`` for the groups the current user is invited to."""
+        cursor.execute(
+            """SELECT g.id, g.name, m.role FROM user_groups g JOIN group_members m ON m.group_id = g.id 
+               WHERE m.user_id = ? AND m.status = 'pending' ORDER BY g.name""",
+            (self.current_user["id"],)
+        )
+        return cursor.fetchall()
+    
+    def _group_role(self, cursor, group_id):
+        """Return the current user's role in a group, or None if not a member."""
+        cursor.execute("SELECT role FROM group_members WHERE group_id = ? AND user_id = ? AND status = 'active'",
+                       (group_id, self.current_user["id"]))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def _group_member_ids(self, cursor, group_id):
+        """Return the user IDs of a group's members (not those only invited)."""
+        cursor.execute("SELECT user_id FROM group_members WHERE group_id = ? AND status = 'active'", (group_id,))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def create_group(self, name):
+        """Create a group owned by the current user; return its ID."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO user_groups (name) VALUES (?)", (name,))
+            group_id = cursor.lastrowid
+            cursor.execute("INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, 'owner')",
+                           (group_id, self.current_user["id"]))
+            if not self.conn:
+                conn.commit()
+            print(f"\n✓ Group '{name}' created. Add members to see their spending together.")
+            return group_id
+        except sqlite3.IntegrityError:
+            print(f"A group named '{name}' already exists.")
+            return None
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+    
+    def add_group_member(self, group_id, username, role="member"):
+        """Invite a user to a group (or change a member's role); only owners
+        can. The user joins once they accept. Returns whether it was done."""
+        if role not in ("owner", "member"):
+            print("Role must be 'owner' or 'member'.")
+            return False
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            if self._group_role(cursor, group_id) != "owner":
+                print("Only a group's owners can add members.")
+                return False
+            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+            user = cursor.fetchone()
+            if not user:
+                print(f"No user named '{username}'.")
+                return False
+            cursor.execute(
+                """INSERT INTO group_members (group_id, user_id, role, status) VALUES (?, ?, ?, 'pending') 
+                   ON CONFLICT (group_id, user_id) DO UPDATE SET role = excluded.role""",
+                (group_id, user[0], role)
+            )
+            cursor.execute("SELECT status FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user[0]))
+            status = cursor.fetchone()[0]
+            if not self.conn:
+                conn.commit()
+            if status == "pending":
+                print(f"\n✓ Invited {username} as a{'n owner' if role == 'owner' else ' member'}; "
+                      f"they join the group once they accept.")
+            else:
+                print(f"\n✓ {username} is now a{'n owner' if role == 'owner' else ' member'} of the group.")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def accept_group_invitation(self, group_id):
+        """Join a group the current user is invited to; returns whether they joined."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """UPDATE group_members SET status = 'active' 
+                   WHERE group_id = ? AND user_id = ? AND status = 'pending'""",
+                (group_id, self.current_user["id"])
+            )
+            if not cursor.rowcount:
+                print("You have no invitation to that group.")
+                return False
+            if not self.conn:
+                conn.commit()
+            print("\n✓ You joined the group.")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def decline_group_invitation(self, group_id):
+        """Decline an invitation to a group; returns whether there was one."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "DELETE FROM group_members WHERE group_id = ? AND user_id = ? AND status = 'pending'",
+                (group_id, self.current_user["id"])
+            )
+            if not cursor.rowcount:
+                print("You have no invitation to that group.")
+                return False
+            if not self.conn:
+                conn.commit()
+            print("\n✓ Invitation declined.")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def remove_group_member(self, group_id, username=None):
+        """Remove a member from a group, or with no ``username`` leave it.
+
+        Only owners can remove others (or withdraw their invitations), and
+        the last owner can only leave once nobody else is left; a group
+        without members is deleted along with its budgets and invitations.
+        Returns whether a member was removed.
+        """
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            role = self._group_role(cursor, group_id)
+            if role is None:
+                print("You are not a member of that group.")
+                return False
+            if username is None:
+                user_id, target_role, status = self.current_user["id"], role, "active"
+            else:
+                cursor.execute(
+                    """SELECT u.id, m.role, m.status FROM users u 
+                       JOIN group_members m ON m.user_id = u.id AND m.group_id = ? 
+                       WHERE u.username = ?""",
+                    (group_id, username)
+                )
+                row = cursor.fetchone()
+                if not row:
+                    print(f"{username} is not a member of that group.")
+                    return False
+                user_id, target_role, status = row
+                if user_id != self.current_user["id"] and role != "owner":
+                    print("Only a group's owners can remove other members.")
+                    return False
+            
+            cursor.execute(
+                "SELECT COUNT(*), SUM(role = 'owner') FROM group_members WHERE group_id = ? AND status = 'active'",
+                (group_id,)
+            )
+            members, owners = cursor.fetchone()
+            active = status == "active"
+            if active and target_role == "owner" and owners == 1 and members > 1:
+                print("Make another member an owner first; a group needs an owner while it has members.")
+                return False
+            
+            cursor.execute("DELETE FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+            if active and members == 1:
+                cursor.execute("DELETE FROM group_members WHERE group_id = ?", (group_id,))
+                cursor.execute("DELETE FROM group_budgets WHERE group_id = ?", (group_id,))
+                cursor.execute("DELETE FROM user_groups WHERE id = ?", (group_id,))
+            if not self.conn:
+                conn.commit()
+            print("\n✓ Member removed." if username else "\n✓ You left the group.")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def set_group_budget(self, group_id, category, amount, month, year):
+        """Set a group's budget for a category and month; only owners can. Returns whether it was set."""
+        if amount <= 0:
+            print("Budget amount must be greater than zero.")
+            return False
+        conn = self._write_connection()
         cursor = conn.cursor()
+        try:
+            if self._group_role(cursor, group_id) != "owner":
+                print("Only a group's owners can set its budgets.")
+                return False
+            cursor.execute(
+                """INSERT OR REPLACE INTO group_budgets (group_id, category, amount, month, year, currency) 
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (group_id, category, amount, month, year, self._base_currency())
+            )
+            if not self.conn:
+                conn.commit()
+            print(f"\n✓ Group budget for {category} ({month}/{year}) set to {self._money(amount)}")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
+    
+    def _group_budget_statuses(self, cursor, group_id, month, year, rates=None, categories=None):
+        """Return a BudgetStatus for every budget of a group in the given month
+        (or only those for ``categories``), spent being all members' spending.
+
+        As with personal budgets, a budget covers its category's subtree
+        (in each member's own category tree). The spending of every budget
+        comes from one query over all members' rows, not from a report per
+        member.
+        """
+        rates = rates or self._rates(cursor.connection.cursor())
+        where, params = "group_id = ? AND month = ? AND year = ?", [group_id, month, year]
+        if categories:
+            where += f" AND category IN ({', '.join('?' * len(categories))})"
+            params += list(categories)
+        cursor.execute(f"SELECT category, amount, currency FROM group_budgets WHERE {where}", params)
+        budgets = cursor.fetchall()
+        if not budgets:
+            return []
         
-        # Create users table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        spending = self._converted_sums(
+            cursor,
+            f"type = 'expense' AND category IN ({', '.join('?' * len(budgets))}) AND day_num >= ? AND day_num < ?",
+            [b[0] for b in budgets] + list(month_days(year, month)),
+            group_by=["category"],
+            rates=rates,
+            source=subtree_rows(MONTHLY_ROWS),
+            user_ids=self._group_member_ids(cursor, group_id)
         )
-        ''')
+        first_day = f"{year}-{month:02d}-01"
+        return [
+            BudgetStatus(category, rates.convert(amount, currency, first_day), spending.get((category, "expense"), 0))
+            for category, amount, currency in budgets
+        ]
+    
+    @timed("report_group")
+    def _generate_group_report(self, group_id, month=None, year=None):
+        """Show a group's combined income and spending for a month, per member
+        and per category, with its budgets."""
+        print("\n=== Group Report ===")
+        if month is None or year is None:
+            month, year = self._prompt_month_year()
         
-        # Create transactions table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            type TEXT NOT NULL,
-            amount REAL NOT NULL,
-            category TEXT NOT NULL,
-            description TEXT,
-            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            if self._group_role(cursor, group_id) is None:
+                print("You are not a member of that group.")
+                return
+            cursor.execute("SELECT name FROM user_groups WHERE id = ?", (group_id,))
+            name = cursor.fetchone()[0]
+            cursor.execute(
+                """SELECT u.id, u.username FROM group_members m JOIN users u ON u.id = m.user_id 
+                   WHERE m.group_id = ? AND m.status = 'active' ORDER BY u.username""",
+                (group_id,)
+            )
+            members = {user_id: PeriodTotals(username) for user_id, username in cursor.fetchall()}
+            
+            rates = self._rates(conn.cursor())
+            sums = self._converted_sums(
+                cursor,
+                "day_num >= ? AND day_num < ?",
+                list(month_days(year, month)),
+                group_by=["user_id", "category"],
+                rates=rates,
+                source=MONTHLY_ROWS,
+                user_ids=list(members)
+            )
+            statuses = self._group_budget_statuses(cursor, group_id, month, year, rates)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        except LookupError as e:
+            print(f"Currency error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        total = PeriodTotals("Total")
+        expenses = {}
+        for (member_id, category, transaction_type), amount in sums.items():
+            members[member_id].add(transaction_type, amount)
+            total.add(transaction_type, amount)
+            if transaction_type == "expense":
+                expenses[category] = expenses.get(category, 0) + amount
+        
+        print(f"\n{name}, {month}/{year} ({len(members)} member(s), amounts in {self._base_currency()}):")
+        print_table(
+            [[m.label, self._money(m.income), self._money(m.expense), self._money(m.net, signed=True)]
+             for m in list(members.values()) + [total]],
+            ["Member", "Income", "Expenses", "Net"]
         )
-        ''')
+        if expenses:
+            print("\nCombined spending by category:")
+            print_table(category_share_rows(expenses, total.expense, currency=self._base_currency()),
+                        ["Category", "Spent", "Share"])
+        if statuses:
+            print("\nGroup budgets:")
+            print_table(
+                [[s.category, self._money(s.budget), self._money(s.spent), self._money(s.remaining),
+                  budget_progress(s.percentage)] for s in sorted(statuses, key=lambda s: s.spent, reverse=True)],
+                ["Category", "Budget", "Spent", "Remaining", "Progress"]
+            )
+    
+    def _data_revision(self, cursor):
+        """Return the current user's data revision, bumped on every relevant write."""
+        cursor.execute("SELECT revision FROM data_revisions WHERE user_id = ?", (self.current_user["id"],))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    
+    def _month_end_forecasts(self, cursor, month, year):
+        """Return a SpendForecast for every budget of the given month.
+
+        Daily expense history (up to FORECAST_HISTORY_DAYS before today) is
+        resampled for the days left in the month. Results are cached per
+        user and month until the user's data revision or the day changes.
+        """
+        today = datetime.now().date()
+        key = (self.current_user["id"], month, year)
+        revision = (self._data_revision(cursor), today, self._base_currency())
+        cached = self._forecast_cache.get(key)
+        if cached and cached[0] == revision:
+            return cached[1]
         
-        # Create budget table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS budgets (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            category TEXT NOT NULL,
-            amount REAL NOT NULL,
-            month INTEGER NOT NULL,
-            year INTEGER NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, category, month, year)
+        rates = self._rates(cursor.connection.cursor())
+        statuses = self._budget_statuses(cursor, month, year, rates)
+        
+        first_day = datetime(year, month, 1).date()
+        last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        remaining_days = (last_day - max(today, first_day - timedelta(days=1))).days
+        
+        history = []
+        if statuses and remaining_days > 0:
+            # History starts at the first expense in the window, so a short
+            # record is not diluted by days before the user started tracking
+            end = epoch_day(today)
+            source = self._history_source(cursor, end - FORECAST_HISTORY_DAYS)
+            cursor.execute(
+                f"""SELECT MIN(day_num) FROM {source} 
+                    WHERE user_id = ? AND type = 'expense' AND day_num >= ? AND day_num < ?""",
+                (self.current_user["id"], end - FORECAST_HISTORY_DAYS, end)
+            )
+            start = cursor.fetchone()[0]
+            if start is not None:
+                row_of = {status.category: i for i, status in enumerate(statuses)}
+                history = [[0.0] * (end - start) for _ in statuses]
+                daily = self._converted_sums(
+                    cursor,
+                    f"type = 'expense' AND day_num >= ? AND day_num < ? AND category IN ({', '.join('?' * len(row_of))})",
+                    [start, end] + list(row_of),
+                    group_by=["category", "day_num"],
+                    rates=rates,
+                    source=subtree_rows(source)
+                )
+                for (category, day, kind), total in daily.items():
+                    history[row_of[category]][day - start] += total
+        
+        forecasts = forecast_spending(history, statuses, remaining_days if history else 0)
+        self._forecast_cache[key] = (revision, forecasts)
+        return forecasts
+    
+    def _converted_sums(self, cursor, where, params, group_by=(), rates=None, source="transactions",
+                        user_ids=None):
+        """Sum matching transactions per group and type in the base currency.
+
+        Returns ``{(group values..., type): total}``. SQL sums each group per
+        currency (and per day for foreign currencies), so conversion is
+        applied once per pre-summed group rather than once per row.
+        ``source`` is the table, view or subquery read, e.g. MONTHLY_ROWS.
+        Rows are the current user's, or those of all ``user_ids`` (a
+        group's members); the IDs are inlined as an ``IN`` list so SQLite
+        still pushes the filter into each branch of a UNION source and reads
+        every member's rows through the user indexes.
+        """
+        rates = rates or self._rates(cursor.connection.cursor())
+        columns = list(group_by) + [
+            "type", "currency", "CASE WHEN currency = ? THEN NULL ELSE day_num END"
+        ]
+        positions = ", ".join(str(i) for i in range(1, len(columns) + 1))
+        user_ids = [self.current_user["id"]] if user_ids is None else list(user_ids)
+        cursor.execute(
+            f"""SELECT {", ".join(columns)}, SUM(amount)
+                FROM {source}
+                WHERE user_id IN ({", ".join("?" * len(user_ids))}) AND {where}
+                GROUP BY {positions}""",
+            [rates.base] + user_ids + list(params)
         )
-        ''')
         
-        # Commit changes if we created the connection
-        if not self.conn:
-            conn.commit()
-            conn.close()
+        totals = {}
+        for *key, currency, day, total in cursor.fetchall():
+            key = tuple(key)
+            totals[key] = totals.get(key, 0) + rates.convert(total, currency, day)
+        return totals
+    
+    def _snapshot_sums(self, cursor, first_day, end_day, group_by=(), rates=None):
+        """Like ``_converted_sums`` over days ``first_day`` up to ``end_day``,
+        but aggregated from the user's columnar snapshot.
+
+        Returns None when snapshots are disabled or cannot be written, and
+        callers then run the SQL query instead.
+        """
+        if not self.snapshot_dir:
+            return None
+        rates = rates or self._rates(cursor.connection.cursor())
+        try:
+            directory = self._refresh_snapshot(cursor)
+            with ColumnSnapshot(directory) as snapshot:
+                return snapshot.sums(first_day, end_day, group_by, rates.base, rates)
+        except (OSError, ValueError) as e:
+            print(f"Columnar snapshot unavailable ({e}); reading the database instead.")
+            return None
+    
+    def _refresh_snapshot(self, cursor):
+        """Bring the current user's columnar snapshot up to date with the
+        data ``cursor`` sees; return its directory.
+
+        The snapshot records the change-log seq it is current to. If every
+        transaction logged for the user since then is new (added after the
+        snapshot's last row), those rows are appended; edits and deletions
+        rewrite the snapshot from ``all_transactions``. Archiving moves rows
+        without logging them, which leaves the snapshot valid as it is.
+        """
+        user_id = self.current_user["id"]
+        directory = os.path.join(self.snapshot_dir, f"user_{user_id}")
+        with self._snapshot_lock:
+            meta = read_snapshot_meta(directory)
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+            latest = cursor.fetchone()[0]
+            # A watermark ahead of the log means the database was replaced
+            if meta and meta["seq"] <= latest:
+                cursor.execute(
+                    """SELECT COUNT(*), COALESCE(SUM(op = 'delete'), 0) FROM change_log 
+                       WHERE table_name = 'transactions' AND user_id = ? AND seq > ?""",
+                    (user_id, meta["seq"])
+                )
+                changed, deleted = cursor.fetchone()
+                if not changed:
+                    return directory
+                if not deleted:
+                    cursor.execute(
+                        """SELECT t.id, t.day_num, t.amount, t.category, t.type, t.currency 
+                           FROM change_log c JOIN transactions t ON t.uid = c.row_key 
+                           WHERE c.table_name = 'transactions' AND c.user_id = ? AND c.seq > ? 
+                           ORDER BY t.id""",
+                        (user_id, meta["seq"])
+                    )
+                    rows = cursor.fetchall()
+                    if len(rows) == changed and rows[0][0] > meta["max_id"]:
+                        new_meta = dict(meta, seq=latest, rows=meta["rows"] + len(rows), max_id=rows[-1][0])
+                        write_snapshot(directory, new_meta, self._snapshot_columns(rows, new_meta), append=meta)
+                        return directory
+            
+            meta = {"version": SNAPSHOT_VERSION, "seq": latest, "rows": 0, "sorted": 0, "max_id": 0,
+                    "categories": [], "currencies": []}
+            cursor.execute(
+                """SELECT id, day_num, amount, category, type, currency FROM all_transactions 
+                   WHERE user_id = ? ORDER BY day_num""",
+                (user_id,)
+            )
+            rows = cursor.fetchall()
+            meta.update(rows=len(rows), sorted=len(rows), max_id=max((row[0] for row in rows), default=0))
+            write_snapshot(directory, meta, self._snapshot_columns(rows, meta))
+        return directory
+    
+    def _snapshot_columns(self, rows, meta):
+        """Turn ``(id, day_num, amount, category, type, currency)`` rows into
+        snapshot column arrays, extending ``meta``'s category and currency
+        names with any new ones."""
+        codes = {name: {value: i for i, value in enumerate(meta[name])} for name in ("categories", "currencies")}
         
-    def hash_password(self, password):
-        """Hash the password using SHA-256."""
-        return hashlib.sha256(password.encode()).hexdigest()
+        def code(name, value):
+            if value not in codes[name]:
+                codes[name][value] = len(meta[name])
+                meta[name].append(value)
+            return codes[name][value]
+        
+        return {
+            "day_num": array(SNAPSHOT_COLUMNS["day_num"], (row[1] for row in rows)),
+            "amount": array(SNAPSHOT_COLUMNS["amount"], (row[2] for row in rows)),
+            "category": array(SNAPSHOT_COLUMNS["category"], (code("categories", row[3]) for row in rows)),
+            "type": array(SNAPSHOT_COLUMNS["type"], (SNAPSHOT_TYPES.index(row[4]) for row in rows)),
+            "currency": array(SNAPSHOT_COLUMNS["currency"], (code("currencies", row[5]) for row in rows)),
+        }
+    
+    def _prompt_month_year(self):
+        """Prompt for a month and year, defaulting to the current ones."""
+        current_month = datetime.now().month
+        current_year = datetime.now().year
+        
+        while True:
+            try:
+                month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
+                month = int(month_input) if month_input else current_month
+                
+                if not 1 <= month <= 12:
+                    print("Month must be between 1 and 12.")
+                    continue
+                
+                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
+                year = int(year_input) if year_input else current_year
+                
+                if year < 2000 or year > 2100:
+                    print("Please enter a valid year between 2000 and 2100.")
+                    continue
+                
+                return month, year
+            except ValueError:
+                print("Please enter a valid number.")
+    
+    def _prompt_year(self):
+        """Prompt for a year, defaulting to the current one."""
+        current_year = datetime.now().year
+        
+        while True:
+            try:
+                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
+                year = int(year_input) if year_input else current_year
+                
+                if year < 2000 or year > 2100:
+                    print("Please enter a valid year between 2000 and 2100.")
+                    continue
+                
+                return year
+            except ValueError:
+                print("Please enter a valid number.")
+    
+    def generate_report(self):
+        """Generate financial reports for the user."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Generate Financial Report ===")
+        print("1. Monthly Report")
+        print("2. Yearly Report")
+        print("3. Category Breakdown")
+        print("4. Income vs Expense Trend")
+        print("5. Year-over-Year Comparison")
+        print("6. Unusual Spending")
+        print("7. Month-End Budget Forecast")
+        print("8. Totals Between Dates")
+        print("9. Top Payees")
+        print("10. Tagged Transactions")
+        
+        choice = input("\nSelect report type (1-10): ").strip()
+        
+        if choice == "1":
+            self._generate_monthly_report()
+        elif choice == "2":
+            self._generate_yearly_report()
+        elif choice == "3":
+            self._generate_category_breakdown()
+        elif choice == "4":
+            self._generate_trend_report()
+        elif choice == "5":
+            self._generate_yoy_report()
+        elif choice == "6":
+            self._generate_anomaly_report()
+        elif choice == "7":
+            self._generate_forecast_report()
+        elif choice == "8":
+            self._generate_range_report()
+        elif choice == "9":
+            self._generate_top_payees_report()
+        elif choice == "10":
+            self._generate_tag_report()
+        else:
+            print("Invalid choice.")
+    
+    def manage_tags(self):
+        """List the user's tags, and tag or untag transactions."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+        
+        print("\n=== Tags ===")
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            index = self._tag_index(cursor)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if index.bits:
+            print_table([[tag, index.count(bits)] for tag, bits in sorted(index.bits.items())],
+                        ["Tag", "Transactions"])
+        else:
+            print("No tags yet.")
+        
+        print("\n1. Tag transactions")
+        print("2. Remove tags from transactions")
+        choice = input("\nSelect an option (1-2): ").strip()
+        if choice not in ["1", "2"]:
+            print("Invalid choice.")
+            return
+        
+        try:
+            transaction_ids = [int(part) for part in re.split(r"[\s,]+", input("Transaction IDs: ").strip()) if part]
+            tags = parse_tags(input("Tags (e.g. business, trip-2026): "))
+        except ValueError as e:
+            print(f"Invalid input: {e}" if "tag" in str(e) else "Please enter valid IDs.")
+            return
+        if not transaction_ids or not tags:
+            print("Please enter at least one transaction ID and one tag.")
+            return
+        
+        if choice == "1":
+            count = self.tag_transactions(transaction_ids, tags)
+            if count is not None:
+                print(f"\n✓ Added {count} tag(s).")
+        else:
+            count = self.untag_transactions(transaction_ids, tags)
+            if count is not None:
+                print(f"\n✓ Removed {count} tag(s).")
+    
+    def tag_transactions(self, transaction_ids, tags):
+        """Give the user's transactions ``transaction_ids`` each of ``tags``;
+        returns the number of tags added, or None on error."""
+        try:
+            tags = parse_tags(" ".join(tags))
+        except ValueError as e:
+            print(e)
+            return None
+        user_id = self.current_user["id"]
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT id FROM all_transactions WHERE user_id = ? AND id IN ({', '.join('?' * len(transaction_ids))})",
+                [user_id] + list(transaction_ids)
+            )
+            found = [row[0] for row in cursor.fetchall()]
+            missing = sorted(set(transaction_ids) - set(found))
+            if missing:
+                print(f"Skipping transaction(s) not found: {', '.join(map(str, missing))}")
+            
+            cursor.executemany("INSERT OR IGNORE INTO tags (user_id, name) VALUES (?, ?)",
+                               [(user_id, tag) for tag in tags])
+            cursor.executemany(
+                """INSERT OR IGNORE INTO transaction_tags (tag_id, transaction_id) 
+                   SELECT id, ? FROM tags WHERE user_id = ? AND name = ?""",
+                [(transaction_id, user_id, tag) for tag in tags for transaction_id in found]
+            )
+            added = cursor.rowcount if found else 0
+            if not self.conn:
+                conn.commit()
+            return added
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+    
+    def untag_transactions(self, transaction_ids, tags):
+        """Remove ``tags`` from the user's transactions ``transaction_ids``
+        (tags no transaction has any more are dropped); returns the number
+        removed, or None on error."""
+        user_id = self.current_user["id"]
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"""DELETE FROM transaction_tags 
+                    WHERE tag_id IN (SELECT id FROM tags WHERE user_id = ? AND name IN ({', '.join('?' * len(tags))})) 
+                      AND transaction_id IN ({', '.join('?' * len(transaction_ids))})""",
+                [user_id] + list(tags) + list(transaction_ids)
+            )
+            removed = cursor.rowcount
+            cursor.execute(
+                """DELETE FROM tags WHERE user_id = ? 
+                   AND NOT EXISTS (SELECT 1 FROM transaction_tags WHERE tag_id = tags.id)""",
+                (user_id,)
+            )
+            if not self.conn:
+                conn.commit()
+            return removed
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+    
+    def _tag_index(self, cursor):
+        """Return the current user's TagIndex as of the data ``cursor`` sees.
+
+        Indexes are built from ``all_transactions`` and ``transaction_tags``
+        and cached per user until the user's data revision changes (adding,
+        deleting or tagging transactions all bump it).
+        """
+        user_id = self.current_user["id"]
+        revision = self._data_revision(cursor)
+        cached = self._tag_indexes.get(user_id)
+        if cached and cached[0] == revision:
+            return cached[1]
+        
+        cursor.execute("SELECT id FROM all_transactions WHERE user_id = ? ORDER BY id", (user_id,))
+        ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            """SELECT t.name, tt.transaction_id FROM tags t 
+               JOIN transaction_tags tt ON tt.tag_id = t.id WHERE t.user_id = ?""",
+            (user_id,)
+        )
+        index = TagIndex(ids, cursor.fetchall())
+        self._tag_indexes[user_id] = (revision, index)
+        return index
     
-    def register_user(self):
-        """Register a new user."""
-        print("\n=== User Registration ===")
+    def _tagged_ids(self, cursor, expression):
+        """Return the IDs of the user's transactions matching a tag query,
+        as a JSON array for ``id IN (SELECT value FROM json_each(?))``."""
+        index = self._tag_index(cursor)
+        return json.dumps(index.transaction_ids(index.query(expression)))
+    
+    def manage_attachments(self):
+        """Attach receipts to a transaction, or save and remove its attachments."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
         
-        while True:
-            username = input("Enter username (min 3 characters): ").strip()
-            if len(username) < 3:
-                print("Username must be at least 3 characters long.")
-                continue
-                
-            # Check if username exists
-            conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            if cursor.fetchone():
-                print("Username already exists. Please choose another one.")
-                if not self.conn:
-                    conn.close()
-                continue
-            
-            # Password validation
-            while True:
-                password = getpass("Enter password (min 6 characters): ")
-                if len(password) < 6:
-                    print("Password must be at least 6 characters long.")
-                    continue
-                    
-                confirm_password = getpass("Confirm password: ")
-                if password != confirm_password:
-                    print("Passwords do not match. Try again.")
-                    continue
-                break
-            
-            # Save user to database
-            password_hash = self.hash_password(password)
-            try:
-                cursor.execute(
-                    "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                    (username, password_hash)
-                )
-                if not self.conn:
-                    conn.commit()
-                print("\n✓ Registration successful! You can now log in.")
-                break
-            except sqlite3.Error as e:
-                print(f"Database error: {e}")
-            finally:
-                if not self.conn:
-                    conn.close()
-            
-    def login(self):
-        """Authenticate user and set current_user if successful."""
-        print("\n=== User Login ===")
+        print("\n=== Attachments ===")
         
-        username = input("Username: ").strip()
-        password = getpass("Password: ")
+        try:
+            transaction_id = int(input("Transaction ID: ").strip())
+        except ValueError:
+            print("Please enter a valid ID.")
+            return
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
+        conn = self._read_connection()
         cursor = conn.cursor()
+        try:
+            attachments = self._attachments(cursor, transaction_id)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if attachments:
+            print_table([[a[0], a[1], f"{a[2]:,} bytes", a[3]] for a in attachments],
+                        ["ID", "File", "Size", "Added"])
+        else:
+            print("No attachments for this transaction.")
+        
+        print("\n1. Attach a file")
+        print("2. Save a copy of an attachment")
+        print("3. Remove an attachment")
+        choice = input("\nSelect an option (1-3): ").strip()
         
+        if choice == "1":
+            path = input("File to attach: ").strip()
+            self.add_attachment(transaction_id, path)
+        elif choice in ["2", "3"]:
+            try:
+                attachment_id = int(input("Attachment ID: ").strip())
+            except ValueError:
+                print("Please enter a valid ID.")
+                return
+            if choice == "2":
+                destination = input("Save as (file or folder): ").strip() or "."
+                self.save_attachment(attachment_id, destination)
+            else:
+                self.remove_attachment(attachment_id)
+        else:
+            print("Invalid choice.")
+    
+    def _attachments(self, cursor, transaction_id):
+        """Return ``(id, filename, size, added_at)`` for a transaction's attachments."""
+        cursor.execute(
+            """SELECT id, filename, size, added_at FROM attachments 
+               WHERE transaction_id = ? AND user_id = ? ORDER BY id""",
+            (transaction_id, self.current_user["id"])
+        )
+        return cursor.fetchall()
+    
+    def add_attachment(self, transaction_id, path):
+        """Attach the file at ``path`` to one of the user's transactions.
+
+        The file is streamed into the attachment store (once per distinct
+        content) and a metadata row is added. Returns the attachment ID, or
+        None if it could not be attached.
+        """
+        conn = self._write_connection()
+        cursor = conn.cursor()
         try:
             cursor.execute(
-                "SELECT id, username, password_hash FROM users WHERE username = ?", 
-                (username,)
+                "SELECT 1 FROM all_transactions WHERE id = ? AND user_id = ?",
+                (transaction_id, self.current_user["id"])
             )
-            user = cursor.fetchone()
+            if not cursor.fetchone():
+                print("Transaction not found or you don't have permission to change it.")
+                return None
             
-            if user and user[2] == self.hash_password(password):
-                self.current_user = {"id": user[0], "username": user[1]}
-                print(f"\n✓ Welcome back, {user[1]}!")
-                if not self.conn:
-                    conn.commit()
-                return True
-            else:
-                print("Invalid username or password.")
+            digest, size = store_attachment(path, self.attachments_dir)
+            cursor.execute(
+                """INSERT INTO attachments (user_id, transaction_id, filename, size, sha256) 
+                   VALUES (?, ?, ?, ?, ?)""",
+                (self.current_user["id"], transaction_id, os.path.basename(path), size, digest)
+            )
+            attachment_id = cursor.lastrowid
+            if not self.conn:
+                conn.commit()
+            print(f"\n✓ Attached {os.path.basename(path)} ({size:,} bytes)")
+            return attachment_id
+        except OSError as e:
+            print(f"Error reading file: {e}")
+            return None
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+    
+    def save_attachment(self, attachment_id, destination):
+        """Copy an attachment to ``destination`` (a file, or a folder to keep
+        its name in), in chunks. Returns the path written, or None."""
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT filename, sha256 FROM attachments WHERE id = ? AND user_id = ?",
+                (attachment_id, self.current_user["id"])
+            )
+            row = cursor.fetchone()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+        
+        if not row:
+            print("Attachment not found.")
+            return None
+        filename, digest = row
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, filename)
+        try:
+            with open(attachment_path(self.attachments_dir, digest), "rb") as src, open(destination, "wb") as dst:
+                shutil.copyfileobj(src, dst, ATTACHMENT_CHUNK_SIZE)
+        except OSError as e:
+            print(f"Error saving attachment: {e}")
+            return None
+        print(f"\n✓ Saved {filename} to {destination}")
+        return destination
+    
+    def remove_attachment(self, attachment_id):
+        """Remove an attachment; its file goes once nothing else refers to it."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT sha256 FROM attachments WHERE id = ? AND user_id = ?",
+                (attachment_id, self.current_user["id"])
+            )
+            row = cursor.fetchone()
+            if not row:
+                print("Attachment not found.")
                 return False
+            cursor.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+            if not self.conn:
+                conn.commit()
+            self._prune_attachment_files(cursor, [row[0]])
+            print("\n✓ Attachment removed.")
+            return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return False
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def logout(self):
-        """Log out the current user."""
-        if self.current_user:
-            print(f"\n✓ Goodbye, {self.current_user['username']}!")
-            self.current_user = None
-        else:
-            print("No user is currently logged in.")
+    def _prune_attachment_files(self, cursor, digests=None):
+        """Delete stored files that no attachment row refers to any more.
+
+        Only the files in ``digests`` are checked when given, otherwise the
+        whole store.
+        """
+        if not os.path.isdir(self.attachments_dir):
+            return
+        if digests is None:
+            digests = [name for prefix in os.listdir(self.attachments_dir)
+                       if os.path.isdir(os.path.join(self.attachments_dir, prefix))
+                       for name in os.listdir(os.path.join(self.attachments_dir, prefix))]
+        for digest in set(digests):
+            cursor.execute("SELECT 1 FROM attachments WHERE sha256 = ? LIMIT 1", (digest,))
+            path = attachment_path(self.attachments_dir, digest)
+            if not cursor.fetchone() and os.path.exists(path):
+                os.remove(path)
     
-    def add_transaction(self):
-        """Add a new income or expense transaction."""
+    def sync_database(self):
+        """Exchange changes with another copy of the database."""
         if not self.current_user:
             print("Please log in first.")
             return
-            
-        print("\n=== Add Transaction ===")
         
-        # Get transaction type (income or expense)
-        while True:
-            transaction_type = input("Transaction type (income/expense): ").strip().lower()
-            if transaction_type in ["income", "expense"]:
-                break
-            print("Invalid type. Please enter 'income' or 'expense'.")
+        print("\n=== Sync With Another Database ===")
+        peer_file = input("Path of the other database file: ").strip()
+        if not peer_file:
+            print("Sync cancelled.")
+            return
+        if not os.path.exists(peer_file):
+            print(f"{peer_file} does not exist.")
+            return
+        if os.path.abspath(peer_file) == os.path.abspath(self.db_file):
+            print("That is this database.")
+            return
         
-        # Get amount
-        while True:
+        result = self.sync_with(peer_file)
+        if result:
+            received, sent = result
+            print(f"\n✓ Sync complete: {received} change(s) received, {sent} sent.")
+    
+    @timed("sync")
+    def sync_with(self, peer_file):
+        """Sync with the replica in ``peer_file``; returns ``(received, sent)`` or None.
+
+        Each side applies the other's change log entries after the last one
+        it has seen from that replica, so the work done scales with the
+        number of changes, not the size of either database. When both sides
+        changed a row, the change with the higher (clock, replica ID) wins,
+        on both sides. Transactions in the archive database are not synced:
+        archiving is not logged as a change, and a change the other side
+        makes to a row archived here arrives as a new hot row. Replicas
+        should be synced first and then archived at the same cutoff.
+        """
+        # Bring the other database's schema (and change log) up to date first
+        PersonalFinanceManager(db_file=peer_file, readers=1).close()
+        
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            # ATTACH and DETACH cannot run inside a transaction, so a sync
+            # always commits (or rolls back) its own work. In WAL mode the two
+            # files commit one after the other, and a crash in between leaves
+            # one side's half undone. Each side stores what it has received
+            # (sync_peers) in the commit that applies it, and applying a change
+            # twice changes nothing, so the next sync finishes the other half.
+            cursor.execute("ATTACH DATABASE ? AS peer", (peer_file,))
             try:
-                amount = float(input("Amount: $").strip())
-                if amount <= 0:
-                    print("Amount must be greater than zero.")
-                    continue
-                break
-            except ValueError:
-                print("Invalid amount. Please enter a number.")
+                received = self._apply_changes(cursor, "peer", "main")
+                sent = self._apply_changes(cursor, "main", "peer")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE peer")
+            return received, sent
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        finally:
+            self._release(conn)
+    
+    def _apply_changes(self, cursor, source, target):
+        """Apply ``source``'s new change log entries to ``target`` (schema names).
+
+        Entries from ``target`` itself are skipped, entries older than the
+        target's own entry for the row lose, and applied ones are logged in
+        the target under their original clock and origin, so they can travel
+        on to further replicas. Returns the number of changes applied.
+        """
+        cursor.execute(f"SELECT value FROM {source}.meta WHERE key = 'replica_id'")
+        source_id = cursor.fetchone()[0]
+        cursor.execute(f"SELECT value FROM {target}.meta WHERE key = 'replica_id'")
+        target_id = cursor.fetchone()[0]
+        cursor.execute(f"SELECT received_seq FROM {target}.sync_peers WHERE replica_id = ?", (source_id,))
+        row = cursor.fetchone()
+        since = row[0] if row else 0
+        users = self._sync_users(cursor, source, target)
         
-        # Get category
-        categories = self.get_categories(transaction_type)
-        print(f"\nAvailable {transaction_type} categories:")
-        for i, category in enumerate(categories, 1):
-            print(f"{i}. {category}")
-        print(f"{len(categories) + 1}. Other (create new)")
+        cursor.execute(f"INSERT OR REPLACE INTO {target}.meta (key, value) VALUES ('syncing', '1')")
+        cursor.execute(
+            f"""SELECT seq, table_name, user_id, row_key, op, clock, origin FROM {source}.change_log 
+                WHERE seq > ? ORDER BY seq""",
+            (since,)
+        )
+        changes = cursor.fetchall()
+        applied = 0
+        for seq, table, user_id, key, op, clock, origin in changes:
+            since = seq
+            if origin == target_id:
+                continue
+            target_user = users.get(user_id, 0)
+            cursor.execute(
+                f"""SELECT clock, origin FROM {target}.change_log 
+                    WHERE table_name = ? AND user_id = ? AND row_key = ?""",
+                (table, target_user, key)
+            )
+            local = cursor.fetchone()
+            if local and (local[0], local[1]) >= (clock, origin):
+                continue
+            self._apply_change(cursor, source, target, table, user_id, target_user, key, op)
+            cursor.execute(
+                f"""INSERT OR REPLACE INTO {target}.change_log (table_name, user_id, row_key, op, clock, origin) 
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                (table, target_user, key, op, clock, origin)
+            )
+            applied += 1
         
-        while True:
-            try:
-                choice = int(input("\nSelect category number: "))
-                if 1 <= choice <= len(categories):
-                    category = categories[choice - 1]
-                    break
-                elif choice == len(categories) + 1:
-                    category = input("Enter new category name: ").strip().title()
-                    if not category:
-                        print("Category cannot be empty.")
-                        continue
-                    break
-                else:
-                    print("Invalid choice.")
-            except ValueError:
-                print("Please enter a number.")
+        # Lamport clock: later local changes must order after everything seen
+        if changes:
+            cursor.execute(
+                f"UPDATE {target}.meta SET value = MAX(CAST(value AS INTEGER), ?) WHERE key = 'clock'",
+                (max(change[5] for change in changes),)
+            )
+        cursor.execute(
+            f"""INSERT INTO {target}.sync_peers (replica_id, received_seq, synced_at) VALUES (?, ?, CURRENT_TIMESTAMP) 
+                ON CONFLICT (replica_id) DO UPDATE SET received_seq = excluded.received_seq, 
+                                                       synced_at = excluded.synced_at""",
+            (source_id, since)
+        )
+        cursor.execute(f"DELETE FROM {target}.meta WHERE key = 'syncing'")
+        return applied
+    
+    def _sync_users(self, cursor, source, target):
+        """Map ``source`` user IDs to ``target`` ones by username, adding
+        missing users to ``target``. Rates' user 0 maps to itself."""
+        cursor.execute(f"SELECT id, username, password_hash, base_currency FROM {source}.users")
+        users = {0: 0}
+        for user_id, username, password_hash, base_currency in cursor.fetchall():
+            cursor.execute(
+                f"""INSERT INTO {target}.users (username, password_hash, base_currency) VALUES (?, ?, ?) 
+                    ON CONFLICT (username) DO NOTHING""",
+                (username, password_hash, base_currency)
+            )
+            cursor.execute(f"SELECT id FROM {target}.users WHERE username = ?", (username,))
+            users[user_id] = cursor.fetchone()[0]
+        return users
+    
+    def _apply_change(self, cursor, source, target, table, source_user, target_user, key, op):
+        """Copy one row, named by its sync key, from ``source`` to ``target``,
+        or delete it there."""
+        if table == "transactions":
+            match, params = "uid = ?", [key]
+        elif table == "budgets":
+            month, year, category = key.split("|", 2)
+            match, params = "month = ? AND year = ? AND category = ?", [int(month), int(year), category]
+        else:
+            currency, date = key.split("|", 1)
+            match, params = "currency = ? AND date = ?", [currency, date]
+        user_match = "user_id = ? AND " if table != "fx_rates" else ""
         
-        # Get description
-        description = input("Description (optional): ").strip()
+        if op == "delete":
+            cursor.execute(f"DELETE FROM {target}.{table} WHERE {user_match}{match}",
+                           ([target_user] if user_match else []) + params)
+            return
         
-        # Get date (default is today)
-        while True:
-            date_input = input("Date (YYYY-MM-DD, leave empty for today): ").strip()
-            if not date_input:
-                date = datetime.now().strftime("%Y-%m-%d")
-                break
+        if table == "transactions":
+            columns = ["type", "amount", "category", "description", "date", "currency"]
+        elif table == "budgets":
+            columns = ["category", "amount", "month", "year", "currency"]
+        else:
+            columns = ["currency", "date", "rate"]
+        cursor.execute(
+            f"SELECT {', '.join(columns)} FROM {source}.{table} WHERE {user_match}{match}",
+            ([source_user] if user_match else []) + params
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return  # Deleted (or archived) at the source after the change was logged
+        
+        if table == "transactions":
+            # Fingerprints include the user ID, which can differ between
+            # replicas, so the row gets the one an import here would give it
+            # (keeping the n of the n-th identical transaction), unless
+            # another row already has that one
+            cursor.execute(f"SELECT fingerprint, external_id FROM {source}.transactions WHERE uid = ?", (key,))
+            source_fingerprint, external_id = cursor.fetchone()
+            suffix = (source_fingerprint or ":1").rpartition(":")[2]
+            fingerprint = f"{transaction_fingerprint(target_user, *row)}:{suffix}"
+            cursor.execute(
+                f"""UPDATE {target}.transactions SET {', '.join(c + ' = ?' for c in columns)}, user_id = ?, 
+                           fingerprint = CASE WHEN EXISTS (SELECT 1 FROM {target}.transactions 
+                                                           WHERE user_id = ? AND fingerprint = ? AND uid != ?) 
+                                              THEN fingerprint ELSE ? END 
+                    WHERE uid = ?""",
+                list(row) + [target_user, target_user, fingerprint, key, fingerprint, key]
+            )
+            if not cursor.rowcount:
+                # A copy already recorded here under another uid (same fingerprint
+                # or source ID) takes this one, so later edits and deletes reach it
+                cursor.execute(
+                    f"""UPDATE {target}.transactions SET {', '.join(c + ' = ?' for c in columns)}, uid = ? 
+                        WHERE id = (SELECT id FROM {target}.transactions 
+                                     WHERE user_id = ? AND (fingerprint = ? OR external_id = ?) LIMIT 1)""",
+                    list(row) + [key, target_user, fingerprint, external_id]
+                )
+                if cursor.rowcount:
+                    return
+                cursor.execute(
+                    f"""INSERT INTO {target}.transactions 
+                        (user_id, {', '.join(columns)}, fingerprint, external_id, uid) 
+                        VALUES (?, {', '.join('?' * len(columns))}, ?, ?, ?) ON CONFLICT DO NOTHING""",
+                    [target_user] + list(row) + [fingerprint, external_id, key]
+                )
+        elif table == "budgets":
+            cursor.execute(
+                f"""INSERT INTO {target}.budgets (user_id, {', '.join(columns)}) VALUES (?, ?, ?, ?, ?, ?) 
+                    ON CONFLICT (user_id, category, month, year) 
+                    DO UPDATE SET amount = excluded.amount, currency = excluded.currency""",
+                [target_user] + list(row)
+            )
+        else:
+            cursor.execute(
+                f"""INSERT INTO {target}.fx_rates (currency, date, rate) VALUES (?, ?, ?) 
+                    ON CONFLICT (currency, date) DO UPDATE SET rate = excluded.rate""",
+                list(row)
+            )
+    
+    def show_stats(self):
+        """Show how often each operation ran this session and how long it took."""
+        print("\n=== Usage Statistics ===")
+        
+        if not self.metrics.enabled:
+            print("Metrics are turned off.")
+            return
+        rows = self.metrics.rows()
+        if not rows:
+            print("No operations recorded yet.")
+            return
+        
+        def ms(seconds):
+            return "-" if seconds is None else f"{seconds * 1000:.1f}"
+        
+        def bucket(timed, p95):
+            if not timed:
+                return "-"
+            return f"≤ {ms(p95)}" if p95 is not None else f"> {ms(self.metrics.buckets[-1])}"
+        
+        table = [[operation, calls, errors, ms(mean), bucket(timed, p95)]
+                 for operation, calls, errors, timed, mean, p95 in rows]
+        print_table(table, ["Operation", "Runs", "Errors", "Mean ms", "p95 ms"])
+        if self.metrics.path:
+            print(f"\nAlso written to {self.metrics.path} (Prometheus text format).")
+    
+    def database_maintenance(self):
+        """Run every maintenance step now and show what each did."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+        
+        print("\n=== Database Maintenance ===")
+        print("Refreshing query statistics, returning free space to the file system and checking integrity...")
+        try:
+            steps, before, after = self.run_maintenance(full=True)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        
+        print_table([[step.name, f"{step.seconds * 1000:.1f}", step.result] for step in steps],
+                    ["Step", "Time ms", "Result"])
+        print(f"\nFile size: {before[0] / 1024:.0f} KiB → {after[0] / 1024:.0f} KiB "
+              f"({after[1]} free page(s) left)")
+    
+    @timed("maintenance")
+    def run_maintenance(self, full=False):
+        """Run the database maintenance steps that are due, or with ``full`` all of them.
+
+        The steps are ANALYZE (after MAINTENANCE_ANALYZE_CHANGES changes,
+        with MAINTENANCE_ANALYSIS_LIMIT unless ``full``), incremental vacuum
+        (at most MAINTENANCE_VACUUM_PAGES pages unless ``full``) and
+        quick_check (every MAINTENANCE_CHECK_DAYS days). ``full`` also
+        converts a database created before incremental auto-vacuum with a
+        one-off VACUUM. Returns ``(steps, before, after)``: the
+        MaintenanceStep records of the steps run, and the file's
+        ``(size in bytes, free pages)`` before and after.
+        """
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        steps = []
+        
+        def run(name, func):
+            start = time.perf_counter()
+            result = func()
+            steps.append(MaintenanceStep(name, time.perf_counter() - start, result))
+        
+        try:
+            before = self._database_size(cursor)
+            cursor.execute("SELECT key, value FROM meta WHERE key IN ('analyzed_seq', 'checked_at')")
+            state = dict(cursor.fetchall())
             
-            try:
-                date = datetime.strptime(date_input, "%Y-%m-%d").strftime("%Y-%m-%d")
-                break
-            except ValueError:
-                print("Invalid date format. Please use YYYY-MM-DD.")
+            cursor.execute("PRAGMA main.auto_vacuum")
+            incremental = cursor.fetchone()[0] == 2
+            # VACUUM (and the script below) cannot run inside a transaction the
+            # caller of a provided connection has open
+            if full and not incremental and not conn.in_transaction:
+                def convert():
+                    cursor.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+                    cursor.execute("VACUUM main")
+                    return "switched to incremental auto-vacuum"
+                run("vacuum", convert)
+                incremental = True
+            
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+            latest = cursor.fetchone()[0]
+            analyzed = state.get("analyzed_seq")
+            if full or analyzed is None or latest - int(analyzed) >= MAINTENANCE_ANALYZE_CHANGES:
+                def analyze():
+                    cursor.execute(f"PRAGMA analysis_limit={0 if full else MAINTENANCE_ANALYSIS_LIMIT}")
+                    cursor.execute("ANALYZE main")
+                    cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('analyzed_seq', ?)",
+                                   (str(latest),))
+                    return f"{latest - int(analyzed or 0)} change(s) since the last run"
+                run("analyze", analyze)
+            
+            if not self.conn:
+                conn.commit()
+            free = self._database_size(cursor)[1]
+            if incremental and free and not conn.in_transaction:
+                def vacuum():
+                    pages = free if full else min(free, MAINTENANCE_VACUUM_PAGES)
+                    # Run as a script: a single execute() frees only one page
+                    conn.executescript(f"PRAGMA main.incremental_vacuum({pages})")
+                    return f"freed {free - self._database_size(cursor)[1]} of {free} free page(s)"
+                run("incremental_vacuum", vacuum)
+            
+            checked_at = state.get("checked_at")
+            check_due = not checked_at or \
+                datetime.now() - datetime.fromisoformat(checked_at) >= timedelta(days=MAINTENANCE_CHECK_DAYS)
+            if full or check_due:
+                def check():
+                    cursor.execute("PRAGMA main.quick_check")
+                    problems = [row[0] for row in cursor.fetchall() if row[0] != "ok"]
+                    cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('checked_at', ?)",
+                                   (datetime.now().isoformat(timespec="seconds"),))
+                    return "ok" if not problems else "; ".join(problems[:5])
+                run("quick_check", check)
+            
+            if not self.conn:
+                conn.commit()
+            return steps, before, self._database_size(cursor)
+        finally:
+            self._release(conn)
+    
+    def _database_size(self, cursor):
+        """Return the main database's ``(size in bytes, free pages)``."""
+        cursor.execute("PRAGMA main.page_count")
+        pages = cursor.fetchone()[0]
+        cursor.execute("PRAGMA main.page_size")
+        size = pages * cursor.fetchone()[0]
+        cursor.execute("PRAGMA main.freelist_count")
+        return size, cursor.fetchone()[0]
+    
+    @timed("backup_data")
+    def backup_data(self):
+        """Create a backup of the database."""
+        if not self.current_user:
+            print("Please log in first.")
+            return
+            
+        print("\n=== Backup Data ===")
         
-        # Save transaction to database
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        # Create backup directory if it doesn't exist
+        backup_dir = "backups"
+        if not os.path.exists(backup_dir):
+            os.makedirs(backup_dir)
+        
+        # Generate backup filename with timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup_file = f"{backup_dir}/finance_backup_{self.current_user['username']}_{timestamp}.db"
         
+        # Connect to existing database
+        conn = self._read_connection()
         try:
-            cursor.execute(
-                """INSERT INTO transactions 
-                (user_id, type, amount, category, description, date) 
-                VALUES (?, ?, ?, ?, ?, ?)""",
-                (self.current_user["id"], transaction_type, amount, category, description, date)
-            )
-            if not self.conn:
-                conn.commit()
-            print(f"\n✓ {transaction_type.title()} transaction added successfully!")
+            # Back up the database
+            with open(backup_file, 'wb') as f:
+                for line in conn.iterdump():
+                    f.write(f'{line}\n'.encode('utf-8'))
             
-            # Check if budget is exceeded for expense transactions
-            if transaction_type == "expense":
-                self.check_budget_limit(category, amount, date)
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
+            # The archived transactions go to a copy of the archive database
+            # beside it, taken from the same snapshot
+            if any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+                archive = sqlite3.connect(archive_backup_file(backup_file))
+                try:
+                    conn.backup(archive, name="archive")
+                finally:
+                    archive.close()
+            
+            # Attachment files go to a content-addressed store shared by all
+            # backups, so each file is only ever copied once
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT sha256 FROM attachments")
+            copied = self._copy_attachment_files([row[0] for row in cursor.fetchall()],
+                                                 self.attachments_dir, f"{backup_dir}/attachments")
+            
+            print(f"\n✓ Backup created successfully: {backup_file}")
+            if os.path.exists(archive_backup_file(backup_file)):
+                print(f"  Archived transactions saved to {archive_backup_file(backup_file)}")
+            if copied:
+                print(f"  {copied} new attachment file(s) saved to {backup_dir}/attachments")
+            
+        except Exception as e:
+            print(f"Error creating backup: {e}")
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def get_categories(self, transaction_type):
-        """Get list of categories based on transaction type."""
-        if transaction_type == "income":
-            return ["Salary", "Freelance", "Investment", "Gift", "Refund"]
-        else:  # expense
-            return ["Food", "Housing", "Transportation", "Utilities", "Entertainment", 
-                    "Healthcare", "Education", "Shopping", "Personal Care"]
+    def _copy_attachment_files(self, digests, source_dir, target_dir):
+        """Stream attachment files from one store to another, skipping files
+        already there or missing at the source. Returns the number copied."""
+        copied = 0
+        for digest in digests:
+            source = attachment_path(source_dir, digest)
+            target = attachment_path(target_dir, digest)
+            if os.path.exists(target) or not os.path.exists(source):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target + ".part")
+            os.replace(target + ".part", target)
+            copied += 1
+        return copied
     
-    def view_transactions(self):
-        """View all transactions for the current user."""
+    @timed("restore_data")
+    def restore_data(self):
+        """Restore data from a backup file."""
         if not self.current_user:
             print("Please log in first.")
             return
             
-        print("\n=== View Transactions ===")
-        
-        # Filter options
-        print("\nFilter options:")
-        print("1. View all transactions")
-        print("2. Filter by date range")
-        print("3. Filter by category")
-        print("4. Filter by transaction type")
+        print("\n=== Restore Data ===")
         
-        choice = input("\nSelect an option (1-4): ").strip()
+        # Check if backup directory exists
+        backup_dir = "backups"
+        if not os.path.exists(backup_dir):
+            print("No backups found.")
+            return
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # List available backups for the current user
+        backups = [f for f in os.listdir(backup_dir)
+                   if f.startswith(f"finance_backup_{self.current_user['username']}_") and f.endswith(".db")]
         
-        query = """SELECT id, type, amount, category, description, date 
-                   FROM transactions 
-                   WHERE user_id = ?"""
-        params = [self.current_user["id"]]
+        if not backups:
+            print(f"No backups found for {self.current_user['username']}.")
+            return
         
-        # Apply filters based on user choice
-        if choice == "2":
-            start_date = input("Start date (YYYY-MM-DD): ").strip()
-            end_date = input("End date (YYYY-MM-DD, leave empty for today): ").strip()
-            
-            if not end_date:
-                end_date = datetime.now().strftime("%Y-%m-%d")
+        # Display available backups
+        print("\nAvailable backups:")
+        for i, backup in enumerate(backups, 1):
+            # Extract timestamp from filename
+            timestamp = backup.split('_')[-1].split('.')[0]
+            try:
+                backup_time = datetime.strptime(timestamp, "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                backup_time = "Unknown date"
                 
-            query += " AND date BETWEEN ? AND ?"
-            params.extend([start_date, end_date])
-            
-        elif choice == "3":
-            category = input("Enter category: ").strip()
-            query += " AND category LIKE ?"
-            params.append(f"%{category}%")
-            
-        elif choice == "4":
-            while True:
-                trans_type = input("Transaction type (income/expense): ").strip().lower()
-                if trans_type in ["income", "expense"]:
+            print(f"{i}. {backup} ({backup_time})")
+        
+        # Get user selection
+        while True:
+            try:
+                choice = int(input("\nSelect backup to restore (0 to cancel): "))
+                if choice == 0:
+                    return
+                if 1 <= choice <= len(backups):
+                    selected_backup = f"{backup_dir}/{backups[choice-1]}"
                     break
-                print("Invalid type. Please enter 'income' or 'expense'.")
-                
-            query += " AND type = ?"
-            params.append(trans_type)
+                print("Invalid choice.")
+            except ValueError:
+                print("Please enter a number.")
         
-        query += " ORDER BY date DESC"
+        # Confirm restoration
+        confirm = input(f"\n⚠️ Warning: This will replace your current data with the backup.\nAre you sure? (y/n): ").strip().lower()
+        if confirm != 'y':
+            print("Restoration cancelled.")
+            return
         
         try:
-            cursor.execute(query, params)
-            transactions = cursor.fetchall()
+            # Close current database connections
+            self.close()
             
-            if not transactions:
-                print("\nNo transactions found.")
-                return
+            # Create a temporary database file
+            temp_db = f"temp_restore_{timestamp}.db"
+            temp_archive = f"temp_restore_{timestamp}_archive.db"
+            conn = sqlite3.connect(temp_db)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cursor = conn.cursor()
             
-            # Display transactions
-            headers = ["ID", "Type", "Amount", "Category", "Description", "Date"]
-            table_data = []
+            # Read and execute SQL commands from backup file
+            with open(selected_backup, 'r', encoding='utf-8') as f:
+                sql_script = f.read()
+                cursor.executescript(sql_script)
             
-            for t in transactions:
-                # Format amount with currency symbol based on transaction type
-                if t["type"] == "income":
-                    amount = f"+${t['amount']:.2f}"
-                else:
-                    amount = f"-${t['amount']:.2f}"
-                    
-                table_data.append([
-                    t["id"],
-                    t["type"].title(),
-                    amount,
-                    t["category"],
-                    t["description"] if t["description"] else "-",
-                    t["date"]
-                ])
+            conn.commit()
+            conn.close()
             
-            print("\n" + tabulate(table_data, headers=headers, tablefmt="pretty"))
+            # Bring back the attachment files the restored data refers to
+            conn = sqlite3.connect(temp_db)
+            try:
+                digests = [row[0] for row in conn.execute("SELECT DISTINCT sha256 FROM attachments")]
+            except sqlite3.OperationalError:
+                digests = []  # Backup from before attachments existed
+            try:
+                archived = conn.execute("SELECT COUNT(*) FROM users WHERE archived_before IS NOT NULL").fetchone()[0]
+            except sqlite3.OperationalError:
+                archived = 0  # Backup from before archiving existed
+            conn.close()
+            self._copy_attachment_files(digests, f"{backup_dir}/attachments", self.attachments_dir)
             
-            # Show summary
-            total_income = sum(t["amount"] for t in transactions if t["type"] == "income")
-            total_expense = sum(t["amount"] for t in transactions if t["type"] == "expense")
-            balance = total_income - total_expense
+            # The archived transactions, if the backup has them
+            archive_backup = archive_backup_file(selected_backup)
+            if os.path.exists(archive_backup):
+                source, target = sqlite3.connect(archive_backup), sqlite3.connect(temp_archive)
+                try:
+                    source.backup(target)
+                finally:
+                    source.close()
+                    target.close()
             
-            print(f"\nSummary:")
-            print(f"Total Income: ${total_income:.2f}")
-            print(f"Total Expenses: ${total_expense:.2f}")
-            print(f"Balance: ${balance:.2f}")
+            # Replace the current database (and archive) with the restored one.
+            # Without an archive copy, the current archive is only dropped
+            # when the backup is from before anything was archived
+            os.remove(self.db_file)
+            os.rename(temp_db, self.db_file)
+            if os.path.exists(temp_archive):
+                os.replace(temp_archive, self.archive_file)
+            elif not archived and os.path.exists(self.archive_file):
+                os.remove(self.archive_file)
+            if self.snapshot_dir:
+                shutil.rmtree(self.snapshot_dir, ignore_errors=True)
             
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-        finally:
-            if not self.conn:
-                conn.close()
+            print(f"\n✓ Database restored successfully from {selected_backup}")
+            
+        except Exception as e:
+            print(f"Error restoring backup: {e}")
+            for temp_file in (temp_db, temp_archive):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
     
-    def edit_transaction(self):
-        """Edit an existing transaction."""
+    def manage_currencies(self):
+        """Set the base currency and maintain exchange rates."""
         if not self.current_user:
             print("Please log in first.")
             return
             
-        print("\n=== Edit Transaction ===")
+        print("\n=== Currencies & Exchange Rates ===")
+        print(f"Base currency: {self._base_currency()}")
+        print("1. Change base currency")
+        print("2. Add or update an exchange rate")
+        print("3. View exchange rates")
         
-        # First, display recent transactions
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        choice = input("\nSelect an option (1-3): ").strip()
         
-        try:
-            cursor.execute(
-                """SELECT id, type, amount, category, description, date 
-                   FROM transactions 
-                   WHERE user_id = ? 
-                   ORDER BY date DESC LIMIT 10""",
-                (self.current_user["id"],)
-            )
-            transactions = cursor.fetchall()
-            
-            if not transactions:
-                print("No transactions found.")
+        if choice == "1":
+            self.set_base_currency(self._prompt_currency(self._base_currency()))
+        elif choice == "2":
+            currency = self._prompt_currency(self._base_currency())
+            if currency == DEFAULT_CURRENCY:
+                print(f"{DEFAULT_CURRENCY} is the reference currency and always has a rate of 1.")
                 return
             
-            # Display transactions
-            headers = ["ID", "Type", "Amount", "Category", "Description", "Date"]
-            table_data = []
-            
-            for t in transactions:
-                # Format amount with currency symbol based on transaction type
-                if t["type"] == "income":
-                    amount = f"+${t['amount']:.2f}"
-                else:
-                    amount = f"-${t['amount']:.2f}"
-                    
-                table_data.append([
-                    t["id"],
-                    t["type"].title(),
-                    amount,
-                    t["category"],
-                    t["description"] if t["description"] else "-",
-                    t["date"]
-                ])
-            
-            print("\nRecent Transactions:")
-            print(tabulate(table_data, headers=headers, tablefmt="pretty"))
-            
-            # Get transaction ID to edit
             while True:
+                date_input = input("Rate date (YYYY-MM-DD, leave empty for today): ").strip()
                 try:
-                    transaction_id = int(input("\nEnter ID of transaction to edit (0 to cancel): "))
-                    if transaction_id == 0:
-                        return
-                    
-                    # Check if transaction exists and belongs to current user
-                    cursor.execute(
-                        """SELECT id, type, amount, category, description, date 
-                           FROM transactions 
-                           WHERE id = ? AND user_id = ?""",
-                        (transaction_id, self.current_user["id"])
-                    )
-                    transaction = cursor.fetchone()
-                    
-                    if not transaction:
-                        print("Transaction not found or you don't have permission to edit it.")
-                        continue
+                    date = datetime.strptime(date_input, "%Y-%m-%d").strftime("%Y-%m-%d") if date_input \
+                        else datetime.now().strftime("%Y-%m-%d")
                     break
                 except ValueError:
-                    print("Please enter a valid ID.")
-            
-            # Show current values
-            print(f"\nEditing transaction #{transaction_id}:")
-            print(f"Current type: {transaction['type']}")
-            print(f"Current amount: ${transaction['amount']:.2f}")
-            print(f"Current category: {transaction['category']}")
-            print(f"Current description: {transaction['description'] or '-'}")
-            print(f"Current date: {transaction['date']}")
-            
-            # Get new values
-            print("\nEnter new values (leave empty to keep current value):")
-            
-            # Type
-            while True:
-                new_type = input(f"New type (income/expense): ").strip().lower()
-                if not new_type:
-                    new_type = transaction["type"]
-                    break
-                elif new_type in ["income", "expense"]:
-                    break
-                print("Invalid type. Please enter 'income' or 'expense'.")
+                    print("Invalid date format. Please use YYYY-MM-DD.")
             
-            # Amount
             while True:
-                new_amount_str = input(f"New amount: $").strip()
-                if not new_amount_str:
-                    new_amount = transaction["amount"]
-                    break
                 try:
-                    new_amount = float(new_amount_str)
-                    if new_amount <= 0:
-                        print("Amount must be greater than zero.")
+                    rate = parse_amount(input(f"Value of 1 {currency} in {DEFAULT_CURRENCY}: ").strip())
+                    if rate <= 0:
+                        print("Rate must be greater than zero.")
                         continue
                     break
                 except ValueError:
-                    print("Invalid amount. Please enter a number.")
-            
-            # Category
-            if new_type != transaction["type"]:
-                # If type changed, show categories for the new type
-                categories = self.get_categories(new_type)
-                print(f"\nAvailable {new_type} categories:")
-                for i, category in enumerate(categories, 1):
-                    print(f"{i}. {category}")
-                print(f"{len(categories) + 1}. Other (create new)")
-                print(f"{len(categories) + 2}. Keep current ({transaction['category']})")
-                
-                while True:
-                    try:
-                        choice = int(input("\nSelect category number: "))
-                        if 1 <= choice <= len(categories):
-                            new_category = categories[choice - 1]
-                            break
-                        elif choice == len(categories) + 1:
-                            new_category = input("Enter new category name: ").strip().title()
-                            if not new_category:
-                                print("Category cannot be empty.")
-                                continue
-                            break
-                        elif choice == len(categories) + 2:
-                            new_category = transaction["category"]
-                            break
-                        else:
-                            print("Invalid choice.")
-                    except ValueError:
-                        print("Please enter a number.")
-            else:
-                new_category_input = input(f"New category (current: {transaction['category']}): ").strip()
-                new_category = new_category_input if new_category_input else transaction["category"]
-            
-            # Description
-            new_description = input(f"New description (current: {transaction['description'] or '-'}): ").strip()
-            if not new_description and transaction["description"]:
-                new_description = transaction["description"]
-            
-            # Date
-            while True:
-                new_date_input = input(f"New date (YYYY-MM-DD, current: {transaction['date']}): ").strip()
-                if not new_date_input:
-                    new_date = transaction["date"]
-                    break
-                
-                try:
-                    new_date = datetime.strptime(new_date_input, "%Y-%m-%d").strftime("%Y-%m-%d")
-                    break
-                except ValueError:
-                    print("Invalid date format. Please use YYYY-MM-DD.")
+                    print("Invalid rate. Please enter a number.")
             
-            # Update the transaction
+            self.add_exchange_rate(currency, date, rate)
+        elif choice == "3":
+            conn = self._read_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """SELECT currency, date, rate FROM fx_rates 
+                       ORDER BY currency, date DESC"""
+                )
+                rows = [[currency, date, f"{rate:.6g}"] for currency, date, rate in cursor]
+                if not rows:
+                    print("No exchange rates recorded.")
+                    return
+                print_table(rows, ["Currency", "Date", f"Value in {DEFAULT_CURRENCY}"])
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+            finally:
+                self._release(conn)
+        else:
+            print("Invalid choice.")
+    
+    def set_base_currency(self, currency):
+        """Change the currency the current user's reports are shown in."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
             cursor.execute(
-                """UPDATE transactions 
-                   SET type = ?, amount = ?, category = ?, description = ?, date = ? 
-                   WHERE id = ?""",
-                (new_type, new_amount, new_category, new_description, new_date, transaction_id)
+                "UPDATE users SET base_currency = ? WHERE id = ?",
+                (currency, self.current_user["id"])
             )
             if not self.conn:
                 conn.commit()
-            print("\n✓ Transaction updated successfully!")
-            
-            # Check budget if the transaction is an expense
-            if new_type == "expense":
-                self.check_budget_limit(new_category, new_amount, new_date)
-            
+            self.current_user["base_currency"] = currency
+            print(f"\n✓ Base currency set to {currency}")
         except sqlite3.Error as e:
             print(f"Database error: {e}")
         finally:
+            self._release(conn)
+    
+    def add_exchange_rate(self, currency, date, rate):
+        """Record the value of one ``currency`` unit in DEFAULT_CURRENCY as of ``date``."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT OR REPLACE INTO fx_rates (currency, date, rate) VALUES (?, ?, ?)",
+                (currency, date, rate)
+            )
             if not self.conn:
-                conn.close()
+                conn.commit()
+            print(f"\n✓ 1 {currency} = {rate:.6g} {DEFAULT_CURRENCY} from {date}")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._release(conn)
     
-    def delete_transaction(self):
-        """Delete an existing transaction."""
+    def manage_categories(self):
+        """Arrange categories into parents and subcategories."""
         if not self.current_user:
             print("Please log in first.")
             return
-            
-        print("\n=== Delete Transaction ===")
         
-        # First, display recent transactions
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        print("\n=== Category Hierarchy ===")
         
+        conn = self._read_connection()
+        cursor = conn.cursor()
         try:
+            parents = self._category_parents(cursor)
             cursor.execute(
-                """SELECT id, type, amount, category, description, date 
-                   FROM transactions 
-                   WHERE user_id = ? 
-                   ORDER BY date DESC LIMIT 10""",
+                "SELECT DISTINCT ancestor FROM category_closure WHERE user_id = ? ORDER BY ancestor",
                 (self.current_user["id"],)
             )
-            transactions = cursor.fetchall()
-            
-            if not transactions:
-                print("No transactions found.")
+            categories = {row[0]: 0 for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if categories:
+            for path in category_paths(parents, categories):
+                print(f"  {path}")
+        else:
+            print("No categories yet.")
+        
+        print("\n1. Move a category under a parent")
+        print("2. Make a category top-level")
+        choice = input("\nSelect an option (1-2): ").strip()
+        
+        if choice not in ["1", "2"]:
+            print("Invalid choice.")
+            return
+        category = input("Category: ").strip().title()
+        if not category:
+            print("Category cannot be empty.")
+            return
+        if choice == "1":
+            parent = input("Parent category: ").strip().title()
+            if not parent:
+                print("Category cannot be empty.")
                 return
-            
-            # Display transactions
-            headers = ["ID", "Type", "Amount", "Category", "Description", "Date"]
-            table_data = []
-            
-            for t in transactions:
-                # Format amount with currency symbol based on transaction type
-                if t["type"] == "income":
-                    amount = f"+${t['amount']:.2f}"
-                else:
-                    amount = f"-${t['amount']:.2f}"
-                    
-                table_data.append([
-                    t["id"],
-                    t["type"].title(),
-                    amount,
-                    t["category"],
-                    t["description"] if t["description"] else "-",
-                    t["date"]
-                ])
-            
-            print("\nRecent Transactions:")
-            print(tabulate(table_data, headers=headers, tablefmt="pretty"))
-            
-            # Get transaction ID to delete
-            while True:
-                try:
-                    transaction_id = int(input("\nEnter ID of transaction to delete (0 to cancel): "))
-                    if transaction_id == 0:
-                        return
-                    
-                    # Check if transaction exists and belongs to current user
+            self.set_category_parent(category, parent)
+        else:
+            self.set_category_parent(category, None)
+    
+    def set_category_parent(self, category, parent):
+        """Move ``category`` (with its subcategories) under ``parent``, or to the top level.
+
+        The closure table is updated in place: the subtree's links to its
+        old ancestors are removed and links to each of the new parent's
+        ancestors are added. Returns whether the move was made.
+        """
+        user_id = self.current_user["id"]
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            for name in [category, parent]:
+                if name:
                     cursor.execute(
-                        "SELECT id FROM transactions WHERE id = ? AND user_id = ?",
-                        (transaction_id, self.current_user["id"])
-                    )
-                    if not cursor.fetchone():
-                        print("Transaction not found or you don't have permission to delete it.")
-                        continue
-                    break
-                except ValueError:
-                    print("Please enter a valid ID.")
+                        """INSERT OR IGNORE INTO category_closure (user_id, ancestor, descendant, depth) 
+                           VALUES (?, ?, ?, 0)""",
+                        (user_id, name, name)
+                    )
             
-            # Confirm deletion
-            confirm = input(f"Are you sure you want to delete transaction #{transaction_id}? (y/n): ").strip().lower()
-            if confirm != 'y':
-                print("Deletion cancelled.")
-                return
+            if parent:
+                cursor.execute(
+                    "SELECT 1 FROM category_closure WHERE user_id = ? AND ancestor = ? AND descendant = ?",
+                    (user_id, category, parent)
+                )
+                if cursor.fetchone():
+                    print(f"{parent} is {category} or one of its subcategories.")
+                    return False
             
-            # Delete the transaction
-            cursor.execute("DELETE FROM transactions WHERE id = ?", (transaction_id,))
+            subtree = "SELECT descendant FROM category_closure WHERE user_id = ? AND ancestor = ?"
+            cursor.execute(
+                f"""DELETE FROM category_closure 
+                    WHERE user_id = ? AND descendant IN ({subtree}) AND ancestor NOT IN ({subtree})""",
+                (user_id, user_id, category, user_id, category)
+            )
+            if parent:
+                cursor.execute(
+                    """INSERT INTO category_closure (user_id, ancestor, descendant, depth) 
+                       SELECT a.user_id, a.ancestor, d.descendant, a.depth + d.depth + 1 
+                       FROM category_closure a JOIN category_closure d ON d.user_id = a.user_id 
+                       WHERE a.user_id = ? AND a.descendant = ? AND d.ancestor = ?""",
+                    (user_id, parent, category)
+                )
+                cursor.execute(
+                    "INSERT OR REPLACE INTO category_parents (user_id, category, parent) VALUES (?, ?, ?)",
+                    (user_id, category, parent)
+                )
+            else:
+                cursor.execute(
+                    "DELETE FROM category_parents WHERE user_id = ? AND category = ?",
+                    (user_id, category)
+                )
             if not self.conn:
                 conn.commit()
-            print("\n✓ Transaction deleted successfully!")
-            
+            print(f"\n✓ {category} is now " + (f"under {parent}" if parent else "a top-level category"))
+            return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+            return False
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def set_budget(self):
-        """Set or update budget for a category."""
+    def _category_parents(self, cursor):
+        """Return ``{category: parent}`` for the current user's subcategories."""
+        cursor.execute(
+            "SELECT category, parent FROM category_parents WHERE user_id = ?",
+            (self.current_user["id"],)
+        )
+        return dict(cursor.fetchall())
+    
+    def manage_category_rules(self):
+        """List, add and delete automatic categorization rules."""
         if not self.current_user:
             print("Please log in first.")
             return
-            
-        print("\n=== Set Budget ===")
         
-        # Get month and year
-        current_month = datetime.now().month
-        current_year = datetime.now().year
+        print("\n=== Categorization Rules ===")
+        print("Imported transactions without a category, and new ones you add, get the category of the "
+              "highest priority matching rule.")
         
-        while True:
-            try:
-                month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
-                month = int(month_input) if month_input else current_month
-                
-                if not 1 <= month <= 12:
-                    print("Month must be between 1 and 12.")
-                    continue
-                
-                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                year = int(year_input) if year_input else current_year
-                
-                if year < 2000 or year > 2100:
-                    print("Please enter a valid year between 2000 and 2100.")
-                    continue
-                
-                break
-            except ValueError:
-                print("Please enter a valid number.")
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """SELECT id, priority, kind, pattern, min_amount, max_amount, transaction_type, category 
+                   FROM category_rules WHERE user_id = ? ORDER BY priority DESC, id""",
+                (self.current_user["id"],)
+            )
+            rules = cursor.fetchall()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        finally:
+            self._release(conn)
         
-        # Show expense categories
-        categories = self.get_categories("expense")
-        print("\nExpense Categories:")
-        for i, category in enumerate(categories, 1):
-            print(f"{i}. {category}")
-        print(f"{len(categories) + 1}. Other (create new)")
+        if rules:
+            rows = []
+            for rule_id, priority, kind, pattern, low, high, transaction_type, category in rules:
+                if kind == "amount":
+                    low = "" if low is None else self._money(low)
+                    high = "" if high is None else self._money(high)
+                    condition = f"amount {low}..{high}"
+                else:
+                    condition = f"{kind} {pattern}"
+                rows.append([rule_id, priority, condition, transaction_type or "any", category])
+            print_table(rows, ["ID", "Priority", "Match", "Type", "Category"])
+        else:
+            print("No rules yet.")
         
-        # Get category
-        while True:
+        print("\n1. Add a rule")
+        print("2. Delete a rule")
+        print(f"3. Categorize transactions in a category (e.g. {DEFAULT_IMPORT_CATEGORY}) by the rules")
+        choice = input("\nSelect an option (1-3): ").strip()
+        
+        if choice == "1":
+            kind = input("Match on (keyword/regex/amount): ").strip().lower()
+            if kind not in RULE_KINDS:
+                print("Invalid choice.")
+                return
+            pattern = low = high = None
+            if kind == "amount":
+                try:
+                    low = input("Minimum amount (leave empty for none): ").strip()
+                    high = input("Maximum amount (leave empty for none): ").strip()
+                    low = parse_amount(low) if low else None
+                    high = parse_amount(high) if high else None
+                except ValueError:
+                    print("Invalid amount. Please enter a number.")
+                    return
+            else:
+                pattern = input("Description keyword: " if kind == "keyword" else "Regular expression: ").strip()
+            category = input("Category: ").strip().title()
+            transaction_type = input("Transaction type (income/expense, leave empty for any): ").strip().lower()
             try:
-                choice = int(input("\nSelect category number: "))
-                if 1 <= choice <= len(categories):
-                    category = categories[choice - 1]
-                    break
-                elif choice == len(categories) + 1:
-                    category = input("Enter new category name: ").strip().title()
-                    if not category:
-                        print("Category cannot be empty.")
-                        continue
-                    break
-                else:
-                    print("Invalid choice.")
+                priority = int(input("Priority (higher wins, leave empty for 0): ").strip() or 0)
             except ValueError:
                 print("Please enter a number.")
-        
-        # Get budget amount
-        while True:
+                return
+            self.add_category_rule(kind, pattern, category, priority, transaction_type or None, low, high)
+        elif choice == "2":
             try:
-                amount = float(input(f"Budget amount for {category} (${month}/{year}): $").strip())
-                if amount <= 0:
-                    print("Budget amount must be greater than zero.")
-                    continue
-                break
+                rule_id = int(input("Rule ID: ").strip())
             except ValueError:
-                print("Invalid amount. Please enter a number.")
+                print("Please enter a number.")
+                return
+            self.delete_category_rule(rule_id)
+        elif choice == "3":
+            category = input(f"Category to recategorize (leave empty for {DEFAULT_IMPORT_CATEGORY}): ").strip().title()
+            try:
+                count = self.apply_category_rules(category or DEFAULT_IMPORT_CATEGORY)
+                print(f"\n✓ Recategorized {count} transaction(s).")
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+        else:
+            print("Invalid choice.")
+    
+    def add_category_rule(self, kind, pattern, category, priority=0, transaction_type=None,
+                          min_amount=None, max_amount=None):
+        """Add a categorization rule for the current user; return its ID, or None if invalid."""
+        if kind not in RULE_KINDS:
+            print(f"Unknown rule kind '{kind}'.")
+            return None
+        if not category:
+            print("Category cannot be empty.")
+            return None
+        if transaction_type not in (None, "income", "expense"):
+            print("Invalid type. Please enter 'income' or 'expense'.")
+            return None
+        if kind == "amount":
+            pattern = None
+            if min_amount is None and max_amount is None:
+                print("An amount rule needs a minimum or a maximum.")
+                return None
+            if min_amount is not None and max_amount is not None and min_amount > max_amount:
+                print("The minimum cannot be above the maximum.")
+                return None
+        else:
+            min_amount = max_amount = None
+            if not pattern:
+                print("Pattern cannot be empty.")
+                return None
+        if kind == "regex":
+            try:
+                # Most rules are compiled as one alternation, so check the pattern in that form too
+                CategoryMatcher([(category, kind, pattern, None, None, None)] * 2)
+            except re.error as e:
+                print(f"Invalid regular expression: {e}")
+                return None
         
-        # Set or update budget in database
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
+        conn = self._write_connection()
         cursor = conn.cursor()
-        
         try:
             cursor.execute(
-                """INSERT OR REPLACE INTO budgets 
-                   (user_id, category, amount, month, year) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                (self.current_user["id"], category, amount, month, year)
+                """INSERT INTO category_rules 
+                   (user_id, kind, pattern, min_amount, max_amount, transaction_type, category, priority) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (self.current_user["id"], kind, pattern, min_amount, max_amount, transaction_type, category,
+                 priority)
             )
             if not self.conn:
                 conn.commit()
-            print(f"\n✓ Budget for {category} (${month}/{year}) set to ${amount:.2f}")
+            print(f"\n✓ Rule added: {kind} → {category}")
+            return cursor.lastrowid
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+            return None
         finally:
+            self._release(conn)
+    
+    def delete_category_rule(self, rule_id):
+        """Delete one of the current user's categorization rules; return whether it existed."""
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM category_rules WHERE id = ? AND user_id = ?",
+                           (rule_id, self.current_user["id"]))
+            if not cursor.rowcount:
+                print("Rule not found.")
+                return False
             if not self.conn:
-                conn.close()
+                conn.commit()
+            print("\n✓ Rule deleted.")
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+        finally:
+            self._release(conn)
     
-    def check_budget_limit(self, category, amount, date_str):
-        """Check if a transaction exceeds the budget limit."""
-        if not self.current_user:
-            return
+    def _category_matcher(self, cursor):
+        """Return the current user's rules as a CategoryMatcher, or None without rules.
+
+        Compiled matchers are cached until the user's rule set changes.
+        """
+        user_id = self.current_user["id"]
+        cursor.execute("SELECT COUNT(*), MAX(id) FROM category_rules WHERE user_id = ?", (user_id,))
+        version = cursor.fetchone()
+        cached = self._category_matchers.get(user_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        
+        matcher = None
+        if version[0]:
+            cursor.execute(
+                """SELECT category, kind, pattern, min_amount, max_amount, transaction_type 
+                   FROM category_rules WHERE user_id = ? ORDER BY priority DESC, id""",
+                (user_id,)
+            )
+            matcher = CategoryMatcher(cursor.fetchall())
+        self._category_matchers[user_id] = (version, matcher)
+        return matcher
+    
+    def _suggest_category(self, description, amount, transaction_type):
+        """Return the category the current user's rules give a transaction, or None."""
+        conn = self._read_connection(timed=False)
+        try:
+            matcher = self._category_matcher(conn.cursor())
+        finally:
+            self._release(conn)
+        return matcher.match(description, amount, transaction_type) if matcher else None
+    
+    @timed("apply_category_rules")
+    def apply_category_rules(self, category=DEFAULT_IMPORT_CATEGORY):
+        """Recategorize the current user's transactions in ``category`` by the rules.
+
+        Transactions no rule matches keep their category. The changed rows
+        are written with one ``executemany`` and the running daily totals
+        rebuilt once afterwards. Returns the number of transactions changed.
+        """
+        user_id = self.current_user["id"]
+        conn = self._write_connection()
+        cursor = conn.cursor()
+        try:
+            matcher = self._category_matcher(cursor)
+            if matcher is None:
+                return 0
+            cursor.execute(
+                "SELECT id, description, amount, type FROM transactions WHERE user_id = ? AND category = ?",
+                (user_id, category)
+            )
+            changes = []
+            for transaction_id, description, amount, transaction_type in cursor.fetchall():
+                new_category = matcher.match(description, amount, transaction_type)
+                if new_category and new_category != category:
+                    changes.append((new_category, transaction_id))
+            if not changes:
+                return 0
             
-        # Parse transaction date
-        date = datetime.strptime(date_str, "%Y-%m-%d")
-        month = date.month
-        year = date.year
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilding_balances', '1')")
+            cursor.executemany("UPDATE transactions SET category = ? WHERE id = ?", changes)
+            cursor.execute("DELETE FROM meta WHERE key = 'rebuilding_balances'")
+            self._rebuild_daily_balances(cursor, user_id)
+            if not self.conn:
+                conn.commit()
+            return len(changes)
+        finally:
+            self._release(conn)
+    
+    @timed("report_monthly")
+    def _generate_monthly_report(self, month=None, year=None):
+        """Generate a monthly financial report."""
+        # Get month and year
+        if month is None or year is None:
+            month, year = self._prompt_month_year()
+        
+        month_name = datetime(year, month, 1).strftime("%B")
+        print(f"\n=== Monthly Financial Report: {month_name} {year} ===")
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
+        conn = self._read_connection()
         cursor = conn.cursor()
         
         try:
-            # Get budget for the category and month/year
-            cursor.execute(
-                """SELECT amount FROM budgets 
-                   WHERE user_id = ? AND category = ? AND month = ? AND year = ?""",
-                (self.current_user["id"], category, month, year)
+            # Sum the month's transactions per category and date in the base currency
+            rates = self._rates(conn.cursor())
+            first_day, end_day = month_days(year, month)
+            sums = self._converted_sums(
+                cursor,
+                "day_num >= ? AND day_num < ?",
+                [first_day, end_day],
+                group_by=["category", "day_num"],
+                rates=rates,
+                source=self._history_source(cursor, first_day)
             )
-            budget = cursor.fetchone()
             
-            if not budget:
-                return  # No budget set for this category
+            # Calculate summary statistics and group by category and day
+            totals = PeriodTotals(month_name)
+            income_by_category = {}
+            expense_by_category = {}
+            daily = {}
             
-            budget_amount = budget[0]
+            for (category, day_num, transaction_type), amount in sums.items():
+                totals.add(transaction_type, amount)
+                by_category = income_by_category if transaction_type == "income" else expense_by_category
+                by_category[category] = by_category.get(category, 0) + amount
+                
+                day = day_num - first_day + 1
+                if day not in daily:
+                    daily[day] = PeriodTotals(day)
+                daily[day].add(transaction_type, amount)
             
-            # Calculate total spent in this category for the month
-            cursor.execute(
-                """SELECT SUM(amount) FROM transactions 
-                   WHERE user_id = ? AND type = 'expense' AND category = ? 
-                   AND strftime('%m', date) = ? AND strftime('%Y', date) = ?""",
-                (self.current_user["id"], category, f"{month:02d}", str(year))
-            )
+            if not daily:
+                print(f"No transactions found for {month_name} {year}.")
+                return
             
-            total_spent = cursor.fetchone()[0] or 0
-            
-            # Check if budget is exceeded
-            if total_spent > budget_amount:
-                print(f"\n⚠️ Warning: You have exceeded your budget for {category} in {month}/{year}!")
-                print(f"Budget: ${budget_amount:.2f}")
-                print(f"Spent: ${total_spent:.2f}")
-                print(f"Over budget by: ${(total_spent - budget_amount):.2f}")
-            elif total_spent >= budget_amount * 0.8:
-                remaining = budget_amount - total_spent
-                print(f"\n⚠️ Warning: You are approaching your budget limit for {category} in {month}/{year}!")
-                print(f"Budget: ${budget_amount:.2f}")
-                print(f"Spent: ${total_spent:.2f}")
-                print(f"Remaining: ${remaining:.2f} ({(remaining/budget_amount)*100:.1f}% left)")
+            # Display summary
+            print(f"\nSummary:")
+            print(f"Total Income: {self._money(totals.income)}")
+            print(f"Total Expenses: {self._money(totals.expense)}")
+            print(f"Net Savings: {self._money(totals.net)}")
+            
+            if totals.savings_rate is not None:
+                print(f"Savings Rate: {format_percent(totals.savings_rate)}")
+            
+            # Display income breakdown
+            if income_by_category:
+                print("\nIncome Breakdown:")
+                income_table = category_share_rows(income_by_category, totals.income, currency=self._base_currency())
+                print_table(income_table, ["Category", "Amount", "% of Income"])
+            
+            # Display expense breakdown
+            if expense_by_category:
+                print("\nExpense Breakdown:")
+                expense_table = category_share_rows(expense_by_category, totals.expense, currency=self._base_currency())
+                print_table(expense_table, ["Category", "Amount", "% of Expenses"])
+            
+            # Check against budgets
+            statuses = self._budget_statuses(cursor, month, year, rates)
+            
+            if statuses:
+                print("\nBudget Performance:")
+                budget_table = []
+                
+                for status in statuses:
+                    percentage = status.percentage
+                    if percentage is None:
+                        status_label = "N/A"
+                    else:
+                        status_label = "🔴 OVER" if percentage > 100 else "🟠 CLOSE" if percentage >= 80 else "🟢 OK"
+                    
+                    budget_table.append([
+                        status.category,
+                        self._money(status.budget),
+                        self._money(status.spent),
+                        self._money(status.remaining),
+                        format_percent(percentage or 0),
+                        status_label
+                    ])
+                
+                print_table(budget_table, ["Category", "Budget", "Spent", "Remaining", "Used", "Status"])
+        
         except sqlite3.Error as e:
-            print(f"Database error when checking budget: {e}")
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def view_budgets(self):
-        """View all budgets for the current user."""
-        if not self.current_user:
-            print("Please log in first.")
-            return
+    def _monthly_totals(self, cursor, year, rates=None):
+        """Return twelve PeriodTotals (Jan..Dec) for the given year."""
+        months = [PeriodTotals(datetime(year, i, 1).strftime("%b")) for i in range(1, 13)]
+        starts = month_starts(year, year)
+        sums = self._snapshot_sums(cursor, starts[0], month_days(year, 12)[1], ["day_num"], rates)
+        if sums is None:
+            sums = self._converted_sums(
+                cursor,
+                "day_num >= ? AND day_num < ?",
+                [starts[0], month_days(year, 12)[1]],
+                group_by=["day_num"],
+                rates=rates,
+                source=MONTHLY_ROWS
+            )
+        for (day, transaction_type), total in sums.items():
+            months[bisect_right(starts, day) - 1].add(transaction_type, total)
+        return months
+    
+    def _category_totals(self, cursor, where, params, rates=None, source="transactions", rollup=False):
+        """Return CategoryTotal records for transactions matching ``where``.
+
+        With ``rollup`` each category's total includes all its subcategories.
+        """
+        if rollup:
+            source = subtree_rows(source)
+        sums = self._converted_sums(cursor, where, params, group_by=["category"], rates=rates, source=source)
+        records = [CategoryTotal(transaction_type, category, total)
+                   for (category, transaction_type), total in sums.items()]
+        records.sort(key=lambda r: (r.type, -r.total))
+        return records
+
+    def _range_totals(self, cursor, first_day, last_day, by_category=False, rollup=False):
+        """Return ``{(category, type): total}`` for days ``first_day``..``last_day``
+        from ``daily_balances``, or None if that cannot answer exactly.
+
+        Each total is the running total at the end of the range minus the one
+        before it, two index lookups per category and currency however wide
+        the range is. Without ``by_category`` the category is '' (all of them);
+        with ``rollup`` categories include their subcategories. Ranges reaching
+        into archived history, or holding amounts in other currencies than the
+        base one (which convert at each day's rate), give None, and callers
+        fall back to summing rows.
+        """
+        if self._history_source(cursor, first_day) != "transactions":
+            return None
+
+        def running(column, day):
+            return f"""COALESCE((SELECT {column} FROM daily_balances b
+                WHERE b.user_id = k.user_id AND b.category = k.category AND b.currency = k.currency
+                  AND b.day_num <= {day} ORDER BY b.day_num DESC LIMIT 1), 0)"""
+
+        if by_category and rollup:
+            category, source = "c.ancestor", """daily_balance_keys k JOIN category_closure c
+                ON c.user_id = k.user_id AND c.descendant = k.category"""
+        else:
+            category, source = "k.category", "daily_balance_keys k"
+        cursor.execute(
+            f"""SELECT {category}, k.currency,
+                       SUM({running("income", ":last")} - {running("income", ":first")}),
+                       SUM({running("expense", ":last")} - {running("expense", ":first")})
+                FROM {source}
+                WHERE k.user_id = :user AND {"k.category != ''" if by_category else "k.category = ''"}
+                GROUP BY 1, 2""",
+            {"user": self.current_user["id"], "first": first_day - 1, "last": last_day}
+        )
+
+        base = self._base_currency()
+        totals = {}
+        for category, currency, income, expense in cursor.fetchall():
+            for transaction_type, total in (("income", income), ("expense", expense)):
+                # Running totals are floats, so "nothing in range" may not be exactly 0
+                if abs(total) < 0.005:
+                    continue
+                if currency != base:
+                    return None
+                totals[(category, transaction_type)] = total
+        return totals
+
+    @timed("report_yearly")
+    def _generate_yearly_report(self, year=None):
+        """Generate a yearly financial report."""
+        # Get year
+        if year is None:
+            year = self._prompt_year()
+        
+        print(f"\n=== Yearly Financial Report: {year} ===")
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Group transactions by month and by category
+            months = self._monthly_totals(cursor, year)
+            categories = self._category_totals(
+                cursor, "day_num >= ? AND day_num < ?", [month_days(year, 1)[0], month_days(year, 12)[1]],
+                source=MONTHLY_ROWS
+            )
             
-        print("\n=== View Budgets ===")
+            if not categories:
+                print(f"No transactions found for {year}.")
+                return
+            
+            totals = PeriodTotals(year)
+            income_by_category = {}
+            expense_by_category = {}
+            for record in categories:
+                totals.add(record.type, record.total)
+                by_category = income_by_category if record.type == "income" else expense_by_category
+                by_category[record.category] = record.total
+            
+            # Display summary
+            print(f"\nSummary for {year}:")
+            print(f"Total Income: {self._money(totals.income)}")
+            print(f"Total Expenses: {self._money(totals.expense)}")
+            print(f"Net Savings: {self._money(totals.net)}")
+            
+            if totals.savings_rate is not None:
+                print(f"Savings Rate: {format_percent(totals.savings_rate)}")
+                
+            # Monthly breakdown
+            print("\nMonthly Breakdown:")
+            monthly_table = [
+                [
+                    m.label,
+                    self._money(m.income),
+                    self._money(m.expense),
+                    self._money(m.net),
+                    format_percent(m.savings_rate)
+                ]
+                for m in months if m.has_data
+            ]
+            
+            print_table(monthly_table, ["Month", "Income", "Expenses", "Net Savings", "Savings Rate"])
+            
+            # Top income sources
+            if income_by_category:
+                print("\nTop Income Sources:")
+                income_table = category_share_rows(income_by_category, totals.income, limit=5, currency=self._base_currency())
+                print_table(income_table, ["Category", "Amount", "% of Income"])
+            
+            # Top expense categories
+            if expense_by_category:
+                print("\nTop Expense Categories:")
+                expense_table = category_share_rows(expense_by_category, totals.expense, limit=5, currency=self._base_currency())
+                print_table(expense_table, ["Category", "Amount", "% of Expenses"])
         
-        # Get month and year filter
-        current_month = datetime.now().month
-        current_year = datetime.now().year
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("report_category_breakdown")
+    def _generate_category_breakdown(self, start_date=None, end_date=None, transaction_type=None):
+        """Generate a report breaking down transactions by category."""
+        print("\n=== Category Breakdown Report ===")
         
-        while True:
+        # Get date range
+        while start_date is None:
             try:
-                month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
-                month = int(month_input) if month_input else current_month
-                
-                if not 1 <= month <= 12:
-                    print("Month must be between 1 and 12.")
-                    continue
-                
-                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                year = int(year_input) if year_input else current_year
-                
-                if year < 2000 or year > 2100:
-                    print("Please enter a valid year between 2000 and 2100.")
+                start_date = input("Start date (YYYY-MM-DD): ").strip()
+                if not start_date:
+                    print("Start date is required.")
+                    start_date = None
                     continue
+                    
+                datetime.strptime(start_date, "%Y-%m-%d")  # Validate format
                 
-                break
+                end_date = input("End date (YYYY-MM-DD, leave empty for today): ").strip()
+                if end_date:
+                    datetime.strptime(end_date, "%Y-%m-%d")  # Validate format
             except ValueError:
-                print("Please enter a valid number.")
+                print("Invalid date format. Please use YYYY-MM-DD.")
+                start_date = None
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        if not end_date:
+            end_date = datetime.now().strftime("%Y-%m-%d")
+        
+        # Get transaction type
+        while transaction_type not in ["income", "expense", "both"]:
+            transaction_type = input("Transaction type (income/expense/both): ").strip().lower()
+            if transaction_type not in ["income", "expense", "both"]:
+                print("Invalid type. Please enter 'income', 'expense', or 'both'.")
+        
+        conn = self._read_connection()
         cursor = conn.cursor()
         
         try:
-            # Get all budgets for the month/year
-            cursor.execute(
-                """SELECT category, amount FROM budgets 
-                   WHERE user_id = ? AND month = ? AND year = ?""",
-                (self.current_user["id"], month, year)
-            )
-            budgets = cursor.fetchall()
-            
-            if not budgets:
-                print(f"No budgets found for {month}/{year}.")
-                return
-            
-            # Get actual spending for each budget category
-            spending_data = {}
-            for budget in budgets:
-                category = budget["category"]
-                
-                cursor.execute(
-                    """SELECT COALESCE(SUM(amount), 0) as total FROM transactions 
-                       WHERE user_id = ? AND type = 'expense' AND category = ? 
-                       AND strftime('%m', date) = ? AND strftime('%Y', date) = ?""",
-                    (self.current_user["id"], category, f"{month:02d}", str(year))
-                )
-                
-                total_spent = cursor.fetchone()[0] or 0
-                spending_data[category] = total_spent
-            
-            # Display budget information
-            headers = ["Category", "Budget", "Spent", "Remaining", "Progress"]
-            table_data = []
-            
-            for budget in budgets:
-                category = budget["category"]
-                budget_amount = budget["amount"]
-                spent = spending_data.get(category, 0)
-                remaining = budget_amount - spent
+            # Range totals come from the running daily totals where possible
+            first_day, last_day = epoch_day(start_date), epoch_day(end_date)
+            totals = self._range_totals(cursor, first_day, last_day, by_category=True, rollup=True)
+            if totals is not None:
+                results = [CategoryTotal(t, category, total) for (category, t), total in totals.items()
+                           if transaction_type in ("both", t)]
+            else:
+                # Build query based on filters
+                where = "day_num BETWEEN ? AND ?"
+                params = [first_day, last_day]
                 
-                # Calculate percentage and create progress bar
-                if budget_amount > 0:
-                    percentage = (spent / budget_amount) * 100
-                    if percentage > 100:
-                        progress = "🔴 {:5.1f}% (OVER!)".format(percentage)
-                    elif percentage >= 80:
-                        progress = "🟠 {:5.1f}%".format(percentage)
-                    else:
-                        progress = "🟢 {:5.1f}%".format(percentage)
-                else:
-                    progress = "N/A"
+                if transaction_type != "both":
+                    where += " AND type = ?"
+                    params.append(transaction_type)
                 
-                table_data.append([
-                    category,
-                    f"${budget_amount:.2f}",
-                    f"${spent:.2f}",
-                    f"${remaining:.2f}",
-                    progress
-                ])
+                results = self._category_totals(cursor, where, params, source=self._history_source(cursor, first_day),
+                                                rollup=True)
             
-            # Sort by percentage spent (descending)
-            table_data.sort(key=lambda x: float(x[2].replace('$', '')), reverse=True)
+            if not results:
+                print(f"No transactions found for the selected period and filters.")
+                return
             
-            # Display budgets
-            print(f"\nBudgets for {month}/{year}:")
-            print(tabulate(table_data, headers=headers, tablefmt="pretty"))
+            # Split results; totals are subtree totals, so only top-level
+            # categories add up to the grand total
+            parents = self._category_parents(cursor)
+            income_categories = {r.category: r.total for r in results if r.type == "income"}
+            expense_categories = {r.category: r.total for r in results if r.type == "expense"}
+            income_total = sum(t for c, t in income_categories.items() if parents.get(c) not in income_categories)
+            expense_total = sum(t for c, t in expense_categories.items() if parents.get(c) not in expense_categories)
             
-            # Show summary
-            total_budget = sum(b["amount"] for b in budgets)
-            total_spent = sum(spending_data.values())
-            total_remaining = total_budget - total_spent
+            # Display income categories
+            if income_categories and (transaction_type == "income" or transaction_type == "both"):
+                print(f"\nIncome Categories ({start_date} to {end_date}):")
+                income_table = category_share_rows(category_paths(parents, income_categories), income_total,
+                                                   currency=self._base_currency(), sort=False)
+                print_table(income_table, ["Category", "Amount", "% of Total"])
+                print(f"Total Income: {self._money(income_total)}")
             
-            print(f"\nSummary:")
-            print(f"Total Budget: ${total_budget:.2f}")
-            print(f"Total Spent: ${total_spent:.2f}")
-            print(f"Total Remaining: ${total_remaining:.2f}")
-            if total_budget > 0:
-                print(f"Overall Progress: {(total_spent / total_budget) * 100:.1f}%")
+            # Display expense categories
+            if expense_categories and (transaction_type == "expense" or transaction_type == "both"):
+                print(f"\nExpense Categories ({start_date} to {end_date}):")
+                expense_table = category_share_rows(category_paths(parents, expense_categories), expense_total,
+                                                    currency=self._base_currency(), sort=False)
+                print_table(expense_table, ["Category", "Amount", "% of Total"])
+                print(f"Total Expenses: {self._money(expense_total)}")
             
+            # Show summary if both types are displayed
+            if transaction_type == "both" and income_categories and expense_categories:
+                totals = PeriodTotals("range", income_total, expense_total)
+                
+                print(f"\nSummary:")
+                print(f"Total Income: {self._money(totals.income)}")
+                print(f"Total Expenses: {self._money(totals.expense)}")
+                print(f"Net Savings: {self._money(totals.net)}")
+                print(f"Savings Rate: {format_percent(totals.savings_rate or 0)}")
+        
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def generate_report(self):
-        """Generate financial reports for the user."""
-        if not self.current_user:
-            print("Please log in first.")
-            return
-            
-        print("\n=== Generate Financial Report ===")
-        print("1. Monthly Report")
-        print("2. Yearly Report")
-        print("3. Category Breakdown")
-        print("4. Income vs Expense Trend")
+    @timed("report_year_over_year")
+    def _generate_yoy_report(self, years=None, transaction_type=None):
+        """Compare several years month by month and category by category."""
+        print("\n=== Year-over-Year Comparison ===")
         
-        choice = input("\nSelect report type (1-4): ").strip()
-        
-        if choice == "1":
-            self._generate_monthly_report()
-        elif choice == "2":
-            self._generate_yearly_report()
-        elif choice == "3":
-            self._generate_category_breakdown()
-        elif choice == "4":
-            self._generate_trend_report()
-        else:
-            print("Invalid choice.")
-    
-    def backup_data(self):
-        """Create a backup of the database."""
-        if not self.current_user:
-            print("Please log in first.")
-            return
-            
-        print("\n=== Backup Data ===")
+        current_year = datetime.now().year
+        while not years:
+            years_input = input(
+                f"Years to compare (e.g. 2023-{current_year} or 2022,2024; "
+                f"leave empty for {current_year - 1}-{current_year}): "
+            ).strip()
+            years = self._parse_years(years_input) if years_input else [current_year - 1, current_year]
+            if not years:
+                print("Please enter years between 2000 and 2100, e.g. 2023-2025.")
+        years = sorted(set(years))
         
-        # Create backup directory if it doesn't exist
-        backup_dir = "backups"
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
+        while transaction_type not in ["income", "expense"]:
+            transaction_type = input("Transaction type (income/expense, leave empty for expense): ").strip().lower() \
+                or "expense"
+            if transaction_type not in ["income", "expense"]:
+                print("Invalid type. Please enter 'income' or 'expense'.")
         
-        # Generate backup filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = f"{backup_dir}/finance_backup_{self.current_user['username']}_{timestamp}.db"
+        conn = self._read_connection()
+        cursor = conn.cursor()
         
         try:
-            # Connect to existing database
-            conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-            
-            # Back up the database
-            with open(backup_file, 'wb') as f:
-                for line in conn.iterdump():
-                    f.write(f'{line}\n'.encode('utf-8'))
+            totals = self._yearly_comparison(cursor, years)
             
-            if not self.conn:
-                conn.close()
-            print(f"\n✓ Backup created successfully: {backup_file}")
+            by_month = {}
+            by_category = {}
+            for (year, month, category, kind), total in totals.items():
+                if kind != transaction_type:
+                    continue
+                by_month[(month, year)] = by_month.get((month, year), 0) + total
+                by_category[(category, year)] = by_category.get((category, year), 0) + total
             
-        except Exception as e:
-            print(f"Error creating backup: {e}")
-    
-    def restore_data(self):
-        """Restore data from a backup file."""
-        if not self.current_user:
-            print("Please log in first.")
-            return
+            if not by_month:
+                print(f"No {transaction_type} transactions found for {years[0]}-{years[-1]}.")
+                return
             
-        print("\n=== Restore Data ===")
-        
-        # Check if backup directory exists
-        backup_dir = "backups"
-        if not os.path.exists(backup_dir):
-            print("No backups found.")
-            return
-        
-        # List available backups for the current user
-        backups = [f for f in os.listdir(backup_dir) if f.startswith(f"finance_backup_{self.current_user['username']}_")]
-        
-        if not backups:
-            print(f"No backups found for {self.current_user['username']}.")
-            return
-        
-        # Display available backups
-        print("\nAvailable backups:")
-        for i, backup in enumerate(backups, 1):
-            # Extract timestamp from filename
-            timestamp = backup.split('_')[-1].split('.')[0]
-            try:
-                backup_time = datetime.strptime(timestamp, "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                backup_time = "Unknown date"
-                
-            print(f"{i}. {backup} ({backup_time})")
-        
-        # Get user selection
-        while True:
-            try:
-                choice = int(input("\nSelect backup to restore (0 to cancel): "))
-                if choice == 0:
-                    return
-                if 1 <= choice <= len(backups):
-                    selected_backup = f"{backup_dir}/{backups[choice-1]}"
-                    break
-                print("Invalid choice.")
-            except ValueError:
-                print("Please enter a number.")
-        
-        # Confirm restoration
-        confirm = input(f"\n⚠️ Warning: This will replace your current data with the backup.\nAre you sure? (y/n): ").strip().lower()
-        if confirm != 'y':
-            print("Restoration cancelled.")
-            return
-        
-        try:
-            # Close current database connection
-            if not self.conn:
-                conn = sqlite3.connect(self.db_file)
-                conn.close()
+            latest = years[-1]
+            previous = years[-2] if len(years) > 1 else None
+            headers = [str(y) for y in years]
+            if previous:
+                headers += [f"Change vs {previous}", "Change %"]
             
-            # Create a temporary database file
-            temp_db = f"temp_restore_{timestamp}.db"
-            conn = sqlite3.connect(temp_db)
-            cursor = conn.cursor()
+            def comparison_row(label, values):
+                row = [label] + [self._money(values.get(y, 0)) for y in years]
+                if previous:
+                    change = values.get(latest, 0) - values.get(previous, 0)
+                    base = values.get(previous, 0)
+                    row += [self._money(change, signed=True),
+                            format_percent((change / base) * 100 if base > 0 else None)]
+                return row
             
-            # Read and execute SQL commands from backup file
-            with open(selected_backup, 'r', encoding='utf-8') as f:
-                sql_script = f.read()
-                cursor.executescript(sql_script)
+            # Month by month
+            month_table = []
+            for month in range(1, 13):
+                values = {y: by_month[(month, y)] for y in years if (month, y) in by_month}
+                if values:
+                    month_table.append(comparison_row(datetime(2000, month, 1).strftime("%b"), values))
             
-            conn.commit()
-            conn.close()
+            print(f"\nMonthly {transaction_type.title()}s:")
+            print_table(month_table, ["Month"] + headers)
             
-            # Replace the current database with the restored one
-            os.remove(self.db_file)
-            os.rename(temp_db, self.db_file)
+            # Category by category, largest in the latest year first
+            categories = {}
+            for (category, year), total in by_category.items():
+                categories.setdefault(category, {})[year] = total
+            ranked = sorted(categories.items(), key=lambda x: x[1].get(latest, 0), reverse=True)
             
-            print(f"\n✓ Database restored successfully from {selected_backup}")
+            print(f"\n{transaction_type.title()}s by Category:")
+            print_table([comparison_row(category, values) for category, values in ranked], ["Category"] + headers)
             
-        except Exception as e:
-            print(f"Error restoring backup: {e}")
-            if os.path.exists(temp_db):
-                os.remove(temp_db)
-    
-    def _generate_monthly_report(self):
-        """Generate a monthly financial report."""
-        # Get month and year
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-        
-        while True:
-            try:
-                month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
-                month = int(month_input) if month_input else current_month
-                
-                if not 1 <= month <= 12:
-                    print("Month must be between 1 and 12.")
-                    continue
-                
-                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                year = int(year_input) if year_input else current_year
-                
-                if year < 2000 or year > 2100:
-                    print("Please enter a valid year between 2000 and 2100.")
-                    continue
-                
-                break
-            except ValueError:
-                print("Please enter a valid number.")
+            # Yearly totals
+            year_totals = {}
+            for (month, year), total in by_month.items():
+                year_totals[year] = year_totals.get(year, 0) + total
+            print(f"\nTotals:")
+            print_table([comparison_row("Year", year_totals)], [""] + headers)
         
-        month_name = datetime(year, month, 1).strftime("%B")
-        print(f"\n=== Monthly Financial Report: {month_name} {year} ===")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("report_unusual_spending")
+    def _generate_anomaly_report(self):
+        """List expenses flagged as unusual for their category when they were added."""
+        print("\n=== Unusual Spending ===")
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        conn = self._read_connection()
         cursor = conn.cursor()
         
         try:
-            # Get all transactions for the month
+            # Only the flagged rows are read, joined back to their transactions
             cursor.execute(
-                """SELECT type, amount, category, date 
-                   FROM transactions 
-                   WHERE user_id = ? 
-                   AND strftime('%m', date) = ? 
-                   AND strftime('%Y', date) = ? 
-                   ORDER BY date""",
-                (self.current_user["id"], f"{month:02d}", str(year))
+                """SELECT t.date, t.category, t.description, t.amount, t.currency, 
+                          a.mean, a.stddev, a.z_score 
+                   FROM anomalies a JOIN transactions t ON t.id = a.transaction_id 
+                   WHERE a.user_id = ? AND t.type = 'expense' 
+                   ORDER BY t.date DESC""",
+                (self.current_user["id"],)
             )
-            transactions = cursor.fetchall()
+            rows = cursor.fetchall()
             
-            if not transactions:
-                print(f"No transactions found for {month_name} {year}.")
+            if not rows:
+                print("No unusual spending has been flagged.")
                 return
             
-            # Calculate summary statistics
-            total_income = sum(t["amount"] for t in transactions if t["type"] == "income")
-            total_expense = sum(t["amount"] for t in transactions if t["type"] == "expense")
-            net_savings = total_income - total_expense
-            
-            # Group transactions by category
-            income_by_category = {}
-            expense_by_category = {}
-            
-            for t in transactions:
-                if t["type"] == "income":
-                    if t["category"] not in income_by_category:
-                        income_by_category[t["category"]] = 0
-                    income_by_category[t["category"]] += t["amount"]
-                else:  # expense
-                    if t["category"] not in expense_by_category:
-                        expense_by_category[t["category"]] = 0
-                    expense_by_category[t["category"]] += t["amount"]
-            
-            # Group transactions by day
-            daily_income = {}
-            daily_expense = {}
-            
-            for t in transactions:
-                day = datetime.strptime(t["date"], "%Y-%m-%d").day
-                if t["type"] == "income":
-                    if day not in daily_income:
-                        daily_income[day] = 0
-                    daily_income[day] += t["amount"]
-                else:  # expense
-                    if day not in daily_expense:
-                        daily_expense[day] = 0
-                    daily_expense[day] += t["amount"]
-            
-            # Display summary
-            print(f"\nSummary:")
-            print(f"Total Income: ${total_income:.2f}")
-            print(f"Total Expenses: ${total_expense:.2f}")
-            print(f"Net Savings: ${net_savings:.2f}")
-            
-            if total_income > 0:
-                savings_rate = (net_savings / total_income) * 100
-                print(f"Savings Rate: {savings_rate:.1f}%")
-            
-            # Display income breakdown
-            if income_by_category:
-                print("\nIncome Breakdown:")
-                income_table = []
-                for category, amount in sorted(income_by_category.items(), key=lambda x: x[1], reverse=True):
-                    percentage = (amount / total_income) * 100 if total_income > 0 else 0
-                    income_table.append([category, f"${amount:.2f}", f"{percentage:.1f}%"])
-                
-                print(tabulate(income_table, headers=["Category", "Amount", "% of Income"], tablefmt="pretty"))
-            
-            # Display expense breakdown
-            if expense_by_category:
-                print("\nExpense Breakdown:")
-                expense_table = []
-                for category, amount in sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True):
-                    percentage = (amount / total_expense) * 100 if total_expense > 0 else 0
-                    expense_table.append([category, f"${amount:.2f}", f"{percentage:.1f}%"])
-                
-                print(tabulate(expense_table, headers=["Category", "Amount", "% of Expenses"], tablefmt="pretty"))
+            table = [
+                [date[:10], category, description if description else "-",
+                 format_money(amount, currency=currency), format_money(mean, currency=currency),
+                 format_money(stddev, currency=currency), f"{z_score:+.1f}"]
+                for date, category, description, amount, currency, mean, stddev, z_score in rows
+            ]
+            print_table(table, ["Date", "Category", "Description", "Amount", "Usual", "Std Dev", "Z-Score"],
+                        truncate=(2,))
+            print(f"\nFlagged at {self.anomaly_threshold:g} standard deviations from the category mean.")
+        
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("report_forecast")
+    def _generate_forecast_report(self, month=None, year=None):
+        """Project month-end spending per budget and the chance of going over."""
+        print("\n=== Month-End Budget Forecast ===")
+        
+        if month is None or year is None:
+            month, year = self._prompt_month_year()
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            forecasts = self._month_end_forecasts(cursor, month, year)
             
-            # Check against budgets
-            cursor.execute(
-                """SELECT category, amount FROM budgets 
-                   WHERE user_id = ? AND month = ? AND year = ?""",
-                (self.current_user["id"], month, year)
-            )
-            budgets = cursor.fetchall()
+            if not forecasts:
+                print(f"No budgets found for {month}/{year}.")
+                return
             
-            if budgets:
-                print("\nBudget Performance:")
-                budget_table = []
-                
-                for budget in budgets:
-                    category = budget["category"]
-                    budget_amount = budget["amount"]
-                    spent = expense_by_category.get(category, 0)
-                    remaining = budget_amount - spent
-                    
-                    if budget_amount > 0:
-                        percentage = (spent / budget_amount) * 100
-                        status = "🔴 OVER" if percentage > 100 else "🟠 CLOSE" if percentage >= 80 else "🟢 OK"
-                    else:
-                        percentage = 0
-                        status = "N/A"
-                    
-                    budget_table.append([
-                        category,
-                        f"${budget_amount:.2f}",
-                        f"${spent:.2f}",
-                        f"${remaining:.2f}",
-                        f"{percentage:.1f}%",
-                        status
-                    ])
-                
-                print(tabulate(
-                    budget_table, 
-                    headers=["Category", "Budget", "Spent", "Remaining", "Used", "Status"], 
-                    tablefmt="pretty"
-                ))
+            table = []
+            for f in sorted(forecasts, key=lambda f: f.chance_over, reverse=True):
+                if f.chance_over >= 50:
+                    outlook = "🔴 Likely over"
+                elif f.chance_over >= 20:
+                    outlook = "🟠 At risk"
+                else:
+                    outlook = "🟢 On track"
+                table.append([
+                    f.category, self._money(f.budget), self._money(f.spent), self._money(f.expected),
+                    self._money(f.p90), format_percent(f.chance_over), outlook
+                ])
+            
+            print(f"\nForecast for {month}/{year}:")
+            print_table(table, ["Category", "Budget", "Spent", "Expected", "90th Pct.", "Chance Over", "Outlook"])
+            print(f"\nBased on {FORECAST_PATHS:,} simulated months resampling your daily spending.")
         
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def _generate_yearly_report(self):
-        """Generate a yearly financial report."""
-        # Get year
-        current_year = datetime.now().year
+    @timed("report_range_totals")
+    def _generate_range_report(self, start_date=None, end_date=None, category=None):
+        """Show income, expenses and net between two dates, optionally for one category."""
+        print("\n=== Totals Between Dates ===")
         
-        while True:
+        while start_date is None:
             try:
-                year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                year = int(year_input) if year_input else current_year
+                start_date = input("Start date (YYYY-MM-DD): ").strip()
+                datetime.strptime(start_date, "%Y-%m-%d")  # Validate format
                 
-                if year < 2000 or year > 2100:
-                    print("Please enter a valid year between 2000 and 2100.")
-                    continue
+                end_date = input("End date (YYYY-MM-DD, leave empty for today): ").strip()
+                if end_date:
+                    datetime.strptime(end_date, "%Y-%m-%d")  # Validate format
                 
-                break
+                category = input("Category (includes subcategories, leave empty for all): ").strip()
             except ValueError:
-                print("Please enter a valid number.")
+                print("Invalid date format. Please use YYYY-MM-DD.")
+                start_date = None
         
-        print(f"\n=== Yearly Financial Report: {year} ===")
+        if not end_date:
+            end_date = datetime.now().strftime("%Y-%m-%d")
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        conn = self._read_connection()
         cursor = conn.cursor()
         
         try:
-            # Get all transactions for the year
-            cursor.execute(
-                """SELECT type, amount, category, strftime('%m', date) as month 
-                   FROM transactions 
-                   WHERE user_id = ? AND strftime('%Y', date) = ? 
-                   ORDER BY date""",
-                (self.current_user["id"], str(year))
-            )
-            transactions = cursor.fetchall()
-            
-            if not transactions:
-                print(f"No transactions found for {year}.")
-                return
-            
-            # Calculate summary statistics
-            total_income = sum(t["amount"] for t in transactions if t["type"] == "income")
-            total_expense = sum(t["amount"] for t in transactions if t["type"] == "expense")
-            net_savings = total_income - total_expense
-            
-            # Group transactions by month
-            monthly_income = {str(i).zfill(2): 0 for i in range(1, 13)}
-            monthly_expense = {str(i).zfill(2): 0 for i in range(1, 13)}
-            
-            for t in transactions:
-                month = t["month"]
-                if t["type"] == "income":
-                    monthly_income[month] += t["amount"]
-                else:  # expense
-                    monthly_expense[month] += t["amount"]
-            
-            # Group transactions by category
-            income_by_category = {}
-            expense_by_category = {}
+            first_day, last_day = epoch_day(start_date), epoch_day(end_date)
+            sums = self._range_totals(cursor, first_day, last_day, by_category=bool(category), rollup=True)
+            if sums is None:
+                where, params = "day_num BETWEEN ? AND ?", [first_day, last_day]
+                source = self._history_source(cursor, first_day)
+                if category:
+                    where += " AND category = ?"
+                    params.append(category)
+                    source = subtree_rows(source)
+                sums = self._converted_sums(cursor, where, params, group_by=["category"], source=source)
             
-            for t in transactions:
-                if t["type"] == "income":
-                    if t["category"] not in income_by_category:
-                        income_by_category[t["category"]] = 0
-                    income_by_category[t["category"]] += t["amount"]
-                else:  # expense
-                    if t["category"] not in expense_by_category:
-                        expense_by_category[t["category"]] = 0
-                    expense_by_category[t["category"]] += t["amount"]
+            totals = PeriodTotals(category or "All categories")
+            for (row_category, transaction_type), total in sums.items():
+                if not category or row_category == category:
+                    totals.add(transaction_type, total)
             
-            # Display summary
-            print(f"\nSummary for {year}:")
-            print(f"Total Income: ${total_income:.2f}")
-            print(f"Total Expenses: ${total_expense:.2f}")
-            print(f"Net Savings: ${net_savings:.2f}")
-            
-            if total_income > 0:
-                savings_rate = (net_savings / total_income) * 100
-                print(f"Savings Rate: {savings_rate:.1f}%")
-                
-            # Monthly breakdown
-            print("\nMonthly Breakdown:")
-            month_names = [datetime(year, i, 1).strftime("%b") for i in range(1, 13)]
-            monthly_table = []
-            
-            for i, month in enumerate(range(1, 13)):
-                month_str = str(month).zfill(2)
-                income = monthly_income[month_str]
-                expense = monthly_expense[month_str]
-                net = income - expense
-                
-                if income > 0 or expense > 0:
-                    savings_rate = (net / income) * 100 if income > 0 else 0
-                    monthly_table.append([
-                        month_names[i],
-                        f"${income:.2f}",
-                        f"${expense:.2f}",
-                        f"${net:.2f}",
-                        f"{savings_rate:.1f}%" if income > 0 else "N/A"
-                    ])
-            
-            print(tabulate(
-                monthly_table, 
-                headers=["Month", "Income", "Expenses", "Net Savings", "Savings Rate"], 
-                tablefmt="pretty"
-            ))
-            
-            # Top income sources
-            if income_by_category:
-                print("\nTop Income Sources:")
-                income_table = []
-                for category, amount in sorted(income_by_category.items(), key=lambda x: x[1], reverse=True)[:5]:
-                    percentage = (amount / total_income) * 100
-                    income_table.append([category, f"${amount:.2f}", f"{percentage:.1f}%"])
-                
-                print(tabulate(income_table, headers=["Category", "Amount", "% of Income"], tablefmt="pretty"))
-            
-            # Top expense categories
-            if expense_by_category:
-                print("\nTop Expense Categories:")
-                expense_table = []
-                for category, amount in sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True)[:5]:
-                    percentage = (amount / total_expense) * 100
-                    expense_table.append([category, f"${amount:.2f}", f"{percentage:.1f}%"])
-                
-                print(tabulate(expense_table, headers=["Category", "Amount", "% of Expenses"], tablefmt="pretty"))
+            print(f"\n{totals.label} ({start_date} to {end_date}):")
+            print(f"Total Income: {self._money(totals.income)}")
+            print(f"Total Expenses: {self._money(totals.expense)}")
+            print(f"Net: {self._money(totals.net, signed=True)}")
         
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
     
-    def _generate_category_breakdown(self):
-        """Generate a report breaking down transactions by category."""
-        print("\n=== Category Breakdown Report ===")
+    @timed("report_tags")
+    def _generate_tag_report(self, expression=None, start_date=None, end_date=None):
+        """Show income, expenses and spending by category between two dates
+        for the transactions matching a tag query, and how often each tag
+        occurs among them."""
+        print("\n=== Tagged Transactions ===")
         
-        # Get date range
-        while True:
+        while expression is None:
             try:
+                expression = input("Tags (e.g. business and not (reimbursable or trip-2026)): ")
                 start_date = input("Start date (YYYY-MM-DD): ").strip()
-                if not start_date:
-                    print("Start date is required.")
-                    continue
-                    
                 datetime.strptime(start_date, "%Y-%m-%d")  # Validate format
                 
                 end_date = input("End date (YYYY-MM-DD, leave empty for today): ").strip()
-                if not end_date:
-                    end_date = datetime.now().strftime("%Y-%m-%d")
-                else:
+                if end_date:
                     datetime.strptime(end_date, "%Y-%m-%d")  # Validate format
-                
-                break
             except ValueError:
                 print("Invalid date format. Please use YYYY-MM-DD.")
+                expression = None
         
-        # Get transaction type
-        while True:
-            transaction_type = input("Transaction type (income/expense/both): ").strip().lower()
-            if transaction_type in ["income", "expense", "both"]:
-                break
-            print("Invalid type. Please enter 'income', 'expense', or 'both'.")
+        if not end_date:
+            end_date = datetime.now().strftime("%Y-%m-%d")
         
-        conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        conn = self._read_connection()
         cursor = conn.cursor()
         
         try:
-            # Build query based on filters
-            query = """SELECT type, category, SUM(amount) as total 
-                       FROM transactions 
-                       WHERE user_id = ? AND date BETWEEN ? AND ?"""
-            params = [self.current_user["id"], start_date, end_date]
-            
-            if transaction_type != "both":
-                query += " AND type = ?"
-                params.append(transaction_type)
-            
-            query += " GROUP BY type, category ORDER BY type, total DESC"
-            
-            cursor.execute(query, params)
-            results = cursor.fetchall()
-            
-            if not results:
-                print(f"No transactions found for the selected period and filters.")
-                return
-            
-            # Display results
-            income_categories = []
-            expense_categories = []
-            
-            for result in results:
-                if result["type"] == "income":
-                    income_categories.append([result["category"], f"${result['total']:.2f}"])
-                else:  # expense
-                    expense_categories.append([result["category"], f"${result['total']:.2f}"])
-            
-            # Calculate totals
-            income_total = sum(float(row[1].replace('$', '')) for row in income_categories)
-            expense_total = sum(float(row[1].replace('$', '')) for row in expense_categories)
-            
-            # Display income categories
-            if income_categories and (transaction_type == "income" or transaction_type == "both"):
-                print(f"\nIncome Categories ({start_date} to {end_date}):")
-                for i, (category, amount) in enumerate(income_categories):
-                    # Add percentage to income categories
-                    amount_value = float(amount.replace('$', ''))
-                    percentage = (amount_value / income_total) * 100 if income_total > 0 else 0
-                    income_categories[i].append(f"{percentage:.1f}%")
-                
-                print(tabulate(income_categories, headers=["Category", "Amount", "% of Total"], tablefmt="pretty"))
-                print(f"Total Income: ${income_total:.2f}")
-            
-            # Display expense categories
-            if expense_categories and (transaction_type == "expense" or transaction_type == "both"):
-                print(f"\nExpense Categories ({start_date} to {end_date}):")
-                for i, (category, amount) in enumerate(expense_categories):
-                    # Add percentage to expense categories
-                    amount_value = float(amount.replace('$', ''))
-                    percentage = (amount_value / expense_total) * 100 if expense_total > 0 else 0
-                    expense_categories[i].append(f"{percentage:.1f}%")
+            index = self._tag_index(cursor)
+            bits = index.query(expression)
+            first_day, last_day = epoch_day(start_date), epoch_day(end_date)
+            # Only the matching rows are read, by ID
+            sums = self._converted_sums(
+                cursor,
+                "id IN (SELECT value FROM json_each(?)) AND day_num BETWEEN ? AND ?",
+                [json.dumps(index.transaction_ids(bits)), first_day, last_day],
+                group_by=["category"],
+                source=self._history_source(cursor, first_day)
+            )
+        except ValueError as e:
+            print(f"Invalid tag query: {e}")
+            return
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        except LookupError as e:
+            print(f"Currency error: {e}")
+            return
+        finally:
+            self._release(conn)
+        
+        if not sums:
+            print(f"\nNo transactions tagged '{expression}' between {start_date} and {end_date}.")
+            return
+        
+        totals = PeriodTotals(expression)
+        expenses = {}
+        for (category, transaction_type), total in sums.items():
+            totals.add(transaction_type, total)
+            if transaction_type == "expense":
+                expenses[category] = total
+        
+        print(f"\nTagged '{expression}' ({start_date} to {end_date}):")
+        print(f"Total Income: {self._money(totals.income)}")
+        print(f"Total Expenses: {self._money(totals.expense)}")
+        print(f"Net: {self._money(totals.net, signed=True)}")
+        if expenses:
+            print("\nSpending by category:")
+            print_table(category_share_rows(expenses, totals.expense, currency=self._base_currency()),
+                        ["Category", "Spent", "Share"])
+        
+        # Tag counts over all dates, straight from the bitmaps
+        overlaps = [[tag, index.count(bits & tag_bits)] for tag, tag_bits in sorted(index.bits.items())]
+        print(f"\nTags of the {index.count(bits)} matching transaction(s), all dates:")
+        print_table([row for row in overlaps if row[1]], ["Tag", "Transactions"])
+    
+    @timed("report_top_payees")
+    def _generate_top_payees_report(self, start_date=None, end_date=None, category=None,
+                                    transaction_type="expense"):
+        """Show the payees with the largest totals and the most transactions between two dates."""
+        print("\n=== Top Payees ===")
+        
+        while start_date is None:
+            try:
+                start_date = input("Start date (YYYY-MM-DD): ").strip()
+                datetime.strptime(start_date, "%Y-%m-%d")  # Validate format
                 
-                print(tabulate(expense_categories, headers=["Category", "Amount", "% of Total"], tablefmt="pretty"))
-                print(f"Total Expenses: ${expense_total:.2f}")
-            
-            # Show summary if both types are displayed
-            if transaction_type == "both" and income_categories and expense_categories:
-                net_savings = income_total - expense_total
-                savings_rate = (net_savings / income_total) * 100 if income_total > 0 else 0
+                end_date = input("End date (YYYY-MM-DD, leave empty for today): ").strip()
+                if end_date:
+                    datetime.strptime(end_date, "%Y-%m-%d")  # Validate format
                 
-                print(f"\nSummary:")
-                print(f"Total Income: ${income_total:.2f}")
-                print(f"Total Expenses: ${expense_total:.2f}")
-                print(f"Net Savings: ${net_savings:.2f}")
-                print(f"Savings Rate: {savings_rate:.1f}%")
+                category = input("Drill down into a category (includes subcategories, leave empty for all): ").strip()
+                if input("Show income sources instead of expenses? (y/n): ").strip().lower() == "y":
+                    transaction_type = "income"
+            except ValueError:
+                print("Invalid date format. Please use YYYY-MM-DD.")
+                start_date = None
+        
+        if not end_date:
+            end_date = datetime.now().strftime("%Y-%m-%d")
         
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            by_total, by_count = self._top_payees(cursor, epoch_day(start_date), epoch_day(end_date),
+                                                  transaction_type, category)
         except sqlite3.Error as e:
             print(f"Database error: {e}")
+            return
+        except LookupError as e:
+            print(f"Currency error: {e}")
+            return
         finally:
-            if not self.conn:
-                conn.close()
+            self._release(conn)
+        
+        scope = f"{category} " if category else ""
+        if not by_total:
+            print(f"\nNo {scope}{transaction_type} transactions between {start_date} and {end_date}.")
+            return
+        
+        def rows(records):
+            return [[i, record.payee.title() or "(no description)", self._money(record.total), record.count]
+                    for i, record in enumerate(records, 1)]
+        
+        print(f"\nTop {scope}{transaction_type} payees by amount ({start_date} to {end_date}):")
+        print_table(rows(by_total), ["#", "Payee", "Total", "Transactions"])
+        print(f"\nTop {scope}{transaction_type} payees by number of transactions:")
+        print_table(rows(by_count), ["#", "Payee", "Total", "Transactions"])
+    
+    def _top_payees(self, cursor, first_day, last_day, transaction_type="expense", category=None,
+                    limit=TOP_PAYEES, rates=None):
+        """Return ``(by_total, by_count)``: the ``limit`` PayeeTotal records
+        with the largest totals and the most transactions on days
+        ``first_day``..``last_day``, optionally within ``category`` and its
+        subcategories.
+
+        SQLite groups the rows by normalized payee (``payee_key``, with
+        amounts converted to the base currency in the query), and the groups
+        stream into bounded heaps, so memory is O(``limit``) however long
+        the history and however many distinct payees it holds.
+        """
+        rates = rates or self._rates(cursor.connection.cursor())
+        missing_rates = []
+        
+        def to_base(amount, currency, day):
+            try:
+                return rates.convert(amount, currency, day)
+            except LookupError as e:
+                missing_rates.append(e)
+                return 0.0
+        
+        cursor.connection.create_function("payee_key", 1, payee_key, deterministic=True)
+        cursor.connection.create_function("to_base", 3, to_base)
+        where = "user_id = ? AND type = ? AND day_num BETWEEN ? AND ?"
+        params = [rates.base, self.current_user["id"], transaction_type, first_day, last_day]
+        if category:
+            where += " AND category IN (SELECT descendant FROM category_closure WHERE user_id = ? AND ancestor = ?)"
+            params += [self.current_user["id"], category]
+        cursor.execute(
+            f"""SELECT payee_key(description) AS payee, 
+                       SUM(CASE WHEN currency = ? THEN amount ELSE to_base(amount, currency, day_num) END), 
+                       COUNT(*) 
+                FROM {self._history_source(cursor.connection.cursor(), first_day)} 
+                WHERE {where} 
+                GROUP BY payee""",
+            params
+        )
+        by_total, by_count = top_n((PayeeTotal(*row) for row in cursor), limit,
+                                   lambda record: record.total, lambda record: record.count)
+        if missing_rates:
+            raise missing_rates[0]
+        return by_total, by_count
+    
+    def _parse_years(self, text):
+        """Parse ``2023-2025`` or ``2022,2024`` into a list of years (empty if invalid)."""
+        years = []
+        try:
+            for part in text.split(","):
+                if "-" in part:
+                    first, last = (int(p) for p in part.split("-", 1))
+                    years.extend(range(first, last + 1))
+                else:
+                    years.append(int(part))
+        except ValueError:
+            return []
+        if not years or any(y < 2000 or y > 2100 for y in years):
+            return []
+        return years
+    
+    def _yearly_comparison(self, cursor, years, rates=None):
+        """Return ``{(year, month, category, type): total}`` for the given years.
+
+        Closed years (before the current one) come from the yearly cache when
+        present. All other years are read with a single grouped query over
+        their date ranges, and closed years among them are cached.
+        """
+        rates = rates or self._rates(cursor.connection.cursor())
+        user_id = self.current_user["id"]
+        closed = {y for y in years if y < datetime.now().year}
+        totals = {}
+        
+        marks = ", ".join("?" for _ in closed)
+        cached = set()
+        if closed:
+            cursor.execute(
+                f"""SELECT year FROM yearly_cache_years 
+                    WHERE user_id = ? AND base_currency = ? AND year IN ({marks})""",
+                [user_id, rates.base] + sorted(closed)
+            )
+            cached = {row[0] for row in cursor.fetchall()}
+        
+        if cached:
+            cursor.execute(
+                f"""SELECT year, month, category, type, total FROM yearly_cache_totals 
+                    WHERE user_id = ? AND base_currency = ? AND year IN ({", ".join("?" for _ in cached)})""",
+                [user_id, rates.base] + sorted(cached)
+            )
+            for year, month, category, kind, total in cursor.fetchall():
+                totals[(year, month, category, kind)] = total
+        
+        missing = sorted(set(years) - cached)
+        if not missing:
+            return totals
+        
+        # One date range per run of consecutive years, all in one query
+        ranges = []
+        for year in missing:
+            if ranges and ranges[-1][1] == year:
+                ranges[-1][1] = year + 1
+            else:
+                ranges.append([year, year + 1])
+        where = " OR ".join("(day_num >= ? AND day_num < ?)" for _ in ranges)
+        params = [month_days(y, 1)[0] for r in ranges for y in r]
+        
+        # With snapshots, each date range is summed from the snapshot in turn
+        daily = {} if self.snapshot_dir else None
+        for first_day, end_day in zip(params[::2], params[1::2]):
+            if daily is None:
+                break
+            sums = self._snapshot_sums(cursor, first_day, end_day, ["day_num", "category"], rates)
+            daily = None if sums is None else {**daily, **sums}
+        if daily is None:
+            daily = self._converted_sums(cursor, f"({where})", params, group_by=["day_num", "category"],
+                                         rates=rates, source=MONTHLY_ROWS)
+        starts = month_starts(missing[0], missing[-1])
+        sums = {}
+        for (day, category, kind), total in daily.items():
+            index = bisect_right(starts, day) - 1
+            key = (missing[0] + index // 12, index % 12 + 1, category, kind)
+            sums[key] = sums.get(key, 0) + total
+        totals.update(sums)
+        
+        # Cache closed years, including empty ones (reports read from a
+        # snapshot, so the cache is written through the writer connection)
+        to_cache = closed.intersection(missing)
+        if to_cache:
+            conn = self._write_connection()
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO yearly_cache_years (user_id, year, base_currency) VALUES (?, ?, ?)",
+                    [(user_id, year, rates.base) for year in to_cache]
+                )
+                conn.executemany(
+                    """INSERT OR REPLACE INTO yearly_cache_totals 
+                       (user_id, year, base_currency, month, category, type, total) 
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    [(user_id, year, rates.base, month, category, kind, total)
+                     for (year, month, category, kind), total in sums.items() if year in to_cache]
+                )
+                if not self.conn:
+                    conn.commit()
+            finally:
+                self._release(conn)
+        
+        return totals
     
+    @timed("report_trend")
     def _generate_trend_report(self):
         """Generate a trend report for income vs expenses over time."""
         print("\n=== Income vs Expense Trend Report ===")
@@ -1440,267 +6590,179 @@ class PersonalFinanceManager:
         period_choice = input("Select option (1-2): ").strip()
         
         if period_choice == "1":
-            # Monthly trend report
-            current_year = datetime.now().year
+            self._generate_monthly_trend(self._prompt_year())
+        elif period_choice == "2":
+            month, year = self._prompt_month_year()
+            self._generate_daily_trend(month, year)
+        else:
+            print("Invalid choice.")
+    
+    def _generate_monthly_trend(self, year):
+        """Print the month-by-month income vs expense trend for a year."""
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Only include months with data
+            months = [m for m in self._monthly_totals(cursor, year) if m.has_data]
             
-            while True:
-                try:
-                    year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                    year = int(year_input) if year_input else current_year
-                    
-                    if year < 2000 or year > 2100:
-                        print("Please enter a valid year between 2000 and 2100.")
-                        continue
-                    
-                    break
-                except ValueError:
-                    print("Please enter a valid number.")
+            if not months:
+                print(f"No transactions found for {year}.")
+                return
             
-            conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            trend_table = [
+                [
+                    m.label,
+                    self._money(m.income),
+                    self._money(m.expense),
+                    self._money(m.net),
+                    format_percent(m.savings_rate or 0),
+                    trend_arrow(m.net)
+                ]
+                for m in months
+            ]
             
-            try:
-                # Get monthly income and expenses for the year
-                cursor.execute(
-                    """SELECT 
-                        strftime('%m', date) as month,
-                        type,
-                        SUM(amount) as total
-                       FROM transactions 
-                       WHERE user_id = ? AND strftime('%Y', date) = ? 
-                       GROUP BY month, type
-                       ORDER BY month""",
-                    (self.current_user["id"], str(year))
-                )
-                results = cursor.fetchall()
-                
-                if not results:
-                    print(f"No transactions found for {year}.")
-                    return
-                
-                # Process results
-                monthly_data = {str(i).zfill(2): {"income": 0, "expense": 0} for i in range(1, 13)}
-                
-                for result in results:
-                    month = result["month"]
-                    transaction_type = result["type"]
-                    total = result["total"]
-                    
-                    if month in monthly_data:
-                        monthly_data[month][transaction_type] = total
-                
-                # Prepare table data
-                month_names = [datetime(year, i, 1).strftime("%b") for i in range(1, 13)]
-                trend_table = []
-                
-                for i, month in enumerate(range(1, 13)):
-                    month_str = str(month).zfill(2)
-                    data = monthly_data[month_str]
-                    income = data["income"]
-                    expense = data["expense"]
-                    net = income - expense
-                    
-                    # Only include months with data
-                    if income > 0 or expense > 0:
-                        savings_rate = (net / income) * 100 if income > 0 else 0
-                        trend = "↑" if net > 0 else "↓" if net < 0 else "→"
-                        
-                        trend_table.append([
-                            month_names[i],
-                            f"${income:.2f}",
-                            f"${expense:.2f}",
-                            f"${net:.2f}",
-                            f"{savings_rate:.1f}%",
-                            trend
-                        ])
-                
-                print(f"\nMonthly Trend for {year}:")
-                print(tabulate(
-                    trend_table, 
-                    headers=["Month", "Income", "Expenses", "Net", "Savings Rate", "Trend"], 
-                    tablefmt="pretty"
-                ))
-                
-                # Calculate averages
-                months_with_data = len(trend_table)
-                if months_with_data > 0:
-                    avg_income = sum(float(row[1].replace('$', '')) for row in trend_table) / months_with_data
-                    avg_expense = sum(float(row[2].replace('$', '')) for row in trend_table) / months_with_data
-                    avg_net = sum(float(row[3].replace('$', '')) for row in trend_table) / months_with_data
-                    
-                    print(f"\nAverages:")
-                    print(f"Average Monthly Income: ${avg_income:.2f}")
-                    print(f"Average Monthly Expenses: ${avg_expense:.2f}")
-                    print(f"Average Monthly Net: ${avg_net:.2f}")
+            print(f"\nMonthly Trend for {year}:")
+            print_table(trend_table, ["Month", "Income", "Expenses", "Net", "Savings Rate", "Trend"])
             
-            except sqlite3.Error as e:
-                print(f"Database error: {e}")
-            finally:
-                if not self.conn:
-                    conn.close()
-                
-        elif period_choice == "2":
-            # Daily trend report for a month
-            current_month = datetime.now().month
-            current_year = datetime.now().year
+            # Calculate averages
+            count = len(months)
+            average = PeriodTotals("average", sum(m.income for m in months) / count,
+                                   sum(m.expense for m in months) / count)
             
-            while True:
-                try:
-                    month_input = input(f"Month (1-12, leave empty for current month {current_month}): ").strip()
-                    month = int(month_input) if month_input else current_month
-                    
-                    if not 1 <= month <= 12:
-                        print("Month must be between 1 and 12.")
-                        continue
-                    
-                    year_input = input(f"Year (leave empty for current year {current_year}): ").strip()
-                    year = int(year_input) if year_input else current_year
-                    
-                    if year < 2000 or year > 2100:
-                        print("Please enter a valid year between 2000 and 2100.")
-                        continue
-                    
-                    break
-                except ValueError:
-                    print("Please enter a valid number.")
+            print(f"\nAverages:")
+            print(f"Average Monthly Income: {self._money(average.income)}")
+            print(f"Average Monthly Expenses: {self._money(average.expense)}")
+            print(f"Average Monthly Net: {self._money(average.net)}")
+        
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    def _generate_daily_trend(self, month, year):
+        """Print the day-by-day income vs expense trend for a month."""
+        month_name = datetime(year, month, 1).strftime("%B")
+        
+        conn = self._read_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Get daily income and expenses for the month
+            first_day, end_day = month_days(year, month)
+            sums = self._converted_sums(
+                cursor,
+                "day_num >= ? AND day_num < ?",
+                [first_day, end_day],
+                group_by=["day_num"],
+                source=self._history_source(cursor, first_day)
+            )
             
-            month_name = datetime(year, month, 1).strftime("%B")
+            days = {}
+            for (day_num, transaction_type), total in sums.items():
+                day = day_num - first_day + 1
+                if day not in days:
+                    days[day] = PeriodTotals(day)
+                days[day].add(transaction_type, total)
             
-            conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            # Only include days with data
+            days = [days[day] for day in sorted(days) if days[day].has_data]
             
-            try:
-                # Get daily income and expenses for the month
-                cursor.execute(
-                    """SELECT 
-                        strftime('%d', date) as day,
-                        type,
-                        SUM(amount) as total
-                       FROM transactions 
-                       WHERE user_id = ? 
-                       AND strftime('%m', date) = ? 
-                       AND strftime('%Y', date) = ? 
-                       GROUP BY day, type
-                       ORDER BY day""",
-                    (self.current_user["id"], f"{month:02d}", str(year))
-                )
-                results = cursor.fetchall()
-                
-                if not results:
-                    print(f"No transactions found for {month_name} {year}.")
-                    return
-                
-                # Get days in month
-                days_in_month = (datetime(year, month % 12 + 1, 1) - timedelta(days=1)).day if month < 12 else 31
-                
-                # Process results
-                daily_data = {str(i).zfill(2): {"income": 0, "expense": 0} for i in range(1, days_in_month + 1)}
-                
-                for result in results:
-                    day = result["day"]
-                    transaction_type = result["type"]
-                    total = result["total"]
-                    
-                    if day in daily_data:
-                        daily_data[day][transaction_type] = total
-                
-                # Prepare table data
-                trend_table = []
-                
-                for day in range(1, days_in_month + 1):
-                    day_str = str(day).zfill(2)
-                    data = daily_data[day_str]
-                    income = data["income"]
-                    expense = data["expense"]
-                    
-                    # Only include days with data
-                    if income > 0 or expense > 0:
-                        net = income - expense
-                        trend = "↑" if net > 0 else "↓" if net < 0 else "→"
-                        
-                        trend_table.append([
-                            day,
-                            f"${income:.2f}",
-                            f"${expense:.2f}",
-                            f"${net:.2f}",
-                            trend
-                        ])
-                
-                print(f"\nDaily Trend for {month_name} {year}:")
-                print(tabulate(
-                    trend_table, 
-                    headers=["Day", "Income", "Expenses", "Net", "Trend"], 
-                    tablefmt="pretty"
-                ))
-                
-                # Calculate totals and averages
-                days_with_data = len(trend_table)
-                if days_with_data > 0:
-                    total_income = sum(float(row[1].replace('$', '')) for row in trend_table)
-                    total_expense = sum(float(row[2].replace('$', '')) for row in trend_table)
-                    total_net = total_income - total_expense
-                    
-                    avg_income = total_income / days_with_data
-                    avg_expense = total_expense / days_with_data
-                    avg_net = total_net / days_with_data
-                    
-                    print(f"\nSummary:")
-                    print(f"Total Income: ${total_income:.2f}")
-                    print(f"Total Expenses: ${total_expense:.2f}")
-                    print(f"Net: ${total_net:.2f}")
-                    
-                    print(f"\nDaily Averages (for days with transactions):")
-                    print(f"Average Daily Income: ${avg_income:.2f}")
-                    print(f"Average Daily Expenses: ${avg_expense:.2f}")
-                    print(f"Average Daily Net: ${avg_net:.2f}")
+            if not days:
+                print(f"No transactions found for {month_name} {year}.")
+                return
             
-            except sqlite3.Error as e:
-                print(f"Database error: {e}")
-            finally:
-                if not self.conn:
-                    conn.close()
+            trend_table = [
+                [d.label, self._money(d.income), self._money(d.expense), self._money(d.net), trend_arrow(d.net)]
+                for d in days
+            ]
+            
+            print(f"\nDaily Trend for {month_name} {year}:")
+            print_table(trend_table, ["Day", "Income", "Expenses", "Net", "Trend"])
+            
+            # Calculate totals and averages
+            count = len(days)
+            total = PeriodTotals("total", sum(d.income for d in days), sum(d.expense for d in days))
+            
+            print(f"\nSummary:")
+            print(f"Total Income: {self._money(total.income)}")
+            print(f"Total Expenses: {self._money(total.expense)}")
+            print(f"Net: {self._money(total.net)}")
+            
+            print(f"\nDaily Averages (for days with transactions):")
+            print(f"Average Daily Income: {self._money(total.income / count)}")
+            print(f"Average Daily Expenses: {self._money(total.expense / count)}")
+            print(f"Average Daily Net: {self._money(total.net / count)}")
         
-        else:
-            print("Invalid choice.")
-    def add_transaction_direct(self, user_id, transaction_type, amount, category, description, date):
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        except LookupError as e:
+            print(f"Currency error: {e}")
+        finally:
+            self._release(conn)
+    
+    @timed("add_transaction")
+    def add_transaction_direct(self, user_id, transaction_type, amount, category, description, date,
+                               currency=DEFAULT_CURRENCY):
      """Directly insert a transaction into the database (used for unit testing)."""
-     conn = self.conn if self.conn else sqlite3.connect(self.db_file)
-     cursor = conn.cursor()
-     cursor.execute(
-        """INSERT INTO transactions 
-        (user_id, type, amount, category, description, date) 
-        VALUES (?, ?, ?, ?, ?, ?)""",
-        (user_id, transaction_type, amount, category, description, date)
-     )
-     if not self.conn:
-        conn.commit()
-     if not self.conn:
-        conn.close()
+     conn = self._write_connection()
+     try:
+        cursor = conn.cursor()
+        stats = self._category_stats(cursor, user_id, transaction_type, category, currency)
+        fingerprint = self._next_fingerprint(cursor, user_id, transaction_fingerprint(
+           user_id, transaction_type, amount, category, description, date, currency
+        ))
+        cursor.execute(
+           """INSERT INTO transactions 
+           (user_id, type, amount, category, description, date, currency, fingerprint) 
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+           (user_id, transaction_type, amount, category, description, date, currency, fingerprint)
+        )
+        self._flag_anomaly(cursor, cursor.lastrowid, amount, stats)
+        if not self.conn:
+           conn.commit()
+     finally:
+        self._release(conn)
     def _register_test_user(self, username="testuser", password="testpass"):
      """Register a user directly for testing."""
      cursor = self.conn.cursor()
      password_hash = self.hash_password(password)
      cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
      self.conn.commit()
-     self.current_user = {"id": cursor.lastrowid, "username": username}
+     self.current_user = {"id": cursor.lastrowid, "username": username, "base_currency": DEFAULT_CURRENCY}
 
-    def _add_transaction_for_test(self, transaction_type, amount, category, description="", date=None):
+    def _add_transaction_for_test(self, transaction_type, amount, category, description="", date=None,
+                                  currency=None):
      """Add a transaction directly to the DB."""
      if not date:
         date = datetime.now().strftime("%Y-%m-%d")
      cursor = self.conn.cursor()
      cursor.execute(
-        """INSERT INTO transactions (user_id, type, amount, category, description, date)
-           VALUES (?, ?, ?, ?, ?, ?)""",
-        (self.current_user["id"], transaction_type, amount, category, description, date)
+        """INSERT INTO transactions (user_id, type, amount, category, description, date, currency)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (self.current_user["id"], transaction_type, amount, category, description, date,
+         currency or self._base_currency())
     )
      self.conn.commit()
 
 
 def main():
-    pfm = PersonalFinanceManager()
+    # Metrics are always kept for the Usage Statistics screen, and also
+    # written to $FINANCE_MANAGER_METRICS_FILE when that is set; columnar
+    # snapshots are used when $FINANCE_MANAGER_SNAPSHOTS is set to 1, and an
+    # in-memory working copy (saved every $FINANCE_MANAGER_FLUSH_INTERVAL
+    # seconds) when $FINANCE_MANAGER_IN_MEMORY is set to 1.
+    try:
+        flush_interval = float(os.environ.get("FINANCE_MANAGER_FLUSH_INTERVAL") or WORKING_COPY_FLUSH_INTERVAL)
+    except ValueError:
+        print("FINANCE_MANAGER_FLUSH_INTERVAL must be a number of seconds; using the default.")
+        flush_interval = WORKING_COPY_FLUSH_INTERVAL
+    pfm = PersonalFinanceManager(metrics=True, metrics_file=os.environ.get("FINANCE_MANAGER_METRICS_FILE"),
+                                 snapshots=os.environ.get("FINANCE_MANAGER_SNAPSHOTS") == "1",
+                                 in_memory=os.environ.get("FINANCE_MANAGER_IN_MEMORY") == "1",
+                                 flush_interval=flush_interval)
     while True:
         if not pfm.current_user:
             print("\nPersonal Finance Manager")
@@ -1715,6 +6777,7 @@ def main():
                 pfm.login()
             elif choice == "3":
                 print("Goodbye!")
+                pfm.close()
                 break
             else:
                 print("Invalid choice. Please try again.")
@@ -1729,7 +6792,20 @@ def main():
             print("7. Generate Report")
             print("8. Backup Data")
             print("9. Restore Data")
-            print("10. Logout")
+            print("10. Currencies & Exchange Rates")
+            print("11. Bulk Edit Transactions")
+            print("12. Archive Old Transactions")
+            print("13. Category Hierarchy")
+            print("14. Import Transactions (CSV)")
+            print("15. Attachments")
+            print("16. Usage Statistics")
+            print("17. Sync With Another Database")
+            print("18. Categorization Rules")
+            print("19. Database Maintenance")
+            print("20. Household Groups")
+            print("21. Tags")
+            print("22. Export Transactions (CSV)")
+            print("23. Logout")
             choice = input("Choose an option: ").strip()
             
             if choice == "1":
@@ -1751,6 +6827,32 @@ def main():
             elif choice == "9":
                 pfm.restore_data()
             elif choice == "10":
+                pfm.manage_currencies()
+            elif choice == "11":
+                pfm.bulk_edit_transactions()
+            elif choice == "12":
+                pfm.archive_old_transactions()
+            elif choice == "13":
+                pfm.manage_categories()
+            elif choice == "14":
+                pfm.import_transactions()
+            elif choice == "15":
+                pfm.manage_attachments()
+            elif choice == "16":
+                pfm.show_stats()
+            elif choice == "17":
+                pfm.sync_database()
+            elif choice == "18":
+                pfm.manage_category_rules()
+            elif choice == "19":
+                pfm.database_maintenance()
+            elif choice == "20":
+                pfm.manage_groups()
+            elif choice == "21":
+                pfm.manage_tags()
+            elif choice == "22":
+                pfm.export_transactions()
+            elif choice == "23":
                 pfm.logout()
             else:
                 print("Invalid choice. Please try again.")
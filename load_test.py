@@ -0,0 +1,241 @@
+"""Concurrent load test for the Personal Finance Manager database.
+
+Simulates N users working against one on-disk SQLite file at the same time,
+each with its own PersonalFinanceManager (so its own writer and readers),
+running in threads or in separate processes. Every user runs a random mix of
+writes, budget checks and report queries, and the run reports throughput,
+p50/p95/p99 latency and lock-contention errors per operation.
+
+Example:
+
+    python load_test.py --users 1,4,16,32 --mode processes --mix write=60,budget=30,report=10
+
+Several user counts run one after another on a fresh database each, which
+shows the concurrency at which lock timeouts start to appear.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from Finance_Manager import PersonalFinanceManager, month_days, print_table
+
+OPERATIONS = ("write", "budget", "report")
+DEFAULT_MIX = "write=60,budget=30,report=10"
+CATEGORIES = ["Food", "Housing", "Transportation", "Utilities", "Entertainment", "Shopping"]
+
+
+def parse_mix(text):
+    """Parse ``write=60,budget=30,report=10`` into ``{operation: weight}``."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}' (expected one of {', '.join(OPERATIONS)}).")
+        mix[name] = float(weight)
+        if mix[name] < 0:
+            raise ValueError(f"Weight for '{name}' must not be negative.")
+    if not any(mix.values()):
+        raise ValueError("At least one operation needs a positive weight.")
+    return mix
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def prepare_database(db_file, users, seed_transactions, seed=0):
+    """Create ``users`` load-test users with budgets and some history; return their ids."""
+    rng = random.Random(seed)
+    today = datetime.now()
+    fm = PersonalFinanceManager(db_file=db_file)
+    conn = fm._write_connection()
+    try:
+        cursor = conn.cursor()
+        user_ids = []
+        for i in range(users):
+            cursor.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (f"load_user_{i + 1}", fm.hash_password("load"))
+            )
+            user_ids.append(cursor.lastrowid)
+
+        cursor.executemany(
+            "INSERT INTO budgets (user_id, category, amount, month, year) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, category, 500, today.month, today.year) for user_id in user_ids for category in CATEGORIES]
+        )
+        cursor.executemany(
+            """INSERT INTO transactions (user_id, type, amount, category, description, date)
+               VALUES (?, 'expense', ?, ?, 'seed', ?)""",
+            [(user_id, round(rng.uniform(1, 100), 2), rng.choice(CATEGORIES),
+              (today - timedelta(days=rng.randrange(730))).strftime("%Y-%m-%d"))
+             for user_id in user_ids for _ in range(seed_transactions)]
+        )
+        conn.commit()
+    finally:
+        fm._release(conn)
+        fm.close()
+    return user_ids
+
+
+def _write(fm, rng, today):
+    fm.add_transaction_direct(fm.current_user["id"], "expense", round(rng.uniform(1, 100), 2),
+                              rng.choice(CATEGORIES), "load test", today.strftime("%Y-%m-%d"))
+
+
+def _budget(fm, rng, today):
+    conn = fm._read_connection()
+    try:
+        fm._budget_statuses(conn.cursor(), today.month, today.year)
+    finally:
+        fm._release(conn)
+
+
+def _report(fm, rng, today):
+    conn = fm._read_connection()
+    try:
+        cursor = conn.cursor()
+        fm._monthly_totals(cursor, today.year)
+        fm._category_totals(cursor, "day_num >= ? AND day_num < ?",
+                            [month_days(today.year, 1)[0], month_days(today.year, 12)[1]])
+    finally:
+        fm._release(conn)
+
+
+OPERATION_FUNCTIONS = {"write": _write, "budget": _budget, "report": _report}
+
+
+def run_worker(db_file, user_id, mix, operations, seed, busy_timeout=None):
+    """Run one simulated user; return ``(operation, started, seconds, error)`` samples.
+
+    ``started`` is a wall-clock timestamp (comparable across processes).
+    ``error`` is None, ``"lock"`` for busy/locked timeouts or ``"error"``
+    for any other database error.
+    """
+    rng = random.Random(seed)
+    names, weights = zip(*mix.items())
+    today = datetime.now()
+
+    # Start up with the normal timeout; the one under test applies to the workload
+    fm = PersonalFinanceManager(db_file=db_file, readers=1)
+    if busy_timeout is not None:
+        fm._readers.timeout = busy_timeout
+        writer = fm._write_connection()
+        writer.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        fm._release(writer)
+    fm.current_user = {"id": user_id, "username": f"load_user_{user_id}", "base_currency": "USD"}
+    samples = []
+    try:
+        for _ in range(operations):
+            operation = rng.choices(names, weights)[0]
+            error = None
+            started = time.time()
+            start = time.perf_counter()
+            try:
+                OPERATION_FUNCTIONS[operation](fm, rng, today)
+            except sqlite3.OperationalError as e:
+                message = str(e).lower()
+                error = "lock" if "locked" in message or "busy" in message else "error"
+            except sqlite3.Error:
+                error = "error"
+            samples.append((operation, started, time.perf_counter() - start, error))
+    finally:
+        fm.close()
+    return samples
+
+
+def run_load_test(db_file, users, mix, operations, mode="threads", busy_timeout=None, seed=0):
+    """Run ``users`` concurrent workers; return ``(samples, elapsed seconds)``.
+
+    The elapsed time runs from the first operation's start to the last
+    one's end, so worker start-up is not counted against throughput.
+    """
+    user_ids = prepare_database(db_file, users, seed_transactions=200, seed=seed)
+    executor_class = ProcessPoolExecutor if mode == "processes" else ThreadPoolExecutor
+
+    with executor_class(max_workers=users) as executor:
+        futures = [
+            executor.submit(run_worker, db_file, user_id, mix, operations, seed + i, busy_timeout)
+            for i, user_id in enumerate(user_ids)
+        ]
+        samples = [sample for future in futures for sample in future.result()]
+    if not samples:
+        return samples, 0.0
+    first = min(started for _, started, _, _ in samples)
+    last = max(started + seconds for _, started, seconds, _ in samples)
+    return samples, last - first
+
+
+def summarize(samples, elapsed):
+    """Return one table row per operation (and a total row) for a run."""
+    rows = []
+    for operation in OPERATIONS + ("all",):
+        selected = [s for s in samples if operation in ("all", s[0])]
+        if not selected:
+            continue
+        latencies = sorted(seconds * 1000 for _, _, seconds, error in selected if error is None)
+        locks = sum(1 for s in selected if s[3] == "lock")
+        errors = sum(1 for s in selected if s[3] == "error")
+
+        def ms(value):
+            return "-" if value is None else f"{value:.1f}"
+
+        rows.append([
+            operation, len(selected), f"{len(latencies) / elapsed:.1f}" if elapsed else "-",
+            ms(percentile(latencies, 50)), ms(percentile(latencies, 95)), ms(percentile(latencies, 99)),
+            locks, errors
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for the finance manager database.")
+    parser.add_argument("--users", default="1,4,16",
+                        help="Concurrent users; a comma-separated list runs each level in turn (default: 1,4,16)")
+    parser.add_argument("--operations", type=int, default=200, help="Operations per user (default: 200)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--mode", choices=["threads", "processes"], default="threads",
+                        help="Run users as threads or as separate processes (default: threads)")
+    parser.add_argument("--busy-timeout", type=float, default=None,
+                        help="Seconds to wait for a lock (default: PersonalFinanceManager.BUSY_TIMEOUT)")
+    parser.add_argument("--db", default=None,
+                        help="Database file prefix (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+
+    try:
+        levels = [int(level) for level in args.users.split(",")]
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        prefix = args.db or os.path.join(temp_dir, "load_test")
+        summary = []
+        for users in levels:
+            db_file = f"{prefix}_{users}.db"
+            samples, elapsed = run_load_test(db_file, users, mix, args.operations, args.mode,
+                                             args.busy_timeout, args.seed)
+
+            print(f"\n=== {users} concurrent user(s), {args.mode}, {elapsed:.2f}s ===")
+            rows = summarize(samples, elapsed)
+            print_table(rows, ["Operation", "Count", "Ops/s", "p50 ms", "p95 ms", "p99 ms", "Lock Errors",
+                               "Other Errors"])
+            summary.append([users] + rows[-1][2:])
+
+        if len(levels) > 1:
+            print("\n=== Summary by concurrency ===")
+            print_table(summary, ["Users", "Ops/s", "p50 ms", "p95 ms", "p99 ms", "Lock Errors", "Other Errors"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
+import contextlib
+import csv
+import io
+import calendar
+import os
+import tempfile
+import time
 import unittest
 import sqlite3
-from datetime import datetime
-from Finance_Manager import PersonalFinanceManager
+from datetime import datetime, timedelta
+from unittest import mock
+from Finance_Manager import (
+    MONTHLY_ROWS, PersonalFinanceManager, RateCache, TransactionFilter, epoch_day, format_money, month_days,
+    parse_amount, parse_tags, print_table
+)
 
 class TestPersonalFinanceManager(unittest.TestCase):
     def setUp(self):
@@ -82,6 +93,1080 @@ class TestPersonalFinanceManager(unittest.TestCase):
         self.fm._add_transaction_for_test("income", 1000, "Freelance")
         self.fm._generate_yearly_report()
 
+    def test_budget_statuses_are_numeric(self):
+        """test_budget_statuses_are_numeric"""
+        today = datetime.now()
+        cursor = self.conn.cursor()
+        cursor.execute("""INSERT INTO budgets (user_id, category, amount, month, year)
+                          VALUES (?, ?, ?, ?, ?)""",
+                       (self.fm.current_user["id"], "Food", 300, today.month, today.year))
+        self.conn.commit()
+        self.fm._add_transaction_for_test("expense", 120.5, "Food")
+        self.fm._add_transaction_for_test("expense", 30, "Food")
+        statuses = self.fm._budget_statuses(cursor, today.month, today.year)
+        self.assertEqual(len(statuses), 1)
+        self.assertAlmostEqual(statuses[0].spent, 150.5)
+        self.assertAlmostEqual(statuses[0].remaining, 149.5)
+        self.assertEqual(format_money(statuses[0].remaining), "$149.50")
+
+    def test_monthly_totals_by_month(self):
+        """test_monthly_totals_by_month"""
+        self.fm._add_transaction_for_test("income", 1000, "Salary", date="2024-03-01")
+        self.fm._add_transaction_for_test("expense", 400, "Rent", date="2024-03-05")
+        months = self.fm._monthly_totals(self.conn.cursor(), 2024)
+        self.assertEqual(months[2].label, "Mar")
+        self.assertAlmostEqual(months[2].net, 600)
+        self.assertAlmostEqual(months[2].savings_rate, 60.0)
+        self.assertFalse(months[3].has_data)
+
+    def test_streaming_table_matches_tabulate(self):
+        """test_streaming_table_matches_tabulate"""
+        headers = ["ID", "Category", "Amount"]
+        rows = [[i, "Food", f"${i}.00"] for i in range(1, 50)]
+        buffered, streamed = io.StringIO(), io.StringIO()
+        print_table(rows, headers, out=buffered)
+        print_table(iter(rows), headers, out=streamed, sample_size=10)
+        self.assertEqual(buffered.getvalue(), streamed.getvalue())
+        
+        truncated = io.StringIO()
+        print_table(iter(rows + [[50, "A very long category name", "$1.00"]]), headers,
+                    out=truncated, truncate=(1,), sample_size=10)
+        self.assertIn("| A very … |", truncated.getvalue())
+
+    def test_reports_convert_to_base_currency(self):
+        """test_reports_convert_to_base_currency"""
+        self.fm.add_exchange_rate("EUR", "2024-01-01", 1.10)
+        self.fm.add_exchange_rate("EUR", "2024-03-01", 1.20)
+        self.fm._add_transaction_for_test("expense", 100, "Travel", date="2024-02-10", currency="EUR")
+        self.fm._add_transaction_for_test("expense", 100, "Travel", date="2024-03-10", currency="EUR")
+        self.fm._add_transaction_for_test("expense", 50, "Travel", date="2024-03-11")
+        months = self.fm._monthly_totals(self.conn.cursor(), 2024)
+        self.assertAlmostEqual(months[1].expense, 110.0)
+        self.assertAlmostEqual(months[2].expense, 170.0)
+        
+        self.fm.set_base_currency("EUR")
+        months = self.fm._monthly_totals(self.conn.cursor(), 2024)
+        self.assertAlmostEqual(months[2].expense, 100 + 50 / 1.20)
+
+    def test_rate_cache_uses_latest_rate_on_or_before_day(self):
+        """test_rate_cache_uses_latest_rate_on_or_before_day"""
+        self.fm.add_exchange_rate("GBP", "2024-01-01", 1.25)
+        self.fm.add_exchange_rate("GBP", "2024-06-01", 1.30)
+        rates = RateCache(self.conn.cursor())
+        self.assertEqual(rates.rate("GBP", "2024-05-31"), 1.25)
+        self.assertEqual(rates.rate("GBP", "2024-06-01"), 1.30)
+        self.assertEqual(rates.rate("GBP", "2023-12-31"), 1.25)
+        self.assertEqual(rates.convert(10, "USD", "2024-06-01"), 10)
+        with self.assertRaises(LookupError):
+            rates.rate("CHF", "2024-06-01")
+
+    def test_yearly_comparison_caches_closed_years(self):
+        """test_yearly_comparison_caches_closed_years"""
+        past = datetime.now().year - 1
+        self.fm._add_transaction_for_test("expense", 100, "Food", date=f"{past - 1}-01-05")
+        self.fm._add_transaction_for_test("expense", 150, "Food", date=f"{past}-01-05")
+        cursor = self.conn.cursor()
+        totals = self.fm._yearly_comparison(cursor, [past - 1, past])
+        self.assertEqual(totals[(past, 1, "Food", "expense")], 150)
+        cursor.execute("SELECT COUNT(*) FROM yearly_cache_years")
+        self.assertEqual(cursor.fetchone()[0], 2)
+        
+        # A write to a closed year invalidates only that year
+        self.fm._add_transaction_for_test("expense", 25, "Food", date=f"{past}-01-20")
+        cursor.execute("SELECT year FROM yearly_cache_years")
+        self.assertEqual([row[0] for row in cursor.fetchall()], [past - 1])
+        totals = self.fm._yearly_comparison(cursor, [past - 1, past])
+        self.assertEqual(totals[(past, 1, "Food", "expense")], 175)
+
+    def test_readers_use_snapshot_without_blocking_writer(self):
+        """test_readers_use_snapshot_without_blocking_writer"""
+        with tempfile.TemporaryDirectory() as tmp:
+            fm = PersonalFinanceManager(db_file=os.path.join(tmp, "finance.db"))
+            conn = fm._write_connection()
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('disk', 'x')")
+            conn.commit()
+            fm._release(conn)
+            
+            reader = fm._read_connection()
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 0)
+            fm.add_transaction_direct(1, "expense", 10, "Food", "", "2024-01-01")
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 0)
+            fm._release(reader)
+            
+            reader = fm._read_connection()
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("DELETE FROM transactions")
+            fm._release(reader)
+            fm.close()
+
+    def test_bulk_recategorize_and_delete_by_filter(self):
+        """test_bulk_recategorize_and_delete_by_filter"""
+        self.fm._add_transaction_for_test("expense", 5, "Snacks", "Chips", date="2024-02-01")
+        self.fm._add_transaction_for_test("expense", 7, "Snacks", "Candy", date="2024-06-30")
+        self.fm._add_transaction_for_test("expense", 9, "Snacks", "Chips", date="2025-01-01")
+        self.fm._add_transaction_for_test("income", 50, "Refund", "Import batch 7", date="2024-03-01")
+        self.fm._add_transaction_for_test("income", 60, "Refund", "Import batch 7", date="2024-03-02")
+        
+        criteria = TransactionFilter(start_date="2024-01-01", end_date="2024-12-31", category="Snacks")
+        self.assertEqual(self.fm.bulk_update_transactions(criteria, {"category": "Food"}), 2)
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM transactions WHERE category = 'Food'")
+        self.assertEqual(cursor.fetchone()[0], 2)
+        year = epoch_day("2024-01-01"), epoch_day("2024-12-31")
+        self.assertEqual(self.fm._range_totals(cursor, *year, by_category=True),
+                         {("Food", "expense"): 12, ("Refund", "income"): 110})
+        
+        batch = TransactionFilter(transaction_type="income", description="batch 7", min_amount=55)
+        self.assertEqual(self.fm.bulk_delete_transactions(batch), 1)
+        cursor.execute("SELECT COUNT(*) FROM transactions")
+        self.assertEqual(cursor.fetchone()[0], 4)
+        self.assertEqual(self.fm._range_totals(cursor, *year), {("", "expense"): 12, ("", "income"): 50})
+
+        # Wildcard characters in the description are matched literally
+        self.fm._add_transaction_for_test("income", 10, "Refund", "50% back", date="2024-03-03")
+        self.assertEqual(self.fm.bulk_delete_transactions(TransactionFilter(description="_")), 0)
+        self.assertEqual(self.fm.bulk_delete_transactions(TransactionFilter(description="0%")), 1)
+        with self.assertRaises(ValueError):
+            self.fm.bulk_update_transactions(criteria, {"user_id": 2})
+
+    def test_category_stats_flag_spending_anomalies(self):
+        """test_category_stats_flag_spending_anomalies"""
+        amounts = [10, 12, 11, 9, 10, 13, 8]
+        for amount in amounts:
+            self.fm._add_transaction_for_test("expense", amount, "Coffee")
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT count, mean, m2 FROM category_stats WHERE category = 'Coffee'")
+        count, mean, m2 = cursor.fetchone()
+        expected_mean = sum(amounts) / len(amounts)
+        self.assertEqual(count, len(amounts))
+        self.assertAlmostEqual(mean, expected_mean)
+        self.assertAlmostEqual(m2, sum((a - expected_mean) ** 2 for a in amounts))
+
+        self.fm.add_transaction_direct(self.fm.current_user["id"], "expense", 95, "Coffee", "Espresso machine",
+                                       "2024-05-01")
+        cursor.execute("SELECT t.description, a.z_score FROM anomalies a JOIN transactions t ON t.id = a.transaction_id")
+        flagged = cursor.fetchall()
+        self.assertEqual(len(flagged), 1)
+        self.assertEqual(flagged[0][0], "Espresso machine")
+        self.assertGreater(flagged[0][1], 3)
+
+        # Deleting the outlier restores the running statistics and clears the flag
+        cursor.execute("DELETE FROM transactions WHERE description = 'Espresso machine'")
+        cursor.execute("SELECT count, mean FROM category_stats WHERE category = 'Coffee'")
+        count, mean = cursor.fetchone()
+        self.assertEqual(count, len(amounts))
+        self.assertAlmostEqual(mean, expected_mean)
+        cursor.execute("SELECT COUNT(*) FROM anomalies")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_anomaly_flags_follow_updated_transactions(self):
+        """test_anomaly_flags_follow_updated_transactions"""
+        for amount in [10, 12, 11, 9, 10, 13, 8]:
+            self.fm._add_transaction_for_test("expense", amount, "Coffee")
+        self.fm.add_transaction_direct(self.fm.current_user["id"], "expense", 95, "Coffee", "Espresso machine",
+                                       "2024-05-01")
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT transaction_id FROM anomalies")
+        transaction_id = cursor.fetchone()[0]
+
+        # Any update of the amount, category or type drops the stale flag
+        cursor.execute("UPDATE transactions SET amount = 11 WHERE id = ?", (transaction_id,))
+        cursor.execute("SELECT COUNT(*) FROM anomalies")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        # Editing it back into an outlier flags it again
+        answers = iter([str(transaction_id), "", "", "95", "", "", ""])
+        with mock.patch("builtins.input", lambda prompt="": next(answers)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.fm.edit_transaction()
+        cursor.execute("SELECT transaction_id FROM anomalies")
+        self.assertEqual(cursor.fetchall(), [(transaction_id,)])
+
+        # Other columns leave the flag alone; turning the expense into income drops it
+        cursor.execute("UPDATE transactions SET description = 'Refund' WHERE id = ?", (transaction_id,))
+        cursor.execute("SELECT COUNT(*) FROM anomalies")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute("UPDATE transactions SET type = 'income' WHERE id = ?", (transaction_id,))
+        cursor.execute("SELECT COUNT(*) FROM anomalies")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_month_end_forecast_is_cached_until_new_data(self):
+        """test_month_end_forecast_is_cached_until_new_data"""
+        today = datetime.now()
+        cursor = self.conn.cursor()
+        cursor.execute("""INSERT INTO budgets (user_id, category, amount, month, year)
+                          VALUES (?, ?, ?, ?, ?)""",
+                       (self.fm.current_user["id"], "Food", 10000, today.month, today.year))
+        self.conn.commit()
+        for days_ago in range(1, 41):
+            date = (today - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+            self.fm._add_transaction_for_test("expense", 10, "Food", date=date)
+
+        forecasts = self.fm._month_end_forecasts(cursor, today.month, today.year)
+        self.assertEqual(len(forecasts), 1)
+        spent = 10 * (today.day - 1)
+        remaining = calendar.monthrange(today.year, today.month)[1] - today.day
+        self.assertAlmostEqual(forecasts[0].spent, spent)
+        self.assertAlmostEqual(forecasts[0].expected, spent + 10 * remaining)
+        self.assertEqual(forecasts[0].chance_over, 0)
+        self.assertIs(self.fm._month_end_forecasts(cursor, today.month, today.year), forecasts)
+
+        self.fm._add_transaction_for_test("expense", 5, "Food")
+        updated = self.fm._month_end_forecasts(cursor, today.month, today.year)
+        self.assertIsNot(updated, forecasts)
+        self.assertAlmostEqual(updated[0].spent, spent + 5)
+
+    def test_day_numbers_backfilled_and_kept_current(self):
+        """test_day_numbers_backfilled_and_kept_current"""
+        conn = sqlite3.connect(":memory:")
+        conn.execute("""CREATE TABLE transactions (
+                            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, type TEXT NOT NULL,
+                            amount REAL NOT NULL, category TEXT NOT NULL, description TEXT,
+                            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        conn.execute("""INSERT INTO transactions (user_id, type, amount, category, date)
+                        VALUES (1, 'expense', 40, 'Food', '2024-03-05 10:20:30')""")
+        conn.execute("""INSERT INTO transactions (user_id, type, amount, category, date)
+                        VALUES (1, 'expense', 60, 'Food', '1970-01-02')""")
+        conn.commit()
+        fm = PersonalFinanceManager(conn=conn)
+        self.assertEqual(
+            conn.execute("SELECT day_num FROM transactions ORDER BY id").fetchall(),
+            [(epoch_day("2024-03-05"),), (1,)]
+        )
+
+        conn.execute("UPDATE transactions SET date = '2024-03-31' WHERE id = 2")
+        conn.execute("""INSERT INTO transactions (user_id, type, amount, category, date)
+                        VALUES (1, 'expense', 5, 'Food', '2024-04-01')""")
+        self.assertEqual(
+            conn.execute("SELECT day_num FROM transactions WHERE id > 1 ORDER BY id").fetchall(),
+            [(epoch_day("2024-03-31"),), (epoch_day("2024-04-01"),)]
+        )
+        fm.current_user = {"id": 1, "username": "old", "base_currency": "USD"}
+        months = fm._monthly_totals(conn.cursor(), 2024)
+        self.assertAlmostEqual(months[2].expense, 100)
+        self.assertAlmostEqual(months[3].expense, 5)
+        conn.close()
+
+    def test_archive_moves_old_transactions_but_keeps_reports(self):
+        """test_archive_moves_old_transactions_but_keeps_reports"""
+        fm = PersonalFinanceManager(conn=self.conn, archive_file=":memory:")
+        fm.current_user = self.fm.current_user
+        fm._add_transaction_for_test("income", 1000, "Salary", date="2020-03-01")
+        fm._add_transaction_for_test("expense", 40, "Food", date="2020-03-05")
+        fm._add_transaction_for_test("expense", 60, "Food", date="2020-03-20")
+        fm._add_transaction_for_test("expense", 25, "Food", date="2024-03-05")
+        before = [(m.income, m.expense) for m in fm._monthly_totals(self.conn.cursor(), 2020)]
+
+        self.assertEqual(fm.archive_transactions(epoch_day("2021-01-01")), 3)
+        self.conn.commit()
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM transactions")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute("SELECT COUNT(*) FROM archive.transactions")
+        self.assertEqual(cursor.fetchone()[0], 3)
+        cursor.execute("SELECT COUNT(*) FROM all_transactions")
+        self.assertEqual(cursor.fetchone()[0], 4)
+        cursor.execute("SELECT count, total FROM monthly_summaries WHERE category = 'Food'")
+        self.assertEqual(cursor.fetchall(), [(2, 100)])
+
+        self.assertEqual([(m.income, m.expense) for m in fm._monthly_totals(cursor, 2020)], before)
+        self.assertEqual(fm._history_source(cursor, epoch_day("2020-03-01")), "all_transactions")
+        self.assertEqual(fm._history_source(cursor, epoch_day("2024-03-01")), "transactions")
+        cursor.execute("SELECT count FROM category_stats WHERE category = 'Food'")
+        self.assertEqual(cursor.fetchone()[0], 3)
+
+    def test_archived_transaction_ids_are_never_reused(self):
+        """test_archived_transaction_ids_are_never_reused"""
+        # A table from before IDs were reserved is rebuilt with its rows
+        conn = sqlite3.connect(":memory:")
+        conn.execute("""CREATE TABLE transactions (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+                            type TEXT NOT NULL, amount REAL NOT NULL, category TEXT NOT NULL,
+                            description TEXT, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        conn.execute("""INSERT INTO transactions (user_id, type, amount, category, description, date)
+                        VALUES (1, 'expense', 40, 'Food', 'Lunch', '2020-03-05')""")
+        fm = PersonalFinanceManager(conn=conn, archive_file=":memory:")
+        fm._register_test_user()
+        cursor = conn.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'transactions'")
+        self.assertIn("AUTOINCREMENT", cursor.fetchone()[0])
+        cursor.execute("SELECT id, amount, day_num FROM transactions")
+        self.assertEqual(cursor.fetchall(), [(1, 40, epoch_day("2020-03-05"))])
+
+        self.assertEqual(fm.tag_transactions([1], ["lunch"]), 1)
+        self.assertEqual(fm.archive_transactions(epoch_day("2021-01-01")), 1)
+        fm._add_transaction_for_test("expense", 60, "Food", "Dinner", date="2020-03-20")
+        cursor.execute("SELECT id FROM transactions")
+        new_id = cursor.fetchone()[0]
+        self.assertGreater(new_id, 1)
+        cursor.execute("SELECT transaction_id FROM transaction_tags")
+        self.assertEqual(cursor.fetchall(), [(1,)])
+
+        # Archiving again keeps the first archived row
+        self.assertEqual(fm.archive_transactions(epoch_day("2021-01-01")), 1)
+        cursor.execute("SELECT id, description FROM archive.transactions ORDER BY id")
+        self.assertEqual(cursor.fetchall(), [(1, "Lunch"), (new_id, "Dinner")])
+        cursor.execute("SELECT COUNT(*) FROM transactions")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        conn.close()
+
+    def test_interrupted_archive_move_finishes_on_restart(self):
+        """test_interrupted_archive_move_finishes_on_restart"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "finance.db")
+            fm = PersonalFinanceManager(db_file=db_file, archive_file=os.path.join(temp_dir, "archive.db"))
+            conn = fm._write_connection()
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('u', 'x')")
+            conn.commit()
+            user_id = conn.execute("SELECT id FROM users").fetchone()[0]
+            fm._release(conn)
+            for amount, date in [(40, "2020-03-05"), (60, "2020-03-20"), (25, "2024-03-05")]:
+                fm.add_transaction_direct(user_id, "expense", amount, "Food", "", date)
+
+            # Crash after the archive copy was committed, before the hot rows left
+            finish = fm._finish_archiving
+            def crash(cursor):
+                cursor.execute("SELECT 1 FROM meta WHERE key = 'archive_pending'")
+                if cursor.fetchone():
+                    cursor.execute("PRAGMA main.table_info(transactions)")
+                    columns = ", ".join(row[1] for row in cursor.fetchall())
+                    cursor.execute(f"""INSERT INTO archive.transactions ({columns}) 
+                                       SELECT {columns} FROM main.transactions WHERE day_num < ?""",
+                                   (epoch_day("2021-01-01"),))
+                    cursor.connection.commit()
+                    raise sqlite3.OperationalError("disk I/O error")
+                return finish(cursor)
+            fm.current_user = {"id": user_id, "username": "u", "base_currency": "USD"}
+            fm._finish_archiving = crash
+            with self.assertRaises(sqlite3.OperationalError):
+                fm.archive_transactions(epoch_day("2021-01-01"))
+            fm.close()
+
+            fm = PersonalFinanceManager(db_file=db_file, archive_file=os.path.join(temp_dir, "archive.db"))
+            conn = fm._read_connection()
+            try:
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM main.transactions").fetchone()[0], 1)
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM all_transactions").fetchone()[0], 3)
+                self.assertEqual(conn.execute("SELECT count, total FROM monthly_summaries").fetchall(), [(2, 100)])
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM meta WHERE key = 'archive_pending'").fetchone()[0],
+                                 0)
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM change_log").fetchone()[0], 3)
+            finally:
+                fm._release(conn)
+                fm.close()
+
+    def test_parent_categories_roll_up_subtrees(self):
+        """test_parent_categories_roll_up_subtrees"""
+        today = datetime.now()
+        self.fm._add_transaction_for_test("expense", 100, "Groceries")
+        self.fm._add_transaction_for_test("expense", 50, "Restaurants")
+        self.fm._add_transaction_for_test("expense", 20, "Coffee")
+        self.fm._add_transaction_for_test("expense", 70, "Rent")
+        self.assertTrue(self.fm.set_category_parent("Coffee", "Restaurants"))
+        self.assertTrue(self.fm.set_category_parent("Groceries", "Food"))
+        self.assertTrue(self.fm.set_category_parent("Restaurants", "Food"))
+        self.assertFalse(self.fm.set_category_parent("Food", "Coffee"))
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT depth FROM category_closure WHERE ancestor = 'Food' AND descendant = 'Coffee'")
+        self.assertEqual(cursor.fetchone()[0], 2)
+        totals = {r.category: r.total for r in self.fm._category_totals(cursor, "1 = 1", [], rollup=True)}
+        self.assertEqual(totals, {"Food": 170, "Groceries": 100, "Restaurants": 70, "Coffee": 20, "Rent": 70})
+
+        for category, amount in [("Food", 300), ("Restaurants", 60)]:
+            cursor.execute("""INSERT INTO budgets (user_id, category, amount, month, year)
+                              VALUES (?, ?, ?, ?, ?)""",
+                           (self.fm.current_user["id"], category, amount, today.month, today.year))
+        self.conn.commit()
+        statuses = {s.category: s for s in self.fm._budget_statuses(cursor, today.month, today.year)}
+        self.assertEqual(statuses["Food"].spent, 170)
+        self.assertEqual(statuses["Restaurants"].spent, 70)
+        self.assertTrue(statuses["Restaurants"].nested)
+        self.assertFalse(statuses["Food"].nested)
+
+        # Moving a subtree to the top level drops it from its old parent's rollup
+        self.fm.set_category_parent("Restaurants", None)
+        statuses = {s.category: s for s in self.fm._budget_statuses(cursor, today.month, today.year)}
+        self.assertEqual(statuses["Food"].spent, 100)
+        self.assertFalse(statuses["Restaurants"].nested)
+
+    def test_load_test_harness_runs_mixed_workload(self):
+        """test_load_test_harness_runs_mixed_workload"""
+        import load_test
+        self.assertEqual(load_test.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(load_test.percentile([1, 2, 3, 4], 99), 4)
+        with self.assertRaises(ValueError):
+            load_test.parse_mix("write=1,delete=2")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "load.db")
+            mix = load_test.parse_mix("write=2,budget=1,report=1")
+            samples, elapsed = load_test.run_load_test(db_file, 3, mix, 20)
+        self.assertEqual(len(samples), 60)
+        self.assertEqual({s[0] for s in samples}, {"write", "budget", "report"})
+        rows = load_test.summarize(samples, elapsed)
+        self.assertEqual(rows[-1][0], "all")
+        self.assertEqual(rows[-1][1], 60)
+
+    def test_daily_balances_give_range_totals(self):
+        """test_daily_balances_give_range_totals"""
+        self.fm._add_transaction_for_test("income", 1000, "Salary", date="2024-01-01")
+        self.fm._add_transaction_for_test("expense", 40, "Food", date="2024-01-05")
+        self.fm._add_transaction_for_test("expense", 60, "Food", date="2024-01-20")
+        self.fm._add_transaction_for_test("expense", 25, "Fun", date="2024-02-03")
+        cursor = self.conn.cursor()
+        first, last = epoch_day("2024-01-02"), epoch_day("2024-01-31")
+        self.assertEqual(self.fm._range_totals(cursor, first, last), {("", "expense"): 100})
+        self.assertEqual(self.fm._range_totals(cursor, first, epoch_day("2024-12-31"), by_category=True),
+                         {("Food", "expense"): 100, ("Fun", "expense"): 25})
+
+        # Back-dated edits and deletes shift every later running total
+        cursor.execute("UPDATE transactions SET date = '2024-01-03' WHERE category = 'Fun'")
+        cursor.execute("DELETE FROM transactions WHERE amount = 40")
+        self.conn.commit()
+        self.assertEqual(self.fm._range_totals(cursor, first, last), {("", "expense"): 85})
+        self.assertEqual(self.fm._range_totals(cursor, epoch_day("2023-01-01"), last),
+                         {("", "income"): 1000, ("", "expense"): 85})
+
+        # Amounts in other currencies convert per day, so those ranges are summed from rows
+        self.fm._add_transaction_for_test("expense", 10, "Fun", date="2024-01-10", currency="EUR")
+        self.assertIsNone(self.fm._range_totals(cursor, first, last))
+        self.assertIsNotNone(self.fm._range_totals(cursor, epoch_day("2024-01-11"), last))
+
+    def test_import_skips_already_recorded_transactions(self):
+        """test_import_skips_already_recorded_transactions"""
+        self.fm._add_transaction_for_test("expense", 4.5, "Coffee", "Corner  Cafe", date="2024-03-01")
+        self.fm.setup_database()  # fingerprints rows written without one
+        statement = [
+            {"date": "2024-03-01", "type": "expense", "amount": "4.50", "category": "coffee",
+             "description": "corner cafe"},
+            {"date": "2024-03-01", "type": "expense", "amount": "4.50", "category": "Coffee",
+             "description": "Corner Cafe"},
+            {"date": "2024-03-02", "type": "income", "amount": "900", "category": "Salary", "external_id": "tx-1"},
+            {"date": "2024-03-40", "type": "expense", "amount": "1", "category": "Food"},
+            {"date": "2024-03-03", "type": "expense", "amount": "inf", "category": "Food"},
+            {"date": "2024-03-03", "type": "expense", "amount": "NaN", "category": "Food"},
+        ]
+        inserted, duplicates, invalid = self.fm._import_rows(statement)
+        self.assertEqual((inserted, duplicates), (2, 1))
+        self.assertEqual([line for line, _ in invalid], [5, 6, 7])
+        for text in ("inf", "-Infinity", "nan"):
+            with self.assertRaises(ValueError):
+                parse_amount(text)
+        self.assertEqual(parse_amount("4.50"), 4.5)
+
+        # Files that are not UTF-8 (or not CSV) are reported, and nothing is imported
+        with tempfile.TemporaryDirectory() as temp_dir:
+            latin1 = os.path.join(temp_dir, "latin1.csv")
+            with open(latin1, "w", encoding="latin-1", newline="") as f:
+                f.write("date,type,amount,category,description\n2024-03-04,expense,3,Coffee,Caf\u00e9\n")
+            broken = os.path.join(temp_dir, "broken.csv")
+            with open(broken, "w", encoding="utf-8", newline="") as f:
+                f.write("date,type,amount,category,description\n2024-03-04,expense,3,Coffee,"
+                        + "x" * (csv.field_size_limit() + 1) + "\n")
+            for path, message in ((latin1, "save it as UTF-8"), (broken, "not a valid CSV file")):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    self.fm.import_transactions(path)
+                self.assertIn(message, output.getvalue())
+        count = self.conn.execute("SELECT COUNT(*) FROM transactions WHERE amount = 3").fetchone()[0]
+        self.assertEqual(count, 0)
+
+        # Re-importing matches row for row, and a known external ID wins over changed details
+        statement[2]["amount"] = "950"
+        self.assertEqual(self.fm._import_rows(statement)[:2], (0, 3))
+        self.fm.add_transaction_direct(self.fm.current_user["id"], "expense", 4.5, "Coffee", "Corner Cafe",
+                                       "2024-03-01")
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*), SUM(amount) FROM transactions")
+        self.assertEqual(cursor.fetchone(), (4, 913.5))
+
+    def test_attachments_stored_once_and_removed_with_transaction(self):
+        """test_attachments_stored_once_and_removed_with_transaction"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.fm.attachments_dir = os.path.join(temp_dir, "attachments")
+            receipt = os.path.join(temp_dir, "receipt.pdf")
+            with open(receipt, "wb") as f:
+                f.write(os.urandom(200_000))
+            self.fm._add_transaction_for_test("expense", 30, "Food")
+            self.fm._add_transaction_for_test("expense", 12, "Food")
+            first = self.fm.add_attachment(1, receipt)
+            second = self.fm.add_attachment(2, receipt)
+            self.assertIsNone(self.fm.add_attachment(99, receipt))
+
+            def stored_files():
+                return [name for _, _, names in os.walk(self.fm.attachments_dir) for name in names]
+
+            self.assertEqual(len(stored_files()), 1)
+            copy = self.fm.save_attachment(first, os.path.join(temp_dir, "copy.pdf"))
+            with open(copy, "rb") as a, open(receipt, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+
+            # The shared file stays until its last attachment goes
+            cursor = self.conn.cursor()
+            cursor.execute("DELETE FROM transactions WHERE id = 1")
+            self.conn.commit()
+            self.assertEqual(self.fm._attachments(cursor, 1), [])
+            self.fm._prune_attachment_files(cursor)
+            self.assertEqual(len(stored_files()), 1)
+            self.assertTrue(self.fm.remove_attachment(second))
+            self.assertEqual(stored_files(), [])
+
+    def test_backup_and_restore_keep_archived_transactions(self):
+        """test_backup_and_restore_keep_archived_transactions"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cwd = os.getcwd()
+            os.chdir(temp_dir)  # Backups go to ./backups
+            try:
+                fm = PersonalFinanceManager(db_file="finance.db")
+                conn = fm._write_connection()
+                conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+                conn.commit()
+                fm._release(conn)
+                fm.current_user = {"id": 1, "username": "sam", "base_currency": "USD"}
+                fm.add_transaction_direct(1, "expense", 40, "Food", "Old", "2020-03-05")
+                fm.add_transaction_direct(1, "expense", 25, "Food", "New", "2024-03-05")
+                self.assertEqual(fm.archive_transactions(epoch_day("2021-01-01")), 1)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fm.backup_data()
+                fm.add_transaction_direct(1, "expense", 10, "Food", "Later", "2024-03-06")
+                self.assertEqual(fm.archive_transactions(epoch_day("2025-01-01")), 2)
+
+                with mock.patch("builtins.input", side_effect=["1", "y"]), \
+                        contextlib.redirect_stdout(io.StringIO()) as output:
+                    fm.restore_data()
+                self.assertIn("restored successfully", output.getvalue())
+                fm = PersonalFinanceManager(db_file="finance.db")
+                conn = fm._read_connection()
+                try:
+                    rows = conn.execute("SELECT description FROM all_transactions ORDER BY date").fetchall()
+                    self.assertEqual(rows, [("Old",), ("New",)])
+                finally:
+                    fm._release(conn)
+                    fm.close()
+            finally:
+                os.chdir(cwd)
+
+    def test_metrics_count_operations_and_write_prometheus_file(self):
+        """test_metrics_count_operations_and_write_prometheus_file"""
+        today = datetime.now()
+        self.fm.view_budgets(today.month, today.year)
+        self.assertEqual(self.fm.metrics.rows(), [])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "finance.prom")
+            fm = PersonalFinanceManager(conn=self.conn, metrics_file=path)
+            fm.current_user = self.fm.current_user
+            fm.add_transaction_direct(fm.current_user["id"], "expense", 20, "Food", "", today.strftime("%Y-%m-%d"))
+            fm.view_budgets(today.month, today.year)
+            fm.view_budgets(today.month, today.year)
+            rows = {row[0]: row for row in fm.metrics.rows()}
+            self.assertEqual(rows["view_budgets"][1:4], (2, 0, 2))
+            self.assertEqual(rows["add_transaction"][1], 1)
+
+            fm.close()
+            with open(path) as f:
+                text = f.read()
+        self.assertIn('finance_manager_operations_total{operation="view_budgets"} 2', text)
+        self.assertIn('finance_manager_operation_duration_seconds_bucket{operation="view_budgets",le="+Inf"} 2',
+                      text)
+
+    def test_metrics_exclude_time_spent_at_prompts(self):
+        """test_metrics_exclude_time_spent_at_prompts"""
+        delay = 0.05
+        fm = PersonalFinanceManager(conn=self.conn, metrics=True)
+        fm.current_user = self.fm.current_user
+        self.fm._add_transaction_for_test("expense", 20, "Food", "Lunch", date="2024-03-01")
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id FROM transactions")
+        transaction_id = str(cursor.fetchone()[0])
+
+        def slow_input(answers):
+            answers = iter(answers)
+            def answer(prompt=""):
+                time.sleep(delay)
+                return next(answers)
+            return answer
+
+        with mock.patch("builtins.input", slow_input([transaction_id, "", "", "25", "", "", ""])):
+            fm.edit_transaction()
+        with mock.patch("builtins.input", slow_input([transaction_id, "y"])):
+            fm.delete_transaction()
+        rows = {row[0]: row for row in fm.metrics.rows()}
+        for operation in ("edit_transaction", "delete_transaction"):
+            calls, errors, timed, mean_seconds = rows[operation][1:5]
+            self.assertEqual((calls, errors, timed), (1, 0, 1))
+            self.assertLess(mean_seconds, delay)
+
+        # Time after the clock is stopped (e.g. in a pager) is not counted either
+        def paged():
+            fm.metrics.connection_taken()
+            fm.metrics.stop_clock()
+            time.sleep(delay)
+        fm.metrics.run("paged", paged)
+        self.assertLess({row[0]: row for row in fm.metrics.rows()}["paged"][4], delay)
+
+    def test_sync_exchanges_changes_between_replicas(self):
+        """test_sync_exchanges_changes_between_replicas"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            laptop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "laptop.db"))
+            desktop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "desktop.db"))
+            for fm in (laptop, desktop):
+                conn = fm._write_connection()
+                conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+                conn.commit()
+                fm._release(conn)
+                fm.current_user = {"id": 1, "username": "sam", "base_currency": "USD"}
+
+            def rows(fm, sql):
+                conn = fm._read_connection()
+                try:
+                    return conn.execute(sql).fetchall()
+                finally:
+                    fm._release(conn)
+
+            laptop.add_transaction_direct(1, "expense", 12, "Food", "Lunch", "2024-05-01")
+            desktop.add_transaction_direct(1, "income", 900, "Salary", "", "2024-05-01")
+            self.assertEqual(laptop.sync_with(desktop.db_file), (1, 1))
+            self.assertEqual(laptop.sync_with(desktop.db_file), (0, 0))
+
+            # Concurrent edits of one row: the later clock wins on both sides
+            uid = rows(laptop, "SELECT uid FROM transactions WHERE category = 'Food'")[0][0]
+            for fm, amounts in ((laptop, [15]), (desktop, [13, 14])):
+                conn = fm._write_connection()
+                for amount in amounts:
+                    conn.execute("UPDATE transactions SET amount = ? WHERE uid = ?", (amount, uid))
+                conn.commit()
+                fm._release(conn)
+            conn = laptop._write_connection()
+            conn.execute("DELETE FROM transactions WHERE category = 'Salary'")
+            conn.commit()
+            laptop._release(conn)
+            self.assertEqual(desktop.sync_with(laptop.db_file), (1, 1))
+
+            query = "SELECT category, amount FROM transactions ORDER BY id"
+            self.assertEqual(rows(laptop, query), [("Food", 14)])
+            self.assertEqual(rows(desktop, query), rows(laptop, query))
+            laptop.close()
+            desktop.close()
+
+    def test_sync_matches_copies_recorded_on_both_replicas(self):
+        """test_sync_matches_copies_recorded_on_both_replicas"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            laptop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "laptop.db"))
+            desktop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "desktop.db"))
+            for fm in (laptop, desktop):
+                conn = fm._write_connection()
+                conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+                conn.commit()
+                fm._release(conn)
+                # The same transaction entered on both sides gets a different uid on each
+                fm.add_transaction_direct(1, "expense", 12, "Food", "Lunch", "2024-05-01")
+
+            def rows(fm, sql):
+                conn = fm._read_connection()
+                try:
+                    return conn.execute(sql).fetchall()
+                finally:
+                    fm._release(conn)
+
+            def change(fm, sql):
+                conn = fm._write_connection()
+                conn.execute(sql)
+                conn.commit()
+                fm._release(conn)
+
+            laptop.sync_with(desktop.db_file)
+            self.assertEqual(rows(laptop, "SELECT uid FROM transactions"), rows(desktop, "SELECT uid FROM transactions"))
+
+            change(desktop, "UPDATE transactions SET amount = 15")
+            self.assertEqual(laptop.sync_with(desktop.db_file), (1, 0))
+            self.assertEqual(rows(laptop, "SELECT amount FROM transactions"), [(15,)])
+
+            change(laptop, "DELETE FROM transactions")
+            self.assertEqual(laptop.sync_with(desktop.db_file), (0, 1))
+            self.assertEqual(rows(desktop, "SELECT COUNT(*) FROM transactions"), [(0,)])
+            laptop.close()
+            desktop.close()
+
+    def test_synced_rows_match_imports_across_user_ids(self):
+        """test_synced_rows_match_imports_across_user_ids"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            laptop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "laptop.db"))
+            desktop = PersonalFinanceManager(db_file=os.path.join(temp_dir, "desktop.db"))
+            # The same user has ID 2 on the laptop and 1 on the desktop
+            for fm, usernames in ((laptop, ["alex", "sam"]), (desktop, ["sam"])):
+                conn = fm._write_connection()
+                conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, 'x')",
+                                 [(username,) for username in usernames])
+                conn.commit()
+                fm._release(conn)
+                fm.current_user = {"id": len(usernames), "username": "sam", "base_currency": "USD"}
+
+            desktop.add_transaction_direct(1, "expense", 12, "Food", "Lunch", "2024-05-01")
+            desktop.add_transaction_direct(1, "expense", 12, "Food", "Lunch", "2024-05-01")
+            self.assertEqual(laptop.sync_with(desktop.db_file), (2, 0))
+
+            statement = [{"date": "2024-05-01", "type": "expense", "amount": "12", "category": "Food",
+                          "description": "Lunch"}] * 3
+            self.assertEqual(laptop._import_rows(statement)[:2], (1, 2))
+            conn = laptop._read_connection()
+            try:
+                self.assertEqual(conn.execute("SELECT user_id, COUNT(*) FROM transactions").fetchall(), [(2, 3)])
+            finally:
+                laptop._release(conn)
+            laptop.close()
+            desktop.close()
+
+    def test_snapshot_reports_match_database_as_data_changes(self):
+        """test_snapshot_reports_match_database_as_data_changes"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "finance.db")
+            fm = PersonalFinanceManager(db_file=db_file, snapshots=True)
+            plain = PersonalFinanceManager(db_file=db_file)
+            conn = fm._write_connection()
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+            conn.execute("INSERT INTO fx_rates (currency, date, rate) VALUES ('EUR', '2023-01-01', 1.1)")
+            conn.commit()
+            fm._release(conn)
+            for manager in (fm, plain):
+                manager.current_user = {"id": 1, "username": "sam", "base_currency": "USD"}
+
+            def monthly(manager):
+                conn = manager._read_connection()
+                try:
+                    return [(round(month.income, 6), round(month.expense, 6))
+                            for year in (2023, 2024) for month in manager._monthly_totals(conn.cursor(), year)]
+                finally:
+                    manager._release(conn)
+
+            def check():
+                self.assertEqual(monthly(fm), monthly(plain))
+
+            for day in range(1, 29):
+                fm.add_transaction_direct(1, "expense", day, "Food", "", f"2024-02-{day:02d}")
+                fm.add_transaction_direct(1, "income", 100, "Salary", "", f"2023-{day % 12 + 1:02d}-01", "EUR")
+            check()
+            meta_file = os.path.join(temp_dir, "finance_snapshots", "user_1", "meta.json")
+            self.assertTrue(os.path.exists(meta_file))
+
+            # New rows are appended, edits and deletions rewrite the snapshot
+            fm.add_transaction_direct(1, "expense", 40, "Rent", "", "2023-06-15")
+            check()
+            conn = fm._write_connection()
+            conn.execute("UPDATE transactions SET amount = 99 WHERE id = 3")
+            conn.execute("DELETE FROM transactions WHERE id = 4")
+            conn.commit()
+            fm._release(conn)
+            check()
+            self.assertEqual(monthly(fm)[5], (220.0, 40))
+            fm.close()
+            plain.close()
+
+    def test_category_rules_categorize_imports_by_priority(self):
+        """test_category_rules_categorize_imports_by_priority"""
+        self.fm.add_category_rule("keyword", "Uber", "Transport", transaction_type="expense")
+        self.fm.add_category_rule("keyword", "uber eats", "Food", priority=5)
+        self.fm.add_category_rule("regex", r"payroll|acme\s+inc", "Salary", transaction_type="income")
+        self.fm.add_category_rule("amount", None, "Rent", min_amount=1000, max_amount=2000, priority=-1)
+        self.assertIsNone(self.fm.add_category_rule("regex", "(unclosed", "Broken"))
+        statement = [
+            {"date": "2024-03-01", "type": "expense", "amount": "12", "description": "UBER EATS order"},
+            {"date": "2024-03-02", "type": "expense", "amount": "9", "description": "Uber trip"},
+            {"date": "2024-03-03", "type": "income", "amount": "1500", "description": "ACME  Inc payroll"},
+            {"date": "2024-03-04", "type": "expense", "amount": "1500", "description": "Landlord"},
+            {"date": "2024-03-05", "type": "expense", "amount": "3", "description": "Kiosk"},
+            {"date": "2024-03-06", "type": "expense", "amount": "30", "category": "Gifts", "description": "Uber"},
+        ]
+        self.assertEqual(self.fm._import_rows(statement)[:2], (6, 0))
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT category FROM transactions ORDER BY date")
+        self.assertEqual([row[0] for row in cursor.fetchall()],
+                         ["Food", "Transport", "Salary", "Rent", "Other", "Gifts"])
+
+        # The compiled matcher is reused until the rules change, and new
+        # rules can recategorize what was filed under Other
+        matcher = self.fm._category_matcher(cursor)
+        self.assertIs(self.fm._category_matcher(cursor), matcher)
+        self.fm.add_category_rule("keyword", "kiosk", "Snacks")
+        self.assertIsNot(self.fm._category_matcher(cursor), matcher)
+        self.assertEqual(self.fm.apply_category_rules(), 1)
+        self.assertEqual(self.fm._suggest_category("kiosk near work", 2, "expense"), "Snacks")
+        self.assertEqual(self.fm._import_rows(statement)[:2], (0, 6))
+
+        # Rules with groups or global flags keep their own numbering and flags
+        self.fm.add_category_rule("regex", r"(?P<shop>deli)\b", "Lunch")
+        self.fm.add_category_rule("regex", r"\b(\w+) \1\b", "Duplicates")
+        self.fm.add_category_rule("regex", r"(?P<shop>bakery)", "Bread")
+        self.fm.add_category_rule("regex", r"(?x) gym \s+ fee", "Fitness")
+        self.assertEqual(self.fm._suggest_category("paid paid twice", 5, "expense"), "Duplicates")
+        self.assertNotEqual(self.fm._suggest_category("paid once", 5, "expense"), "Duplicates")
+        self.assertEqual(self.fm._suggest_category("Corner deli", 5, "expense"), "Lunch")
+        self.assertEqual(self.fm._suggest_category("bakery", 5, "expense"), "Bread")
+        self.assertEqual(self.fm._suggest_category("GYM FEE", 5, "expense"), "Fitness")
+        self.assertEqual(self.fm._suggest_category("ACME Inc", 5, "income"), "Salary")
+
+    def test_maintenance_analyzes_vacuums_and_checks_when_due(self):
+        """test_maintenance_analyzes_vacuums_and_checks_when_due"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "finance.db")
+            # A database created before incremental auto-vacuum
+            sqlite3.connect(db_file).execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)").connection.close()
+            fm = PersonalFinanceManager(db_file=db_file)
+            conn = fm._write_connection()
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+            conn.executemany(
+                "INSERT INTO transactions (user_id, type, amount, category, description, date) "
+                "VALUES (1, 'expense', 1, 'Food', ?, '2024-01-01')",
+                [("x" * 500,) for _ in range(2000)]
+            )
+            conn.commit()
+            fm._release(conn)
+
+            steps, _, _ = fm.run_maintenance(full=True)
+            self.assertEqual([step.name for step in steps], ["vacuum", "analyze", "quick_check"])
+            self.assertEqual(steps[-1].result, "ok")
+            conn = fm._write_connection()
+            self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+            self.assertTrue(conn.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl = 'transactions'").fetchone())
+            conn.execute("DELETE FROM transactions")
+            conn.commit()
+            fm._release(conn)
+
+            # 2000 deletions make statistics due again; the integrity check is not
+            steps, before, after = fm.run_maintenance()
+            self.assertEqual([step.name for step in steps], ["analyze", "incremental_vacuum"])
+            self.assertLess(after[0], before[0])
+            self.assertEqual(after[1], 0)
+            self.assertEqual(fm.run_maintenance()[0], [])
+            fm.close()
+
+    def test_in_memory_working_copy_flushes_to_file(self):
+        """test_in_memory_working_copy_flushes_to_file"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "finance.db")
+            fm = PersonalFinanceManager(db_file=db_file)
+            conn = fm._write_connection()
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('sam', 'x')")
+            conn.commit()
+            fm._release(conn)
+            fm.add_transaction_direct(1, "expense", 5, "Food", "", "2024-05-01")
+            fm.close()
+
+            def on_disk():
+                conn = sqlite3.connect(db_file)
+                try:
+                    return conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+                finally:
+                    conn.close()
+
+            working = PersonalFinanceManager(db_file=db_file, in_memory=True, flush_interval=0)
+            working.current_user = {"id": 1, "username": "sam", "base_currency": "USD"}
+            working.add_transaction_direct(1, "expense", 7, "Food", "", "2024-05-02")
+            conn = working._read_connection()
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0], 2)
+            working._release(conn)
+            self.assertEqual(on_disk(), 1)
+
+            self.assertTrue(working.flush())
+            self.assertFalse(working.flush())
+            self.assertEqual(on_disk(), 2)
+            working.add_transaction_direct(1, "income", 100, "Salary", "", "2024-05-03")
+            working.close()
+            self.assertEqual(on_disk(), 3)
+            self.assertFalse([name for name in os.listdir(temp_dir) if ".flush-" in name])
+
+    def test_top_payees_rank_normalized_descriptions(self):
+        """test_top_payees_rank_normalized_descriptions"""
+        for description, amount, category in [
+            ("POS UBER *TRIP 4411", 30, "Transport"), ("Uber Trip", 25, "Transport"),
+            ("Corner Cafe #12", 4, "Coffee"), ("corner cafe", 4, "Coffee"), ("CORNER CAFE 7", 5, "Coffee"),
+            ("Rent March", 900, "Housing"), ("", 3, "Food"),
+        ]:
+            self.fm._add_transaction_for_test("expense", amount, category, description, date="2024-03-10")
+        self.fm._add_transaction_for_test("expense", 5000, "Housing", "Rent March", date="2023-01-01")
+        self.fm._add_transaction_for_test("income", 2000, "Salary", "Acme payroll", date="2024-03-01")
+        self.fm.set_category_parent("Coffee", "Food")
+
+        cursor = self.conn.cursor()
+        first_day, last_day = epoch_day("2024-03-01"), epoch_day("2024-03-31")
+        by_total, by_count = self.fm._top_payees(cursor, first_day, last_day, limit=2)
+        self.assertEqual([(r.payee, r.total, r.count) for r in by_total],
+                         [("rent march", 900, 1), ("uber trip", 55, 2)])
+        self.assertEqual([(r.payee, r.count) for r in by_count], [("corner cafe", 3), ("uber trip", 2)])
+
+        # Drilling into Food includes its Coffee subcategory
+        by_total, _ = self.fm._top_payees(cursor, first_day, last_day, category="Food")
+        self.assertEqual([(r.payee, r.total) for r in by_total], [("corner cafe", 13), ("", 3)])
+
+    def test_group_reports_and_budgets_combine_members(self):
+        """test_group_reports_and_budgets_combine_members"""
+        owner = self.fm.current_user
+        self.fm._add_transaction_for_test("expense", 120, "Food", "Groceries", date="2024-05-03")
+        self.fm._add_transaction_for_test("income", 1000, "Salary", "Pay", date="2024-05-01")
+        group_id = self.fm.create_group("Household")
+        self.assertIsNone(self.fm.create_group("Household"))
+
+        self.fm._register_test_user("partner")
+        partner = self.fm.current_user
+        self.fm._add_transaction_for_test("expense", 90, "Food", "Market", date="2024-05-10")
+        self.fm._add_transaction_for_test("expense", 400, "Food", "Groceries", date="2024-04-10")
+        self.assertFalse(self.fm.add_group_member(group_id, "partner"))  # not an owner yet
+
+        self.fm.current_user = owner
+        self.assertTrue(self.fm.add_group_member(group_id, "partner"))
+        self.assertTrue(self.fm.set_group_budget(group_id, "Food", 250, 5, 2024))
+
+        # An invited user's spending stays private until they accept
+        cursor = self.conn.cursor()
+        self.assertEqual(self.fm._group_member_ids(cursor, group_id), [owner["id"]])
+        status, = self.fm._group_budget_statuses(cursor, group_id, 5, 2024)
+        self.assertEqual(status.spent, 120)
+        self.fm.current_user = partner
+        self.assertIsNone(self.fm._group_role(cursor, group_id))
+        self.assertEqual(self.fm._group_invitations(cursor), [(group_id, "Household", "member")])
+        self.assertTrue(self.fm.accept_group_invitation(group_id))
+        self.assertFalse(self.fm.accept_group_invitation(group_id))
+        self.fm._register_test_user("guest")
+        guest = self.fm.current_user
+        self.fm.current_user = owner
+        self.assertTrue(self.fm.add_group_member(group_id, "guest"))
+        self.fm.current_user = guest
+        self.assertTrue(self.fm.decline_group_invitation(group_id))
+        self.assertEqual(self.fm._group_invitations(cursor), [])
+        self.fm.current_user = owner
+
+        sums = self.fm._converted_sums(cursor, "day_num >= ? AND day_num < ?", list(month_days(2024, 5)),
+                                       group_by=["user_id", "category"], source=MONTHLY_ROWS,
+                                       user_ids=self.fm._group_member_ids(cursor, group_id))
+        self.assertEqual(sums, {(owner["id"], "Food", "expense"): 120, (owner["id"], "Salary", "income"): 1000,
+                                (partner["id"], "Food", "expense"): 90})
+        status, = self.fm._group_budget_statuses(cursor, group_id, 5, 2024)
+        self.assertEqual((status.category, status.budget, status.spent), ("Food", 250, 210))
+
+        # Members see the combined spending against group budgets
+        self.fm.current_user = partner
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.fm.check_budget_limit("Food", 10, "2024-05-11")
+        self.assertIn("approaching Household's group budget for Food", output.getvalue())
+        self.assertFalse(self.fm.set_group_budget(group_id, "Food", 500, 5, 2024))
+
+        # A group budget covers subcategories, as personal budgets do
+        self.assertTrue(self.fm.set_category_parent("Snacks", "Food"))
+        self.fm._add_transaction_for_test("expense", 50, "Snacks", "Chips", date="2024-05-12")
+        status, = self.fm._group_budget_statuses(cursor, group_id, 5, 2024)
+        self.assertEqual(status.spent, 260)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.fm.check_budget_limit("Snacks", 50, "2024-05-12")
+        self.assertIn("exceeded Household's group budget for Food", output.getvalue())
+
+        # The last owner cannot leave others behind; an emptied group is removed
+        self.fm.current_user = owner
+        self.assertFalse(self.fm.remove_group_member(group_id))
+        self.assertTrue(self.fm.remove_group_member(group_id, "partner"))
+        self.assertTrue(self.fm.remove_group_member(group_id))
+        cursor.execute("SELECT COUNT(*) FROM user_groups")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_tag_queries_combine_bitmaps(self):
+        """test_tag_queries_combine_bitmaps"""
+        for amount, category in [(100, "Travel"), (40, "Food"), (25, "Food"), (60, "Office")]:
+            self.fm._add_transaction_for_test("expense", amount, category, date="2024-06-01")
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id FROM transactions ORDER BY id")
+        travel, dinner, lunch, office = [row[0] for row in cursor.fetchall()]
+
+        self.assertEqual(self.fm.tag_transactions([travel, dinner, lunch, office], ["business"]), 4)
+        self.assertEqual(self.fm.tag_transactions([travel, dinner], ["trip-2024"]), 2)
+        self.assertEqual(self.fm.tag_transactions([dinner, office], parse_tags("Reimbursable")), 2)
+        self.assertEqual(self.fm.tag_transactions([dinner], ["business"]), 0)
+        # Query operators are not tag names
+        for reserved in ["and", "OR", "not"]:
+            with self.assertRaises(ValueError):
+                parse_tags(f"business {reserved}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(self.fm.tag_transactions([travel], ["not"]))
+
+        index = self.fm._tag_index(cursor)
+        def ids(expression):
+            return index.transaction_ids(index.query(expression))
+        self.assertEqual(ids("business and not reimbursable"), [travel, lunch])
+        self.assertEqual(ids("trip-2024 or reimbursable"), [travel, dinner, office])
+        self.assertEqual(ids("business not (trip-2024 or reimbursable)"), [lunch])
+        self.assertEqual(ids("unknown"), [])
+        for bad in ["business and", "(business", "or trip-2024", "business; drop"]:
+            with self.assertRaises(ValueError):
+                index.query(bad)
+
+        sums = self.fm._converted_sums(cursor, "id IN (SELECT value FROM json_each(?))",
+                                       [self.fm._tagged_ids(cursor, "business and not trip-2024")],
+                                       group_by=["category"])
+        self.assertEqual(sums, {("Food", "expense"): 25, ("Office", "expense"): 60})
+
+        # Untagging and deleting a transaction refresh the cached index
+        self.assertEqual(self.fm.untag_transactions([office], ["reimbursable"]), 1)
+        cursor.execute("DELETE FROM transactions WHERE id = ?", (lunch,))
+        index = self.fm._tag_index(cursor)
+        self.assertEqual(ids("business and not reimbursable"), [travel, office])
+        cursor.execute("SELECT COUNT(*) FROM transaction_tags WHERE transaction_id = ?", (lunch,))
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_transaction_filter_compiles_by_shape(self):
+        """test_transaction_filter_compiles_by_shape"""
+        for amount, category, description, date in [
+            (12, "Food", "Lunch", "2024-03-02"), (80, "Food", "Dinner party", "2024-03-05"),
+            (45, "Travel", "Train", "2024-03-09"), (30, "Office", "Paper", "2024-04-01"),
+            (25, "Food", "Lunch", "2023-12-30"),
+        ]:
+            self.fm._add_transaction_for_test("expense", amount, category, description, date=date)
+        self.fm._add_transaction_for_test("income", 500, "Salary", "Pay", date="2024-03-01")
+        cursor = self.conn.cursor()
+
+        criteria = TransactionFilter("2024-03-01", "2024-03-31", ["Food", "Travel"], "expense",
+                                     min_amount=20, sort="amount", descending=False)
+        cursor.execute(*self.fm._compile_filter(cursor, criteria, "description, amount"))
+        self.assertEqual(cursor.fetchall(), [("Train", 45), ("Dinner party", 80)])
+
+        # Filters of the same shape share one compiled statement
+        other = TransactionFilter("2023-01-01", "2023-12-31", ["Office", "Food"], "expense",
+                                  min_amount=1, sort="amount", descending=False)
+        self.assertEqual(other.select("id", 1), (criteria.select("id", 1)[0],
+                                                 [1, epoch_day("2023-01-01"), epoch_day("2023-12-31"),
+                                                  "Office", "Food", "expense", 1]))
+        self.assertNotEqual(TransactionFilter(category="Food").where()[0], TransactionFilter().where()[0])
+
+        newest = TransactionFilter(transaction_type="expense", limit=2)
+        cursor.execute(*self.fm._compile_filter(cursor, newest, "description"))
+        self.assertEqual(cursor.fetchall(), [("Paper",), ("Train",)])
+        with self.assertRaises(ValueError):
+            TransactionFilter(sort="payee")
+
+        # Tag queries narrow listings, exports and bulk operations alike
+        cursor.execute("SELECT id FROM transactions WHERE description IN ('Train', 'Paper') ORDER BY id")
+        self.fm.tag_transactions([row[0] for row in cursor.fetchall()], ["business"])
+        tagged = TransactionFilter(tags="business", sort="amount")
+        with self.assertRaises(ValueError):
+            tagged.where()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "business.csv")
+            self.assertEqual(self.fm.export_transactions(tagged, path), 2)
+            with open(path, newline="", encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([(r["description"], float(r["amount"])) for r in rows], [("Train", 45), ("Paper", 30)])
+        owner = self.fm.current_user
+        self.fm._register_test_user("copy")
+        self.assertEqual(self.fm._import_rows(rows)[:2], (2, 0))
+        cursor.execute("SELECT category, amount, date FROM transactions WHERE user_id = ? ORDER BY id",
+                       (self.fm.current_user["id"],))
+        self.assertEqual(cursor.fetchall(), [("Travel", 45, "2024-03-09"), ("Office", 30, "2024-04-01")])
+
+        self.fm.current_user = owner
+        self.assertEqual(self.fm.bulk_delete_transactions(TransactionFilter(category="Office", tags="business")), 1)
+        cursor.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (owner["id"],))
+        self.assertEqual(cursor.fetchone()[0], 5)
+
     def tearDown(self):
         self.conn.close()
 